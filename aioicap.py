@@ -0,0 +1,358 @@
+"""Implements an asyncio based ICAP server framework
+
+This module mirrors pyicap.BaseICAPRequestHandler on top of asyncio
+streams, so one event loop can hold many idle keep-alive connections
+without paying for an OS thread per connection. Service endpoints keep
+the same <service>_OPTIONS/<service>_REQMOD/<service>_RESPMOD contract;
+endpoints that need to read the message body are written as coroutines.
+"""
+
+import asyncio
+import functools
+import inspect
+import socket
+from typing import Callable, Dict, List, Optional, Union
+from urllib.parse import urlparse
+
+from pyicap import BaseICAPRequestHandler, ICAPError
+
+__all__ = [
+    "AsyncICAPServer",
+    "AsyncBaseICAPRequestHandler",
+]
+
+
+class AsyncICAPServer:
+    """ICAP Server running on an asyncio event loop
+
+    Blocking work (content extraction, analysis) must not run on the loop;
+    handlers hand it to run_in_executor instead.
+    """
+
+    def __init__(self, server_address, RequestHandlerClass, executor=None, reuse_port: bool = False):
+        self.server_address = server_address
+        self.RequestHandlerClass = RequestHandlerClass
+        self.executor = executor
+        self.reuse_port = reuse_port
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def serve_forever(self):
+        host, port = self.server_address
+        self._server = await asyncio.start_server(
+            self._handle_connection, host, port, reuse_address=True, reuse_port=self.reuse_port or None
+        )
+        async with self._server:
+            await self._server.serve_forever()
+
+    def shutdown(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def run_in_executor(self, func: Callable, *args, **kwargs):
+        """Run a blocking callable on the server executor and await its result"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        handler = self.RequestHandlerClass(reader, writer, self)
+        try:
+            await handler.handle()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+class AsyncBaseICAPRequestHandler:
+    """Asyncio ICAP request handler base class.
+
+    You have to subclass it and provide methods for each service
+    endpoint, exactly as with BaseICAPRequestHandler. Methods that only
+    build or write the response are shared with the threaded handler;
+    methods that read from the client (read_chunk, no_adaptation_required)
+    are coroutines here and must be awaited.
+    """
+
+    protocol_version = BaseICAPRequestHandler.protocol_version
+    _responses = BaseICAPRequestHandler._responses
+    _sys_version = BaseICAPRequestHandler._sys_version
+    _server_version = BaseICAPRequestHandler._server_version
+    _weekdayname = BaseICAPRequestHandler._weekdayname
+    _monthname = BaseICAPRequestHandler._monthname
+
+    # Response building and writing never blocks on the peer: StreamWriter
+    # buffers writes and handle_one_request drains it after each request.
+    write_chunk = BaseICAPRequestHandler.write_chunk
+    send_chunk = BaseICAPRequestHandler.write_chunk
+    cont = BaseICAPRequestHandler.cont
+    set_enc_status = BaseICAPRequestHandler.set_enc_status
+    set_enc_request = BaseICAPRequestHandler.set_enc_request
+    set_enc_header = BaseICAPRequestHandler.set_enc_header
+    set_icap_response = BaseICAPRequestHandler.set_icap_response
+    set_icap_header = BaseICAPRequestHandler.set_icap_header
+    send_headers = BaseICAPRequestHandler.send_headers
+    send_error = BaseICAPRequestHandler.send_error
+    send_enc_error = BaseICAPRequestHandler.send_enc_error
+    log_request = BaseICAPRequestHandler.log_request
+    log_error = BaseICAPRequestHandler.log_error
+    log_message = BaseICAPRequestHandler.log_message
+    istag = BaseICAPRequestHandler.istag
+    version_bytes = BaseICAPRequestHandler.version_bytes
+    date_time_bytes = BaseICAPRequestHandler.date_time_bytes
+    log_date_time_string = BaseICAPRequestHandler.log_date_time_string
+    address_string = BaseICAPRequestHandler.address_string
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, server: AsyncICAPServer):
+        self.reader = reader
+        self.writer = writer
+        self.wfile = writer
+        self.server = server
+        peername = writer.get_extra_info("peername") or ("-", 0)
+        self.client_address = peername[:2]
+
+    async def _readline(self, limit: int = -1) -> bytes:
+        try:
+            line = await self.reader.readline()
+        except ValueError:
+            # Line longer than the stream limit
+            raise ICAPError(400, "Line too long")
+        if limit > 0:
+            return line[:limit]
+        return line
+
+    async def _read_status(self) -> List[bytes]:
+        """Read a HTTP or ICAP status line from input stream"""
+        return (await self._readline()).strip().split(b" ", 2)
+
+    async def _read_request(self) -> List[bytes]:
+        """Read a HTTP or ICAP request line from input stream"""
+        return (await self._readline()).strip().split(b" ", 2)
+
+    async def _read_headers(self) -> Dict[bytes, List[bytes]]:
+        """Read a sequence of header lines"""
+        headers = {}
+        while True:
+            line = (await self._readline()).strip()
+            if line == b"":
+                break
+            k, v = line.split(b":", 1)
+            headers[k.lower()] = headers.get(k.lower(), []) + [v.strip()]
+        return headers
+
+    async def read_chunk(self) -> bytes:
+        """Read a HTTP chunk
+
+        Same semantics as BaseICAPRequestHandler.read_chunk: sets ieof
+        when the ieof extension is seen and returns b"" on the last chunk.
+        """
+        if not self.has_body or self.eob:
+            self.eob = True
+            return b""
+
+        line = await self._readline()
+        if line == b"":
+            # Connection was probably closed
+            self.eob = True
+            return b""
+
+        arr = line.strip().split(b";", 1)
+
+        try:
+            chunk_size = int(arr[0], 16)
+        except ValueError:
+            raise ICAPError(400, "Protocol error, could not read chunk")
+
+        if len(arr) > 1 and arr[1].strip() == b"ieof":
+            self.ieof = True
+
+        try:
+            value = await self.reader.readexactly(chunk_size)
+            await self.reader.readexactly(2)
+        except asyncio.IncompleteReadError as e:
+            self.eob = True
+            return e.partial
+
+        if value == b"":
+            self.eob = True
+
+        return value
+
+    async def parse_request(self):
+        """Parse a request (internal).
+
+        See BaseICAPRequestHandler.parse_request; the only difference is
+        that header and encapsulated header reads are awaited.
+        """
+        self.command = None
+        self.request_version = version = "ICAP/1.0"
+        self.close_connection = False
+
+        requestline = self.raw_requestline.rstrip(b"\r\n")
+        self.requestline = requestline
+
+        words = requestline.split()
+
+        if len(words) != 3:
+            raise ICAPError(400, "Bad request syntax (%r)" % requestline)
+
+        command, request_uri, version = words
+
+        if version[:5] != b"ICAP/":
+            raise ICAPError(400, "Bad request protocol, only accepting ICAP")
+
+        if command not in (b"OPTIONS", b"REQMOD", b"RESPMOD"):
+            raise ICAPError(501, f"command {command!r} is not implemented")
+
+        try:
+            base_version_number = version.split(b"/", 1)[1]
+            version_number = base_version_number.split(b".")
+            if len(version_number) != 2:
+                raise ValueError
+            version_number = int(version_number[0]), int(version_number[1])
+        except (ValueError, IndexError):
+            raise ICAPError(400, f"Bad request version ({version!r})")
+
+        if version_number != (1, 0):
+            raise ICAPError(505, f"Invalid ICAP Version ({base_version_number!r})")
+
+        self.command, self.request_uri, self.request_version = (
+            command,
+            request_uri,
+            version,
+        )
+
+        self.headers = await self._read_headers()
+
+        conntype = self.headers.get(b"connection", [b""])[0]
+        if conntype.lower() == b"close":
+            self.close_connection = True
+
+        self.encapsulated = {}
+        if self.command in [b"RESPMOD", b"REQMOD"]:
+            for enc in self.headers.get(b"encapsulated", [b""])[0].split(b","):
+                k, v = enc.strip().split(b"=")
+                self.encapsulated[k] = int(v)
+
+        self.preview = self.headers.get(b"preview", [None])[0]
+        self.allow = [x.strip() for x in self.headers.get(b"allow", [b""])[0].split(b",")]
+        self.client_ip = self.headers.get(b"x-client-ip", b"No X-Client-IP header")[0]
+
+        if self.command == b"REQMOD":
+            if b"req-hdr" in self.encapsulated:
+                self.enc_req = await self._read_request()
+                self.enc_req_headers = await self._read_headers()
+            if b"req-body" in self.encapsulated:
+                self.has_body = True
+        elif self.command == b"RESPMOD":
+            if b"req-hdr" in self.encapsulated:
+                self.enc_req = await self._read_request()
+                self.enc_req_headers = await self._read_headers()
+            if b"res-hdr" in self.encapsulated:
+                self.enc_res_status = await self._read_status()
+                self.enc_res_headers = await self._read_headers()
+            if b"res-body" in self.encapsulated:
+                self.has_body = True
+
+        self.servicename = urlparse(self.request_uri)[2].strip(b"/")
+
+    async def handle(self):
+        """Handles a connection, possibly serving several keep-alive requests"""
+        self.close_connection = False
+        while not self.close_connection:
+            await self.handle_one_request()
+
+    async def handle_one_request(self):
+        """Handle a single ICAP request"""
+        self.enc_req = None
+        self.enc_req_headers = {}
+        self.enc_res_status = None
+        self.enc_res_headers = {}
+        self.has_body = False
+        self.servicename = None
+        self.encapsulated = {}
+        self.ieof = False
+        self.eob = False
+        self.methos = None
+        self.preview = None
+        self.allow = set()
+        self.client_ip = None
+
+        self.icap_headers = {}
+        self.enc_headers: Dict[bytes, bytes] = {}
+        self.enc_status: Union[None, bytes] = None
+        self.enc_request = None
+
+        self.icap_response_code = None
+
+        try:
+            self.raw_requestline = await self._readline(65537)
+
+            if not self.raw_requestline:
+                self.close_connection = True
+                return
+
+            await self.parse_request()
+
+            mname: str = self.servicename.decode("utf-8") + "_" + self.command.decode("utf-8")
+            if not hasattr(self, mname):
+                self.log_error("%s not found" % mname)
+                raise ICAPError(404)
+
+            method = getattr(self, mname)
+            if not isinstance(method, Callable):
+                raise ICAPError(404)
+            result = method()
+            if inspect.isawaitable(result):
+                await result
+            await self.writer.drain()
+            self.log_request(self.icap_response_code)
+        except (socket.timeout, asyncio.TimeoutError) as e:
+            self.log_error("Request timed out: %r", e)
+            self.close_connection = 1
+        except ConnectionError:
+            self.close_connection = 1
+        except ICAPError as e:
+            self.send_error(e.code, e.message.encode("utf-8"))
+            await self.writer.drain()
+        except Exception as e:
+            self.log_error("Internal server error: %r", e)
+            self.send_error(500, b"Internal server error")
+            await self.writer.drain()
+
+    async def no_adaptation_required(self):
+        """Tells the client to leave the message unaltered
+
+        See BaseICAPRequestHandler.no_adaptation_required.
+        """
+        if b"204" in self.allow or self.preview is not None:
+            # We MUST read everything the client sent us
+            if self.has_body:
+                while True:
+                    if await self.read_chunk() == b"":
+                        break
+            self.set_icap_response(204)
+            self.send_headers()
+        else:
+            self.set_icap_response(200)
+
+            if self.enc_res_status is not None:
+                self.set_enc_status(self.enc_res_status)
+            for h, v in self.enc_res_headers.items():
+                for v_i in v:
+                    self.set_enc_header(h, v_i)
+
+            if not self.has_body:
+                self.send_headers(False)
+                self.log_request(200)
+                return
+
+            self.send_headers(True)
+            while True:
+                chunk = await self.read_chunk()
+                self.write_chunk(chunk)
+                if chunk == b"":
+                    break
@@ -0,0 +1,231 @@
+import functools
+import multiprocessing
+import multiprocessing.util
+import os
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from cache import LRUCache, content_hash
+from file_operations.file_operations import DOCOperations, PDFOperations
+from icapserver import AnalysisResult, ContentAnalyzer
+from textspans import Span
+
+DEFAULT_TASK_TIMEOUT = 30.0
+
+# Documents whose text is extracted in the workers, by FileOperations class name
+DOCUMENT_OPERATIONS = {
+    "PDFOperations": PDFOperations,
+    "DOCOperations": DOCOperations,
+}
+
+CompactResult = Tuple[Dict[str, str], bool, str, List[Tuple[int, int, str]], Optional[int], bool]
+
+# Worker process state, set up once by _init_worker
+_analyzer: Optional[ContentAnalyzer] = None
+_text_cache: Optional[LRUCache] = None
+
+
+def _init_worker(analyzer_factory: Callable[[], ContentAnalyzer]):
+    global _analyzer, _text_cache
+    # Ctrl-C is handled by the ICAP process, which shuts the pool down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _analyzer = analyzer_factory()
+    _text_cache = LRUCache("extracted_text")
+    # Pool workers leave through os._exit, so atexit hooks would never run
+    if hasattr(_analyzer, "close"):
+        multiprocessing.util.Finalize(None, _analyzer.close, exitpriority=10)
+
+
+def _compact(result: Optional[AnalysisResult]) -> CompactResult:
+    # Only the verdict crosses the process boundary, never recognizer results
+    if result is None:
+        return {}, False, "", [], None, True
+    spans = [tuple(span) for span in result.spans]
+    return result.censor_dict or {}, result.block, result.block_message, spans, result.scanned, result.complete
+
+
+def _analyze_text(content: str, origin_ip: str, destination_ip: str, file_name, metadata) -> CompactResult:
+    return _compact(_analyzer.analyze(content, origin_ip, destination_ip, file_name=file_name, metadata=metadata))
+
+
+def _analyze_document(
+    operations: str, file_content: bytes, origin_ip: str, destination_ip: str, metadata
+) -> CompactResult:
+    analyze_function = functools.partial(
+        _analyzer.analyze, origin_ip=origin_ip, destination_ip=destination_ip, metadata=metadata
+    )
+    op_instance = DOCUMENT_OPERATIONS[operations](analyze_function)
+    extract = functools.partial(op_instance.extract_text, file_content, file_content)
+    cached_extract = functools.partial(_text_cache.get_or_compute, (operations, content_hash(file_content)), extract)
+    return _compact(op_instance.analyze_content(file_content, file_content, cached_extract))
+
+
+class ProcessPoolContentAnalyzer(ContentAnalyzer):
+    """
+    Runs text extraction and analysis in a pool of worker processes.
+
+    Each worker builds its own analyzer once with analyzer_factory (e.g.
+    DLPContentAnalyzer: database pool, recognizers, spaCy model) and keeps
+    it warm for every task it runs, so the ICAP process only moves bytes
+    and CPU-bound work never contends with socket I/O for the GIL.
+    Documents go to the workers as raw bytes and only the compact verdict
+    (censor dict, block flag, message) comes back.
+
+    At most max_pending tasks are queued or running; callers past that wait
+    up to task_timeout for a slot. A task that doesn't finish within
+    task_timeout, a full queue and a crashed worker all get the fallback
+    verdict: let through (fail_open) or block. A timed out task keeps its
+    worker and its slot busy until it ends. A pool whose worker died is
+    replaced by a fresh one on the next task.
+
+    The pool is started lazily in the process that first uses it, so it
+    can be created before pre-forking ICAP workers. analyzer_factory must
+    be picklable: workers are spawned, not forked from a threaded process.
+    """
+
+    def __init__(
+        self,
+        analyzer_factory: Callable[[], ContentAnalyzer],
+        processes: Optional[int] = None,
+        max_pending: Optional[int] = None,
+        task_timeout: float = DEFAULT_TASK_TIMEOUT,
+        fail_open: bool = True,
+    ):
+        self.analyzer_factory = analyzer_factory
+        self.processes = processes or os.cpu_count() or 1
+        self.max_pending = max_pending or self.processes * 4
+        self.task_timeout = task_timeout
+        self.fail_open = fail_open
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+        self.completed = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.failures = 0
+        self.restarts = 0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker,
+                    initargs=(self.analyzer_factory,),
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def _replace(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            # Several callers see the same crash; only the first replaces the pool
+            if self._executor is not broken:
+                return
+            self._executor = None
+            self.restarts += 1
+        print("Analysis worker died, starting a new pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+
+    def _fallback(self, reason: str) -> AnalysisResult:
+        if self.fail_open:
+            print(f"{reason}, letting the content through")
+            return AnalysisResult({}, False, "")
+        print(f"{reason}, blocking the content")
+        return AnalysisResult({}, True, f"Content blocked: {reason.lower()}")
+
+    def _run(self, function: Callable[..., CompactResult], *args) -> AnalysisResult:
+        if not self._slots.acquire(timeout=self.task_timeout):
+            with self._lock:
+                self.rejected += 1
+            return self._fallback("Analysis queue full")
+
+        try:
+            executor = self._pool()
+            try:
+                future = executor.submit(function, *args)
+            except RuntimeError:
+                # Broken, or shut down by another caller replacing it. Nothing
+                # ran yet, so it is safe to submit again to a fresh pool
+                self._replace(executor)
+                executor = self._pool()
+                future = executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        # The slot is held until the task ends, not until the caller stops
+        # waiting: a timed out task still occupies a worker
+        future.add_done_callback(lambda _: self._slots.release())
+
+        try:
+            censor_dict, block, block_message, spans, scanned, complete = future.result(timeout=self.task_timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            with self._lock:
+                self.timeouts += 1
+            return self._fallback(f"Analysis timed out after {self.task_timeout}s")
+        except BrokenProcessPool:
+            self._replace(executor)
+            with self._lock:
+                self.failures += 1
+            return self._fallback("Analysis worker crashed")
+        except Exception as e:
+            with self._lock:
+                self.failures += 1
+            return self._fallback(f"Analysis failed ({e})")
+
+        with self._lock:
+            self.completed += 1
+        return AnalysisResult(censor_dict, block, block_message, [Span(*span) for span in spans], scanned, complete)
+
+    def analyze(
+        self,
+        content: Union[str, Iterable[str]],
+        origin_ip: str = "127.0.0.1",
+        destination_ip: str = "127.0.0.1",
+        file_name: str = None,
+        metadata: dict = None,
+        separator: str = "\n",
+    ) -> AnalysisResult:
+        if not isinstance(content, str):
+            # Segments can't be streamed to a worker: it gets the whole text
+            content = separator.join(content)
+        return self._run(_analyze_text, content, origin_ip, destination_ip, file_name, metadata)
+
+    def analyze_document(
+        self,
+        operations: str,
+        file_content,
+        origin_ip: str = "127.0.0.1",
+        destination_ip: str = "127.0.0.1",
+        metadata: dict = None,
+    ) -> AnalysisResult:
+        """Extract the text of a PDF/DOCX (by FileOperations class name) and analyze it in a worker"""
+        if operations not in DOCUMENT_OPERATIONS:
+            raise ValueError(f"No document extraction for {operations}")
+        # The only copy of the body: it is pickled to the worker, which a view of it can't be
+        return self._run(_analyze_document, operations, bytes(file_content), origin_ip, destination_ip, metadata)
+
+    def close(self):
+        with self._lock:
+            executor, self._executor = self._executor, None
+            owned = self._pid == os.getpid()
+        if executor is not None and owned:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "processes": self.processes,
+                "max_pending": self.max_pending,
+                "completed": self.completed,
+                "timeouts": self.timeouts,
+                "rejected": self.rejected,
+                "failures": self.failures,
+                "restarts": self.restarts,
+            }
@@ -0,0 +1,143 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Dict, List, Optional, Tuple
+
+from presidio_analyzer.nlp_engine import NlpArtifacts, NlpEngine
+
+DEFAULT_MAX_BATCH_SIZE = 16
+DEFAULT_MAX_WAIT = 0.005
+
+
+class NlpBatcher:
+    """
+    Runs the spaCy pipeline for concurrent requests in batches.
+
+    Handler threads call process() and block; a single inference thread
+    gathers their texts for up to max_wait seconds or max_batch_size texts,
+    runs them through NlpEngine.process_batch (nlp.pipe) and hands each
+    caller the NlpArtifacts of its own text.
+
+    Only the NLP step is batched: each caller then runs
+    AnalyzerEngine.analyze with its own entities (its origin's rules) and
+    the precomputed artifacts. Gathering stops early once every caller
+    currently waiting is in the batch, so a lone request doesn't wait for
+    company that isn't coming.
+
+    Before start() (or after stop()) process() runs the pipeline inline.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        nlp_engine: NlpEngine,
+        language: str = "es",
+        max_batch_size: int = DEFAULT_MAX_BATCH_SIZE,
+        max_wait: float = DEFAULT_MAX_WAIT,
+    ):
+        self.nlp_engine = nlp_engine
+        self.language = language
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue: "queue.Queue[Tuple[str, Future]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self.batches = 0
+        self.texts = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="nlp-batcher", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self.queue.put(self._STOP)
+        thread.join(timeout)
+
+        # Callers that queued a text after the marker still need an answer
+        leftover = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not self._STOP:
+                leftover.append(item)
+        if leftover:
+            self._process_batch(leftover)
+
+    def process(self, text: str) -> NlpArtifacts:
+        if self._thread is None:
+            return self.nlp_engine.process_text(text, self.language)
+
+        future: Future = Future()
+        with self._lock:
+            self._waiting += 1
+        try:
+            self.queue.put((text, future))
+            return future.result()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is self._STOP:
+                return
+
+            batch = [item]
+            stopping = False
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                with self._lock:
+                    if len(batch) >= self._waiting:
+                        break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._process_batch(batch)
+            if stopping:
+                return
+
+    def _process_batch(self, batch: List[Tuple[str, Future]]):
+        texts = [text for text, _ in batch]
+        try:
+            artifacts = [nlp_artifacts for _, nlp_artifacts in self.nlp_engine.process_batch(texts, self.language)]
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.texts += len(batch)
+        for (_, future), nlp_artifacts in zip(batch, artifacts):
+            future.set_result(nlp_artifacts)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "texts": self.texts,
+                "average_batch_size": self.texts / self.batches if self.batches else 0.0,
+                "waiting": self._waiting,
+            }
@@ -0,0 +1,141 @@
+"""Latency and recall of the cascaded NER against the large model alone
+
+Analyzes a corpus with es_core_news_lg only (the reference) and with the
+cascade DLP uses: es_core_news_sm first, the large model only when
+cascade.needs_large_model says the small one is unsure. Reports the
+latency of both, how often the cascade escalated, and the recall and
+precision of the NER results above the rule confidence level, taking the
+large model's as the truth.
+
+    python benchmarks/ner_cascade.py [--corpus DIR] [--confidence 0.5]
+
+Without --corpus a synthetic Spanish corpus is generated, a mix of texts
+with and without people, places and organizations.
+"""
+
+import argparse
+import glob
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from presidio_analyzer import AnalyzerEngine  # noqa: E402
+from presidio_analyzer.nlp_engine import NlpEngineProvider  # noqa: E402
+
+from cascade import needs_large_model  # noqa: E402
+
+PEOPLE = ["Oliver Bustamante", "Ángel Bravo", "María Fernanda Quispe", "José Carlos Mariátegui", "Rosa Huamán"]
+PLACES = ["Lima", "Arequipa", "Cusco", "el distrito de San Miguel", "Trujillo"]
+ORGANIZATIONS = ["la Pontificia Universidad Católica del Perú", "Interbank", "la SUNAT", "Petroperú"]
+WITH_ENTITIES = [
+    "{person} envió el informe desde {place} el lunes.",
+    "La reunión con {org} será en {place}.",
+    "Por favor contactar a {person}, quien trabaja en {org}.",
+    "{person} y {other} firmaron el contrato en {place}.",
+]
+WITHOUT_ENTITIES = [
+    "Adjunto el reporte mensual con las cifras actualizadas.",
+    "El pedido fue despachado y llegará en tres días hábiles.",
+    "Recuerda revisar los pendientes antes de la reunión de mañana.",
+    "El sistema se actualizará durante la madrugada.",
+    "Los resultados preliminares están en la carpeta compartida.",
+]
+
+
+def synthetic_corpus(rng: random.Random, texts: int):
+    corpus = []
+    for _ in range(texts):
+        sentences = []
+        for _ in range(rng.randint(1, 6)):
+            if rng.random() < 0.3:
+                template = rng.choice(WITH_ENTITIES)
+                sentences.append(
+                    template.format(
+                        person=rng.choice(PEOPLE),
+                        other=rng.choice(PEOPLE),
+                        place=rng.choice(PLACES),
+                        org=rng.choice(ORGANIZATIONS),
+                    )
+                )
+            else:
+                sentences.append(rng.choice(WITHOUT_ENTITIES))
+        corpus.append(" ".join(sentences))
+    return corpus
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", help="Directory of .txt files; a synthetic corpus is used if not given")
+    parser.add_argument("--texts", type=int, default=500, help="Size of the synthetic corpus")
+    parser.add_argument("--large-config", default="./languages-config.yml")
+    parser.add_argument("--small-config", default="./languages-config-sm.yml")
+    parser.add_argument("--entities", nargs="+", default=["PERSON", "LOCATION", "ORGANIZATION"])
+    parser.add_argument("--confidence", type=float, default=0.5, help="confidence_level of the rules")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    if args.corpus:
+        corpus = []
+        for path in sorted(glob.glob(os.path.join(args.corpus, "*.txt"))):
+            with open(path, encoding="utf-8") as f:
+                corpus.append(f.read())
+    else:
+        corpus = synthetic_corpus(random.Random(args.seed), args.texts)
+
+    large = NlpEngineProvider(conf_file=args.large_config).create_engine()
+    small = NlpEngineProvider(conf_file=args.small_config).create_engine()
+    analyzer = AnalyzerEngine(nlp_engine=large, supported_languages=["es"])
+
+    def analyze(text, nlp_artifacts):
+        return analyzer.analyze(text=text, language="es", entities=args.entities, nlp_artifacts=nlp_artifacts)
+
+    def firing(results):
+        return {(r.entity_type, r.start, r.end) for r in results if r.score >= args.confidence}
+
+    # Warm up both pipelines
+    analyze("Hola", large.process_text("Hola", "es"))
+    analyze("Hola", small.process_text("Hola", "es"))
+
+    large_times, cascade_times = [], []
+    escalations = 0
+    true_positives = expected_total = found_total = 0
+    for text in corpus:
+        start = time.perf_counter()
+        expected = analyze(text, large.process_text(text, "es"))
+        large_times.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        nlp_artifacts = small.process_text(text, "es")
+        found = analyze(text, nlp_artifacts)
+        if needs_large_model(nlp_artifacts):
+            escalations += 1
+            found = analyze(text, large.process_text(text, "es"))
+        cascade_times.append(time.perf_counter() - start)
+
+        expected, found = firing(expected), firing(found)
+        true_positives += len(expected & found)
+        expected_total += len(expected)
+        found_total += len(found)
+
+    print(f"{len(corpus)} texts, {escalations} escalated to the large model ({escalations / len(corpus):.0%})")
+    for name, times in (("large only", large_times), ("cascade", cascade_times)):
+        print(
+            f"{name:>10}: mean {statistics.mean(times) * 1000:.1f} ms, "
+            f"p95 {percentile(times, 0.95) * 1000:.1f} ms, total {sum(times):.2f} s"
+        )
+    recall = true_positives / expected_total if expected_total else 1.0
+    precision = true_positives / found_total if found_total else 1.0
+    print(f"cascade recall {recall:.3f}, precision {precision:.3f} (large model results as reference)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compares the PyMuPDF single-parse PDF pipeline with the former pdfminer + PyMuPDF one
+
+Generates PDFs with sensitive values spread over their pages, then times
+text extraction and redaction both ways:
+
+    pdfminer:  extract_pages for the text, then fitz.open again and
+               page.search_for every value on every page
+    PyMuPDF:   ParsedPDF opened once, words with their rectangles, redaction
+               of the found offsets
+
+and checks that both leave none of the values in the redacted document.
+
+    python benchmarks/pdf_pipeline.py [--pages 20] [--documents 5]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from io import BytesIO
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fitz  # noqa: E402
+from pdfminer.high_level import extract_pages  # noqa: E402
+from pdfminer.layout import LTTextContainer  # noqa: E402
+
+from file_operations.file_operations import ParsedPDF  # noqa: E402
+
+WORDS = "el la de que y en un informe cliente cuenta pago fecha contrato area gerencia reporte mensual".split()
+
+
+def make_pdf(rng: random.Random, pages: int, values: list) -> bytes:
+    document = fitz.open()
+    for _ in range(pages):
+        page = document.new_page()
+        lines = []
+        for _ in range(45):
+            words = [rng.choice(WORDS) for _ in range(rng.randint(6, 12))]
+            if rng.random() < 0.2:
+                words.insert(rng.randint(0, len(words)), rng.choice(values))
+            lines.append(" ".join(words))
+        page.insert_text((50, 60), "\n".join(lines), fontsize=9)
+    content = document.tobytes()
+    document.close()
+    return content
+
+
+def pdfminer_pipeline(content: bytes, values: list) -> bytes:
+    text = ""
+    for page_layout in extract_pages(BytesIO(content)):
+        for text_container in page_layout:
+            if isinstance(text_container, LTTextContainer):
+                text += text_container.get_text()
+    censor_dict = {value: "DNI" for value in values if value in text}
+
+    pdf_file = fitz.open("pdf", BytesIO(content))
+    for page in pdf_file:
+        for key in censor_dict:
+            for inst in page.search_for(key):
+                page.add_redact_annot(inst.irect, text=censor_dict[key], align=fitz.TEXT_ALIGN_CENTER)
+        page.apply_redactions()
+    modified = pdf_file.tobytes()
+    pdf_file.close()
+    return modified
+
+
+def pymupdf_pipeline(content: bytes, values: list) -> bytes:
+    parsed = ParsedPDF(content)
+    # Stands in for the analyzer, which returns spans in the extracted text
+    spans = parsed.find_values({value: "DNI" for value in values})
+    modified = parsed.redact(spans)
+    parsed.close()
+    return modified
+
+
+def leftover(content: bytes, values: list) -> int:
+    document = fitz.open("pdf", content)
+    text = " ".join(page.get_text() for page in document)
+    document.close()
+    return sum(text.count(value) for value in values)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--documents", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    values = [str(rng.randint(10_000_000, 99_999_999)) for _ in range(10)]
+    documents = [make_pdf(rng, args.pages, values) for _ in range(args.documents)]
+
+    failed = False
+    for name, pipeline in (("pdfminer", pdfminer_pipeline), ("PyMuPDF", pymupdf_pipeline)):
+        start = time.perf_counter()
+        outputs = [pipeline(content, values) for content in documents]
+        elapsed = time.perf_counter() - start
+        remaining = sum(leftover(output, values) for output in outputs)
+        failed |= remaining > 0
+        print(
+            f"{name:>8}: {elapsed * 1000 / len(documents):.0f} ms per {args.pages} page document, "
+            f"{remaining} values left unredacted"
+        )
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""Times the prefilter against the recognizers it stands in for
+
+Runs every built-in Spanish pattern recognizer plus a few custom ones
+(patterns, deny list, context words) over random texts seeded with real
+looking values, and reports how many texts the prefilter lets through and
+how long it takes compared to the recognizers. That the prefilter never
+hides a detection is tested in tests/test_prefilter.py.
+
+    python benchmarks/prefilter_check.py [--texts 20000] [--seed 1]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from presidio_analyzer import Pattern, PatternRecognizer, RecognizerRegistry  # noqa: E402
+from presidio_analyzer.nlp_engine import NlpArtifacts  # noqa: E402
+from presidio_analyzer.predefined_recognizers import SpacyRecognizer  # noqa: E402
+
+from prefilter import Prefilter  # noqa: E402
+
+SAMPLES = [
+    "12345678",
+    "DNI 45678912",
+    "20123456789",
+    "12345678-Z",
+    "juan.perez@pucp.edu.pe",
+    "a@b.co",
+    "PE12 3456 7890 1234 5678 90",
+    "ES9121000418450200051332",
+    "4111 1111 1111 1111",
+    "5500-0000-0000-0004",
+    "1BoatSLRHtKNngkdXEeobR76b53LETtpyT",
+    "192.168.0.1",
+    "fe80::1",
+    "::",
+    "2001:db8::ff00:42:8329",
+    "31/12/2023",
+    "2024-01-15",
+    "15-MAR-2024",
+    "MAR-24",
+    "https://www.example.com/path",
+    "dlp.pucp.pe",
+    "+51 987 654 321",
+    "(01) 626-2000",
+    "AB1234563",
+    "secreto",
+    "Proyecto Cóndor",
+]
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZáéíóúñ0123456789      .,;:-/@+()#\n"
+
+
+def custom_recognizers():
+    return [
+        PatternRecognizer(
+            supported_entity="DNI",
+            patterns=[Pattern("DNI", r"\b\d{8}\b", 0.5)],
+            context=["dni", "documento"],
+            supported_language="es",
+        ),
+        PatternRecognizer(
+            supported_entity="RUC",
+            patterns=[Pattern("RUC", r"\b(10|15|17|20)\d{9}\b", 0.6)],
+            supported_language="es",
+        ),
+        PatternRecognizer(
+            supported_entity="PROYECTO",
+            deny_list=["secreto", "Proyecto Cóndor", "confidencial"],
+            supported_language="es",
+        ),
+        PatternRecognizer(
+            supported_entity="CODIGO",
+            patterns=[Pattern("Codigo", r"(?P<pre>[A-Z]{2})-(\d)\2{2}", 0.4)],
+            supported_language="es",
+        ),
+    ]
+
+
+def random_text(rng: random.Random) -> str:
+    parts = []
+    for _ in range(rng.randint(1, 8)):
+        if rng.random() < 0.3:
+            parts.append(rng.choice(SAMPLES))
+        else:
+            parts.append("".join(rng.choice(ALPHABET) for _ in range(rng.randint(0, 40))))
+    return " ".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--texts", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    registry = RecognizerRegistry()
+    registry.load_predefined_recognizers(languages=["es"])
+    recognizers = [r for r in registry.recognizers if not isinstance(r, SpacyRecognizer)] + custom_recognizers()
+    combined = Prefilter(recognizers)
+    artifacts = NlpArtifacts(entities=[], tokens=[], tokens_indices=[], lemmas=[], nlp_engine=None, language="es")
+
+    rng = random.Random(args.seed)
+    texts = [random_text(rng) for _ in range(args.texts)] + SAMPLES + [""]
+
+    found = 0
+    passed = 0
+    analyze_time = 0.0
+    prefilter_time = 0.0
+    for text in texts:
+        start = time.perf_counter()
+        passed += combined.may_match(text)
+        prefilter_time += time.perf_counter() - start
+
+        any_found = False
+        for recognizer in recognizers:
+            start = time.perf_counter()
+            results = recognizer.analyze(text=text, entities=recognizer.supported_entities, nlp_artifacts=artifacts)
+            analyze_time += time.perf_counter() - start
+            any_found = any_found or bool(results)
+        found += any_found
+
+    print(f"{len(texts)} texts, {found} with detections, {passed} passed the prefilter")
+    print(f"recognizers: {analyze_time * 1000:.0f} ms, prefilter: {prefilter_time * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
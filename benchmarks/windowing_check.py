@@ -0,0 +1,84 @@
+"""Times windowed analysis against single-pass analysis
+
+Builds long texts out of random words and real looking values (see
+prefilter_check.py) and analyzes each one in a single AnalyzerEngine call
+and through windowing.analyze_windowed, reporting the time taken by both.
+Small windows are used by default so every text has many window borders.
+That both find the same results is tested in tests/test_windowing.py.
+
+    python benchmarks/windowing_check.py [--texts 20] [--length 200000] [--window-size 5000] [--overlap 400]
+"""
+
+import argparse
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from presidio_analyzer import AnalyzerEngine, RecognizerRegistry  # noqa: E402
+from presidio_analyzer.nlp_engine import NlpEngineProvider  # noqa: E402
+from presidio_analyzer.predefined_recognizers import SpacyRecognizer  # noqa: E402
+from prefilter_check import custom_recognizers, random_text  # noqa: E402
+
+from windowing import analyze_windowed  # noqa: E402
+
+
+def long_text(rng: random.Random, length: int) -> str:
+    parts = []
+    total = 0
+    while total < length:
+        part = random_text(rng)
+        parts.append(part)
+        total += len(part) + 1
+    return " ".join(parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--texts", type=int, default=20)
+    parser.add_argument("--length", type=int, default=200000)
+    parser.add_argument("--window-size", type=int, default=5000)
+    parser.add_argument("--overlap", type=int, default=400)
+    parser.add_argument("--languages-config", default="./languages-config.yml")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    nlp_engine = NlpEngineProvider(conf_file=args.languages_config).create_engine()
+    registry = RecognizerRegistry()
+    registry.load_predefined_recognizers(languages=["es"], nlp_engine=nlp_engine)
+    # NER results depend on the surrounding sentence and are not compared
+    recognizers = [r for r in registry.recognizers if not isinstance(r, SpacyRecognizer)] + custom_recognizers()
+    analyzer = AnalyzerEngine(
+        registry=RecognizerRegistry(recognizers=recognizers), nlp_engine=nlp_engine, supported_languages=["es"]
+    )
+
+    def analyze(text: str):
+        nlp_artifacts = nlp_engine.process_text(text, "es")
+        return analyzer.analyze(text=text, language="es", nlp_artifacts=nlp_artifacts)
+
+    rng = random.Random(args.seed)
+    texts = [long_text(rng, args.length) for _ in range(args.texts)]
+    executor = ThreadPoolExecutor(max_workers=4)
+
+    found = 0
+    single_time = 0.0
+    windowed_time = 0.0
+    for text in texts:
+        start = time.perf_counter()
+        found += len(analyze(text))
+        single_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        analyze_windowed(analyze, text, args.window_size, args.overlap, executor)
+        windowed_time += time.perf_counter() - start
+
+    executor.shutdown()
+    print(f"{len(texts)} texts of ~{args.length} characters, {found} results")
+    print(f"single pass: {single_time * 1000:.0f} ms, windowed: {windowed_time * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,152 @@
+import io
+import mmap
+import os
+import tempfile
+from typing import Iterator, Optional
+
+DEFAULT_INITIAL_SIZE = 64 * 1024
+DEFAULT_SPILL_THRESHOLD = 8 * 1024 * 1024
+
+
+class BodyTooLarge(Exception):
+    """Raised when a message body grows past BodyBuffer.max_size"""
+
+    def __init__(self, size: int, max_size: int):
+        super().__init__(f"Body of at least {size} bytes exceeds the {max_size} bytes limit")
+        self.size = size
+        self.max_size = max_size
+
+
+class BodyBuffer:
+    """
+    Accumulates a message body with bounded memory.
+
+    Chunks are copied once into a preallocated bytearray. Once the body
+    grows past spill_threshold it is moved to an anonymous temporary file
+    and later chunks are appended there; getbuffer() then maps the file
+    instead of reading it back into memory.
+
+    Writing past max_size raises BodyTooLarge. getbuffer() must only be
+    called once the body is complete.
+    """
+
+    def __init__(
+        self,
+        initial_size: int = DEFAULT_INITIAL_SIZE,
+        spill_threshold: int = DEFAULT_SPILL_THRESHOLD,
+        max_size: Optional[int] = None,
+    ):
+        self.spill_threshold = spill_threshold
+        self.max_size = max_size
+        self._buffer = bytearray(min(initial_size, spill_threshold))
+        self._length = 0
+        self._file = None
+        self._map = None
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write(self, chunk: bytes):
+        new_length = self._length + len(chunk)
+        if self.max_size is not None and new_length > self.max_size:
+            raise BodyTooLarge(new_length, self.max_size)
+
+        if self._file is None and new_length > self.spill_threshold:
+            self._spill()
+
+        if self._file is not None:
+            self._file.write(chunk)
+        else:
+            # Fills the preallocated space; grows (amortized) past it
+            self._buffer[self._length : new_length] = chunk
+        self._length = new_length
+
+    def _spill(self):
+        self._file = tempfile.TemporaryFile(prefix="icap-body-")
+        self._file.write(memoryview(self._buffer)[: self._length])
+        self._buffer = bytearray()
+
+    def head(self, size: int) -> bytes:
+        """Copy of the first size bytes; unlike getbuffer() the body can keep growing"""
+        if self._file is None:
+            return bytes(self._buffer[: min(size, self._length)])
+        self._file.flush()
+        return os.pread(self._file.fileno(), min(size, self._length), 0)
+
+    def getbuffer(self) -> memoryview:
+        """Return a read-only view of the whole body, without copying it"""
+        if self._file is None:
+            return memoryview(self._buffer)[: self._length].toreadonly()
+
+        if self._map is None:
+            self._file.flush()
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._map)
+
+    def iter_chunks(self, size: int = DEFAULT_INITIAL_SIZE) -> Iterator[memoryview]:
+        view = self.getbuffer()
+        for start in range(0, len(view), size):
+            yield view[start : start + size]
+
+    def close(self):
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # Views are still alive somewhere; the map goes with them
+                pass
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._buffer = bytearray()
+        self._length = 0
+
+
+class BufferReader(io.RawIOBase):
+    """Read-only, seekable file object over a buffer that doesn't copy it up front"""
+
+    def __init__(self, buffer):
+        self._view = memoryview(buffer)
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        size = min(len(b), len(self._view) - self._pos)
+        if size <= 0:
+            return 0
+        b[:size] = self._view[self._pos : self._pos + size]
+        self._pos += size
+        return size
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = len(self._view) + offset
+        else:
+            raise ValueError(f"Invalid whence ({whence})")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def tell(self) -> int:
+        return self._pos
@@ -0,0 +1,32 @@
+import os
+from typing import Optional
+
+from presidio_analyzer.nlp_engine import NlpArtifacts, NlpEngine, NlpEngineProvider
+
+DEFAULT_SMALL_CONF_FILE = "./languages-config-sm.yml"
+
+
+def load_small_engine(conf_file: str = DEFAULT_SMALL_CONF_FILE) -> Optional[NlpEngine]:
+    """NLP engine of the first tier, or None (large model only) if it isn't configured or installed"""
+    if not os.path.exists(conf_file):
+        return None
+    try:
+        return NlpEngineProvider(conf_file=conf_file).create_engine()
+    except Exception as e:
+        print(f"Cannot load the small NER model from {conf_file}, using the large one only: {e}")
+        return None
+
+
+def needs_large_model(nlp_artifacts: NlpArtifacts) -> bool:
+    """
+    Whether the small model's NER output is too uncertain to act on.
+
+    That is the case when the small model tagged a proper noun but didn't
+    recognize it as any entity (a name it likely missed). The scores of
+    NER results are no signal: the spaCy recognizer gives every entity of
+    a label the same fixed score, whichever model found it.
+    """
+    doc = nlp_artifacts.tokens
+    if doc is None:
+        return False
+    return any(token.pos_ == "PROPN" and not token.ent_type_ for token in doc)
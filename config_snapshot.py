@@ -0,0 +1,83 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from db import Database
+
+
+class ConfigSnapshot:
+    """
+    Everything the analyzer needs from the database, as plain data.
+
+    Read in one query (Database.get_config_snapshot) and saved to a compact
+    JSON file, so a server can start from the last good snapshot when the
+    database is slow or down and reconcile with it later.
+
+    version is a hash of the contents: two snapshots with the same version
+    hold the same configuration, whenever and wherever they were read.
+    """
+
+    def __init__(self, entity_types: List[Dict[str, Any]], rules: List[Dict[str, Any]], created_at: Optional[float] = None):
+        self.entity_types = entity_types
+        self.rules = rules
+        self.created_at = created_at or time.time()
+        self.version = self._hash(entity_types, rules)
+
+    @staticmethod
+    def _hash(*parts) -> str:
+        canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+
+    @property
+    def entity_types_version(self) -> str:
+        return self._hash(self.entity_types)
+
+    @property
+    def rules_version(self) -> str:
+        return self._hash(self.rules)
+
+    @classmethod
+    def from_database(cls, db: Database) -> "ConfigSnapshot":
+        snapshot = db.get_config_snapshot()
+        return cls(snapshot["entity_types"], snapshot["rules"])
+
+    @classmethod
+    def load(cls, path: str) -> Optional["ConfigSnapshot"]:
+        """The snapshot saved at path, or None when there is no usable one"""
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            snapshot = cls(data["entity_types"], data["rules"], data.get("created_at"))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable config snapshot {path}: {e}")
+            return None
+
+        if data.get("version") != snapshot.version:
+            print(f"Ignoring config snapshot {path}: contents don't match version {data.get('version')}")
+            return None
+        return snapshot
+
+    def save(self, path: str):
+        """Write the snapshot next to path and rename it over path, so readers never see half a file"""
+        data = {
+            "version": self.version,
+            "created_at": self.created_at,
+            "entity_types": self.entity_types,
+            "rules": self.rules,
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(prefix=".config-snapshot-", dir=directory)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"), default=str)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
@@ -1,33 +1,229 @@
+import atexit
 import json
-from typing import Any, Dict, List
+import queue
+import select
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
 
 import psycopg2
+import psycopg2.extensions
 import psycopg2.extras
+import psycopg2.pool
 from presidio_analyzer import Pattern
 
 
+class PoolTimeout(psycopg2.pool.PoolError):
+    """Raised when no connection is returned to the pool within checkout_timeout"""
+
+
+class PreparedConnection(psycopg2.extensions.connection):
+    """Connection that remembers which statements were prepared on it"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, elapsed: float, error: bool = False):
+        self.count += 1
+        self.errors += error
+        self.total += elapsed
+        self.max = max(self.max, elapsed)
+
+    def as_dict(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "avg_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
 class Database:
-    def __init__(self, host, database, user, password):
+    """
+    PostgreSQL access shared by every handler thread.
+
+    Each query checks a connection out of a ThreadedConnectionPool for its
+    own duration, so threads never share a cursor. When all max_connections
+    are in use, callers wait up to checkout_timeout for one to be returned.
+
+    The hot queries in PREPARED are run as server-side prepared statements,
+    prepared lazily the first time a pooled connection runs them.
+
+    connect()/close() open and tear down the whole pool; close it before
+    forking and connect again in the child.
+    """
+
+    HISTORY_COLUMNS = (
+        "origin, destination, sensitive_data, results, level, action, text, text_redacted, file, metadata"
+    )
+
+    PREPARED = {
+        "get_rules_network": """SELECT r.id, r.codigo, cet.name as entity, r.confidence_level, r.hits_lower, r.hits_upper, r.action, r.level
+            FROM rules r
+            INNER JOIN custom_entity_types cet ON r.entity_id = cet.id
+            INNER JOIN groups_rules gr ON gr.rule_id = r.id
+            INNER JOIN networks n ON n.id = gr.network_id
+            WHERE r.status = true AND $1::inet <<= n.subnet::inet""",
+        "get_last_update_time": """SELECT GREATEST(
+                MAX(updated_at),
+                MAX(created_at)
+            ) as last_update
+            FROM (
+                SELECT updated_at, created_at FROM custom_entity_types
+                UNION ALL
+                SELECT updated_at, created_at FROM rules
+            ) as updates""",
+        "save_history": f"""INSERT INTO history ({HISTORY_COLUMNS})
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10)""",
+    }
+
+    def __init__(
+        self,
+        host,
+        database,
+        user,
+        password,
+        min_connections: int = 1,
+        max_connections: int = 10,
+        checkout_timeout: float = 30.0,
+    ):
+        self.host = host
+        self.database = database
+        self.user = user
+        self.password = password
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.checkout_timeout = checkout_timeout
+        self.pool: Optional[psycopg2.pool.ThreadedConnectionPool] = None
+        self._slots = threading.BoundedSemaphore(max_connections)
+        self._stats_lock = threading.Lock()
+        self._in_use = 0
+        self._checkouts = 0
+        self._checkout_waits = 0
+        self._checkout_wait_total = 0.0
+        self._checkout_wait_max = 0.0
+        self._queries: Dict[str, QueryStats] = {}
+        self.connect()
+
+    def connect(self):
         try:
-            self.conn = psycopg2.connect(host=host, database=database, user=user, password=password)
-            print(f"Connected to database {database} on {host}")
-            self.cursor = self.conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+            self.pool = psycopg2.pool.ThreadedConnectionPool(
+                self.min_connections,
+                self.max_connections,
+                host=self.host,
+                database=self.database,
+                user=self.user,
+                password=self.password,
+                connection_factory=PreparedConnection,
+            )
+            if self.min_connections:
+                print(f"Connected to database {self.database} on {self.host}")
+            else:
+                # Connections are opened on first use
+                print(f"Using database {self.database} on {self.host}")
         except (Exception, psycopg2.DatabaseError) as e:
             print("Cannot connect to the database")
             raise e
 
-    def execute(self, query, *args):
+    @contextmanager
+    def connection(self) -> Iterator[PreparedConnection]:
+        """Check a connection out of the pool for the duration of the block"""
+        start = time.perf_counter()
+        if not self._slots.acquire(blocking=False):
+            with self._stats_lock:
+                self._checkout_waits += 1
+            if not self._slots.acquire(timeout=self.checkout_timeout):
+                raise PoolTimeout(f"No database connection available after {self.checkout_timeout}s")
         try:
-            self.cursor.execute(query, args)
-            if query.strip().upper().startswith("SELECT"):
-                result = self.cursor.fetchall()
-                return [dict(row) for row in result]
-            else:
-                self.conn.commit()
-                return None
+            conn = self.pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        waited = time.perf_counter() - start
+        with self._stats_lock:
+            self._in_use += 1
+            self._checkouts += 1
+            self._checkout_wait_total += waited
+            self._checkout_wait_max = max(self._checkout_wait_max, waited)
+
+        broken = False
+        try:
+            yield conn
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            broken = True
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_use -= 1
+            try:
+                if self.pool is not None and not self.pool.closed:
+                    # Drop connections the server closed, the pool reopens them on demand
+                    self.pool.putconn(conn, close=broken or bool(conn.closed))
+            finally:
+                self._slots.release()
+
+    def _run(self, label: str, conn, statement: Callable[[Any], None]) -> Optional[List[Dict[str, Any]]]:
+        start = time.perf_counter()
+        error = False
+        try:
+            with conn.cursor(cursor_factory=psycopg2.extras.DictCursor) as cursor:
+                statement(cursor)
+                # Only statements that return rows have a description
+                result = cursor.fetchall() if cursor.description is not None else None
+            conn.commit()
+            return [dict(row) for row in result] if result is not None else None
         except (Exception, psycopg2.DatabaseError) as e:
-            print(f"Error: {str(e)}\nIn query: {query}")
+            error = True
+            if not conn.closed:
+                conn.rollback()
+            print(f"Error: {str(e)}\nIn query: {label}")
             raise e
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._stats_lock:
+                self._queries.setdefault(label, QueryStats()).add(elapsed, error)
+
+    def execute(self, query, *args):
+        with self.connection() as conn:
+            return self._run(" ".join(query.split())[:80], conn, lambda cursor: cursor.execute(query, args))
+
+    def execute_prepared(self, name: str, *args):
+        """Run one of the PREPARED statements, preparing it on the checked out connection if needed"""
+        with self.connection() as conn:
+            if name not in conn.prepared:
+                prepare = f"PREPARE {name} AS {self.PREPARED[name]}"
+                self._run(f"PREPARE {name}", conn, lambda cursor: cursor.execute(prepare))
+                conn.prepared.add(name)
+            if args:
+                query = f"EXECUTE {name} ({', '.join(['%s'] * len(args))})"
+            else:
+                query = f"EXECUTE {name}"
+            return self._run(name, conn, lambda cursor: cursor.execute(query, args))
+
+    def stats(self) -> Dict[str, Any]:
+        """Pool usage, checkout waits and per query latency since the pool was created"""
+        with self._stats_lock:
+            return {
+                "pool_size": self.max_connections,
+                "in_use": self._in_use,
+                "checkouts": self._checkouts,
+                "checkout_waits": self._checkout_waits,
+                "checkout_wait_avg_ms": (
+                    self._checkout_wait_total / self._checkouts * 1000 if self._checkouts else 0.0
+                ),
+                "checkout_wait_max_ms": self._checkout_wait_max * 1000,
+                "queries": {label: query.as_dict() for label, query in self._queries.items()},
+            }
 
     def get_custom_entity_types(self) -> List[Dict[str, Any]]:
         return self.execute("SELECT id, name, detection_type FROM custom_entity_types")
@@ -56,40 +252,69 @@ class Database:
         )
 
     def get_rules_network(self, origin_ip: str) -> List[Dict[str, Any]]:
-        return self.execute(
-            """SELECT r.id, r.codigo, cet.name as entity, r.confidence_level, r.hits_lower, r.hits_upper, r.action, r.level
-            FROM rules r
-            INNER JOIN custom_entity_types cet ON r.entity_id = cet.id
-            INNER JOIN groups_rules gr ON gr.rule_id = r.id
-            INNER JOIN networks n ON n.id = gr.network_id
-            WHERE r.status = true AND %s <<= n.subnet::inet""",
-            origin_ip,
-        )
+        return self.execute_prepared("get_rules_network", origin_ip)
 
-    def get_last_update_time(self) -> float:
+    def get_config_snapshot(self) -> Dict[str, Any]:
+        """
+        Custom entity types (with their patterns, deny list and context words)
+        and active rules per subnet, read in a single query and transaction
+        """
         result = self.execute(
-            """SELECT GREATEST(
-                MAX(updated_at),
-                MAX(created_at)
-            ) as last_update
-            FROM (
-                SELECT updated_at, created_at FROM custom_entity_types
-                UNION ALL
-                SELECT updated_at, created_at FROM rules
-            ) as updates"""
+            """SELECT json_build_object(
+                'entity_types', COALESCE((
+                    SELECT json_agg(json_build_object(
+                        'id', cet.id,
+                        'name', cet.name,
+                        'detection_type', cet.detection_type,
+                        'patterns', COALESCE((
+                            SELECT json_agg(json_build_object('name', p.name, 'regex', p.regex, 'score', p.score)
+                                ORDER BY p.name, p.regex)
+                            FROM custom_patterns p WHERE p.entity_type_id = cet.id
+                        ), '[]'),
+                        'deny_list', COALESCE((
+                            SELECT json_agg(d.value ORDER BY d.value)
+                            FROM custom_deny_list d WHERE d.entity_type_id = cet.id
+                        ), '[]'),
+                        'context_words', COALESCE((
+                            SELECT json_agg(w.word ORDER BY w.word)
+                            FROM custom_context_words w WHERE w.entity_type_id = cet.id
+                        ), '[]')
+                    ) ORDER BY cet.id)
+                    FROM custom_entity_types cet
+                ), '[]'),
+                'rules', COALESCE((
+                    SELECT json_agg(json_build_object(
+                        'id', r.id,
+                        'codigo', r.codigo,
+                        'entity', cet.name,
+                        'confidence_level', r.confidence_level,
+                        'hits_lower', r.hits_lower,
+                        'hits_upper', r.hits_upper,
+                        'action', r.action,
+                        'level', r.level,
+                        'subnet', n.subnet::inet::text
+                    ) ORDER BY r.id, n.subnet::inet::text)
+                    FROM rules r
+                    INNER JOIN custom_entity_types cet ON r.entity_id = cet.id
+                    INNER JOIN groups_rules gr ON gr.rule_id = r.id
+                    INNER JOIN networks n ON n.id = gr.network_id
+                    WHERE r.status = true
+                ), '[]')
+            ) as snapshot"""
         )
+        return result[0]["snapshot"]
+
+    def get_last_update_time(self) -> float:
+        result = self.execute_prepared("get_last_update_time")
         return result[0]["last_update"].timestamp() if result and result[0]["last_update"] else 0
 
-    def save_history(self, history_entry):
-        query = """
-            INSERT INTO history (origin, destination, sensitive_data, results, level, action, text, text_redacted, file, metadata)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-        """
+    @staticmethod
+    def _history_values(history_entry) -> tuple:
         metadata = history_entry.metadata or {}
         if history_entry.file_name:
             metadata["file_name"] = history_entry.file_name
 
-        values = (
+        return (
             history_entry.origin,
             history_entry.destination,
             history_entry.sensitive_data,
@@ -101,11 +326,25 @@ class Database:
             history_entry.file,
             json.dumps(metadata) if metadata else None,
         )
-        self.execute(query, *values)
+
+    def save_history(self, history_entry):
+        self.execute_prepared("save_history", *self._history_values(history_entry))
+
+    def save_history_batch(self, history_entries: Sequence["HistoryEntry"]):
+        """Insert many history entries with one multi-row INSERT and a single commit"""
+        query = f"INSERT INTO history ({self.HISTORY_COLUMNS}) VALUES %s"
+        rows = [self._history_values(entry) for entry in history_entries]
+        with self.connection() as conn:
+            self._run(
+                "save_history_batch",
+                conn,
+                lambda cursor: psycopg2.extras.execute_values(cursor, query, rows, page_size=len(rows)),
+            )
 
     def close(self):
-        if self.conn is not None:
-            self.conn.close()
+        if self.pool is not None:
+            self.pool.closeall()
+            self.pool = None
 
 
 class HistoryEntry:
@@ -137,3 +376,227 @@ class HistoryEntry:
 
     def insert(self, db: Database):
         db.save_history(self)
+
+
+class HistoryWriter:
+    """
+    Writes HistoryEntry rows from a background thread.
+
+    The request path only calls put(), which enqueues the entry on a bounded
+    queue. The writer thread flushes the queue in batches through
+    Database.save_history_batch, as soon as batch_size entries are waiting
+    or flush_interval seconds after the first entry of a batch arrived.
+
+    When the database can't keep up and the queue is full, put() waits up
+    to put_timeout seconds and then drops the entry, so requests are never
+    held up for long by history. Dropped and failed entries are counted in
+    stats().
+
+    close() (also registered with atexit) flushes everything queued so far
+    and stops the thread.
+    """
+
+    _STOP = object()
+
+    def __init__(
+        self,
+        db: Database,
+        queue_size: int = 10000,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        put_timeout: float = 0.05,
+    ):
+        self.db = db
+        self.queue: "queue.Queue[Any]" = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.put_timeout = put_timeout
+        self.written = 0
+        self.failed = 0
+        self.dropped = 0
+        self.batches = 0
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+        atexit.register(self.close)
+
+    def put(self, history_entry: "HistoryEntry") -> bool:
+        try:
+            self.queue.put(history_entry, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            # Don't flood the output while the database is down
+            if dropped % 100 == 1:
+                print(f"History queue full, {dropped} entries dropped so far")
+            return False
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            entry = self.queue.get()
+            if entry is self._STOP:
+                break
+
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if entry is self._STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            self._flush(batch)
+
+    def _flush(self, batch: List["HistoryEntry"]):
+        try:
+            self.db.save_history_batch(batch)
+            with self._lock:
+                self.written += len(batch)
+                self.batches += 1
+        except Exception as e:
+            with self._lock:
+                self.failed += len(batch)
+            print(f"No se ha podido insertar el historial ({len(batch)} entradas): {e}")
+
+    def close(self, timeout: float = 10.0):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        atexit.unregister(self.close)
+        # Everything queued before the marker is flushed first
+        self.queue.put(self._STOP)
+        thread.join(timeout)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "queued": self.queue.qsize(),
+                "written": self.written,
+                "batches": self.batches,
+                "failed": self.failed,
+                "dropped": self.dropped,
+            }
+
+
+class ConfigListener:
+    """
+    Listens for configuration change notifications (see sql/config_notify.sql).
+
+    A background thread keeps a dedicated autocommit connection, outside the
+    pool, subscribed with LISTEN to channel. Notifications arriving within
+    debounce seconds of each other are decoded and handed to on_change as
+    one list of payload dicts.
+
+    Every time the connection is (re)established on_change is called with
+    None, meaning "anything may have changed": changes made before LISTEN
+    took effect were not notified. A lost connection is retried every
+    reconnect_delay seconds. `connected` tells whether notifications are
+    currently being received.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        on_change: Callable[[Optional[List[Dict[str, Any]]]], None],
+        channel: str = "dlp_config",
+        debounce: float = 0.05,
+        reconnect_delay: float = 5.0,
+    ):
+        self.db = db
+        self.on_change = on_change
+        self.channel = channel
+        self.debounce = debounce
+        self.reconnect_delay = reconnect_delay
+        self.connected = False
+        self.notifications = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="config-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _connect(self):
+        conn = psycopg2.connect(
+            host=self.db.host, database=self.db.database, user=self.db.user, password=self.db.password
+        )
+        conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+        with conn.cursor() as cursor:
+            cursor.execute(f"LISTEN {self.channel}")
+        return conn
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                conn = self._connect()
+            except psycopg2.Error as e:
+                print(f"Cannot listen for configuration changes: {e}")
+                self._stop.wait(self.reconnect_delay)
+                continue
+
+            self.connected = True
+            self._notify(None)
+            try:
+                self._listen(conn)
+            except psycopg2.Error as e:
+                print(f"Lost the configuration listener connection: {e}")
+            finally:
+                self.connected = False
+                conn.close()
+            self._stop.wait(self.reconnect_delay)
+
+    def _listen(self, conn):
+        while not self._stop.is_set():
+            # Wake up now and then to notice stop()
+            if select.select([conn], [], [], 1.0)[0] == []:
+                continue
+            conn.poll()
+            if not conn.notifies:
+                continue
+
+            # Changes usually come in bursts (one per row); wait for the
+            # rest of the burst and reload once
+            while select.select([conn], [], [], self.debounce)[0]:
+                conn.poll()
+
+            changes = []
+            for notify in conn.notifies:
+                try:
+                    changes.append(json.loads(notify.payload))
+                except ValueError:
+                    changes.append({"table": None, "payload": notify.payload})
+            conn.notifies.clear()
+            self.notifications += len(changes)
+            self._notify(changes)
+
+    def _notify(self, changes: Optional[List[Dict[str, Any]]]):
+        try:
+            self.on_change(changes)
+        except Exception as e:
+            print(f"Error applying configuration changes: {e}")
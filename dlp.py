@@ -1,35 +1,181 @@
 import json
+import logging
 import pprint
-import re
+import sys
 import threading
 import time
-from typing import Dict, Union
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, FrozenSet, Iterable, List, NamedTuple, Optional, Tuple, Union
 
-from presidio_analyzer import AnalyzerEngine, PatternRecognizer, RecognizerRegistry
-from presidio_analyzer.nlp_engine import NlpEngineProvider
+from presidio_analyzer import AnalyzerEngine, EntityRecognizer, Pattern, PatternRecognizer, RecognizerRegistry
+from presidio_analyzer.nlp_engine import NlpArtifacts, NlpEngineProvider
+from presidio_analyzer.predefined_recognizers import SpacyRecognizer
 from presidio_anonymizer import AnonymizerEngine
 from regex import R
 
-from db import Database, HistoryEntry
+from batching import NlpBatcher
+from cache import LRUCache, content_hash
+from cascade import DEFAULT_SMALL_CONF_FILE, load_small_engine, needs_large_model
+from config_snapshot import ConfigSnapshot
+from db import ConfigListener, Database, HistoryEntry, HistoryWriter
 from icapserver import AnalysisResult
+from prefilter import Prefilter
+from rule_index import RuleIndex
+from textspans import CleanText, Span, redact, replace_values
+from windowing import (
+    DEFAULT_SEGMENT_SIZE,
+    DEFAULT_WINDOW_OVERLAP,
+    DEFAULT_WINDOW_SIZE,
+    analyze_windowed,
+    coalesce_segments,
+    segment_windows,
+)
+
+
+class AnalysisPlan(NamedTuple):
+    # Some recognizer reads the spaCy output (NER or context words)
+    needs_nlp: bool
+    # Entities only a NER model finds (the ones the small model may miss)
+    ner_entities: FrozenSet[str]
+    # Rules out texts where none of the recognizers can find anything
+    prefilter: Prefilter
+
+
+class ActiveConfig(NamedTuple):
+    snapshot: ConfigSnapshot
+    # Built from snapshot's entity types and rules
+    analyzer: AnalyzerEngine
 
 
 class DLP:
-    def __init__(self, db: Database) -> None:
+    def __init__(
+        self,
+        db: Database,
+        start_background: bool = True,
+        snapshot_path: str = "config-snapshot.json",
+        small_nlp_conf_file: str = DEFAULT_SMALL_CONF_FILE,
+    ) -> None:
         self.db = db
-        self.analyzer = self._initialize_analyzer()
+        self.snapshot_path = snapshot_path
+        snapshot = self._initial_snapshot()
+        # Loaded once: reloads only rebuild the custom recognizers around it
+        self.nlp_engine = NlpEngineProvider(conf_file="./languages-config.yml").create_engine()
+        # Concurrent requests share spaCy calls (nlp.pipe batches)
+        self.nlp_batcher = NlpBatcher(self.nlp_engine)
+        # Cascaded NER: texts go through the small model first and only the
+        # ones it is unsure about through the large one
+        small_nlp_engine = load_small_engine(small_nlp_conf_file)
+        self.small_nlp_batcher = NlpBatcher(small_nlp_engine) if small_nlp_engine is not None else None
+        self.ner_texts = 0
+        self.ner_escalations = 0
+        # The counters are updated from the window threads
+        self._ner_lock = threading.Lock()
+        # Texts longer than window_size are analyzed in overlapping windows,
+        # in parallel (their spaCy calls end up in the same batch)
+        self.window_size = DEFAULT_WINDOW_SIZE
+        self.window_overlap = DEFAULT_WINDOW_OVERLAP
+        self.window_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="dlp-window")
+        # analyze_segments reads segments in pieces of at least segment_size characters
+        self.segment_size = DEFAULT_SEGMENT_SIZE
+        self.custom_recognizers: Dict[int, Tuple[tuple, PatternRecognizer]] = {}
+        # Stand-in for the spaCy output when no recognizer needs it
+        self.empty_nlp_artifacts = NlpArtifacts(
+            entities=[], tokens=[], tokens_indices=[], lemmas=[], nlp_engine=None, language="es"
+        )
+        self._plans: "weakref.WeakKeyDictionary[AnalyzerEngine, Dict[FrozenSet[str], AnalysisPlan]]" = (
+            weakref.WeakKeyDictionary()
+        )
+        self._plans_lock = threading.Lock()
+        # Text extracted from documents by the ICAP server, by document hash
+        self.text_cache: LRUCache[str] = LRUCache("extracted_text")
+        # Analyzer results by (config version, entities looked for, text hash)
+        self.results_cache: LRUCache[list] = LRUCache(
+            "analysis_results", sizeof=lambda results: sys.getsizeof(results) + 256 * len(results)
+        )
+        # Published as one attribute: a request reads the snapshot version
+        # and the analyzer built from it together
+        self.active = ActiveConfig(snapshot, self._initialize_analyzer(snapshot))
+        self.rule_index = self._build_rule_index()
         self.anonymizer = AnonymizerEngine()
-        self.last_update_time = time.time()
-        self.update_interval = 60  # Check for updates every 60 seconds
+        self.history = HistoryWriter(db)
+        self.config_listener = ConfigListener(db, self.apply_config_changes)
+        self._reload_lock = threading.Lock()
+        self.update_interval = 60  # Poll for updates every 60 seconds while not listening
+        # Threads don't survive fork(): pre-fork workers pass False here and
+        # call start_background_tasks() once they are running.
+        if start_background:
+            self.start_background_tasks()
+
+    def start_background_tasks(self):
+        self.history.start()
+        self.nlp_batcher.start()
+        if self.small_nlp_batcher is not None:
+            self.small_nlp_batcher.start()
+        # Reconciles the snapshot with the database as soon as it connects
+        self.config_listener.start()
         self._start_update_thread()
 
-    def _initialize_analyzer(self):
-        analyzer = AnalyzerEngine(
-            nlp_engine=NlpEngineProvider(conf_file="./languages-config.yml").create_engine(),
-            supported_languages=["es"],
+    def close(self):
+        self.config_listener.stop()
+        self.window_executor.shutdown(wait=False)
+        self.nlp_batcher.stop()
+        if self.small_nlp_batcher is not None:
+            self.small_nlp_batcher.stop()
+        # Flushes the history entries still queued
+        self.history.close()
+
+    def _initial_snapshot(self) -> ConfigSnapshot:
+        # The last good snapshot lets the server start without waiting for
+        # (or even reaching) the database; it is reconciled in the background
+        snapshot = ConfigSnapshot.load(self.snapshot_path)
+        if snapshot is not None:
+            print(f"Loaded config snapshot {snapshot.version} from {self.snapshot_path}")
+            return snapshot
+
+        snapshot = ConfigSnapshot.from_database(self.db)
+        self._save_snapshot(snapshot)
+        return snapshot
+
+    def _save_snapshot(self, snapshot: ConfigSnapshot):
+        try:
+            snapshot.save(self.snapshot_path)
+        except OSError as e:
+            print(f"Cannot save config snapshot to {self.snapshot_path}: {e}")
+
+    @property
+    def snapshot(self) -> ConfigSnapshot:
+        return self.active.snapshot
+
+    @property
+    def analyzer(self) -> AnalyzerEngine:
+        return self.active.analyzer
+
+    def _initialize_analyzer(self, snapshot: ConfigSnapshot) -> AnalyzerEngine:
+        # Built-in recognizers, reused as they are by every later reload
+        self.predefined_recognizers = list(
+            AnalyzerEngine(nlp_engine=self.nlp_engine, supported_languages=["es"]).registry.recognizers
         )
-
-        custom_entity_types = self.db.get_custom_entity_types()
+        self.active_recognizers = self._active_recognizers(snapshot)
+        return self._build_analyzer(self.active_recognizers)
+
+    def _build_analyzer(self, recognizers: List[EntityRecognizer]) -> AnalyzerEngine:
+        registry = RecognizerRegistry(recognizers=recognizers)
+        return AnalyzerEngine(registry=registry, nlp_engine=self.nlp_engine, supported_languages=["es"])
+
+    def _active_recognizers(self, snapshot: ConfigSnapshot) -> List[EntityRecognizer]:
+        """Built-in and custom recognizers for the entities at least one active rule looks for"""
+        recognizers = self.predefined_recognizers + self._load_custom_recognizers(snapshot.entity_types)
+        rule_entities = {rule["entity"] for rule in snapshot.rules}
+        return [recognizer for recognizer in recognizers if rule_entities.intersection(recognizer.supported_entities)]
+
+    def _load_custom_recognizers(self, custom_entity_types: List[Dict[str, Any]]) -> List[PatternRecognizer]:
+        """
+        Custom recognizers for custom_entity_types, updating self.custom_recognizers.
+
+        Recognizers of entity types whose definition didn't change are reused.
+        """
+        custom_recognizers = {}
         for entity_type in custom_entity_types:
 
             if entity_type["detection_type"] == "Native":
@@ -38,9 +184,20 @@ class DLP:
             entity_type_id = entity_type["id"]
             entity_type_name = entity_type["name"]
 
-            patterns = self.db.get_custom_patterns(entity_type_id)
-            deny_list = self.db.get_custom_deny_list(entity_type_id)
-            context_words = self.db.get_custom_context_words(entity_type_id)
+            patterns = [Pattern(name=p["name"], regex=p["regex"], score=p["score"]) for p in entity_type["patterns"]]
+            deny_list = entity_type["deny_list"]
+            context_words = entity_type["context_words"]
+
+            fingerprint = (
+                entity_type_name,
+                tuple((p.name, p.regex, p.score) for p in patterns),
+                tuple(deny_list),
+                tuple(context_words),
+            )
+            previous = self.custom_recognizers.get(entity_type_id)
+            if previous is not None and previous[0] == fingerprint:
+                custom_recognizers[entity_type_id] = previous
+                continue
 
             recognizer = PatternRecognizer(
                 supported_entity=entity_type_name,
@@ -49,28 +206,184 @@ class DLP:
                 context=context_words,
                 supported_language="es",
             )
-
-            analyzer.registry.add_recognizer(recognizer)
-
-        return analyzer
+            custom_recognizers[entity_type_id] = (fingerprint, recognizer)
+
+        self.custom_recognizers = custom_recognizers
+        return [recognizer for _, recognizer in custom_recognizers.values()]
+
+    def reload_recognizers(self, snapshot: ConfigSnapshot) -> AnalyzerEngine:
+        """
+        The analyzer for snapshot: the recognizers of changed custom entity types are rebuilt, the NLP engine kept.
+
+        The current analyzer is returned when no recognizer changed. The
+        caller swaps it in together with snapshot (see reconcile): requests
+        already running keep the analyzer they started with.
+        """
+        previous = self.active_recognizers
+        recognizers = self._active_recognizers(snapshot)
+        if len(recognizers) == len(previous) and all(a is b for a, b in zip(recognizers, previous)):
+            return self.analyzer
+
+        self.active_recognizers = recognizers
+        return self._build_analyzer(recognizers)
+
+    def analysis_plan(self, analyzer: AnalyzerEngine, entities: FrozenSet[str]) -> AnalysisPlan:
+        """
+        How to look for entities with analyzer, worked out once per entity set.
+
+        Only NER based recognizers and context words (matched against the
+        lemmas) use the NLP artifacts; regex and deny list matching doesn't.
+        """
+        with self._plans_lock:
+            plan = self._plans.setdefault(analyzer, {}).get(entities)
+        if plan is not None:
+            return plan
+
+        recognizers = analyzer.registry.get_recognizers(language="es", entities=list(entities))
+        needs_nlp = any(
+            isinstance(recognizer, SpacyRecognizer) or getattr(recognizer, "context", None)
+            for recognizer in recognizers
+        )
+        ner_entities = frozenset(
+            entity
+            for recognizer in recognizers
+            if isinstance(recognizer, SpacyRecognizer)
+            for entity in recognizer.supported_entities
+            if entity in entities
+        )
+        plan = AnalysisPlan(needs_nlp, ner_entities, Prefilter(recognizers))
+        with self._plans_lock:
+            self._plans.setdefault(analyzer, {})[entities] = plan
+        return plan
+
+    def _build_rule_index(self) -> RuleIndex:
+        return RuleIndex(self.snapshot.rules)
+
+    def refresh_rule_index(self):
+        # Built aside and swapped in one assignment: lookups in flight keep
+        # using the old index
+        self.rule_index = self._build_rule_index()
+
+    def has_rules(self, origin_ip: str) -> bool:
+        return bool(self.rule_index.lookup(origin_ip))
+
+    def reconcile(self) -> bool:
+        """
+        Bring the configuration in line with the database.
+
+        Reads a fresh snapshot in one query and only rebuilds the parts
+        (recognizers, rule index) whose contents changed. Returns whether
+        anything changed.
+        """
+        snapshot = ConfigSnapshot.from_database(self.db)
+        with self._reload_lock:
+            current = self.snapshot
+            if snapshot.version == current.version:
+                return False
+
+            # Rules decide which recognizers are active as well
+            self.active = ActiveConfig(snapshot, self.reload_recognizers(snapshot))
+            # Keys carry the version, this only frees the memory sooner
+            self.results_cache.clear()
+            if snapshot.rules_version != current.rules_version:
+                self.refresh_rule_index()
+            self._save_snapshot(snapshot)
+
+        print(f"Configuration updated to snapshot {snapshot.version}")
+        return True
+
+    def apply_config_changes(self, changes: Optional[List[Dict[str, Any]]]):
+        """
+        Called by the config listener with the decoded notification payloads,
+        or None when anything may have changed.
+        """
+        if changes is not None:
+            tables = sorted({str(change.get("table")) for change in changes})
+            print(f"Configuration changed in {', '.join(tables)}")
+        self.reconcile()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "config_version": self.snapshot.version,
+            "text_cache": self.text_cache.stats(),
+            "results_cache": self.results_cache.stats(),
+            "nlp_batches": self.nlp_batcher.stats(),
+            "ner_cascade": {"texts": self.ner_texts, "escalations": self.ner_escalations},
+            "rule_index": self.rule_index.stats(),
+            "history": self.history.stats(),
+            "database": self.db.stats(),
+        }
 
     def _start_update_thread(self):
         def update_checker():
             while True:
                 time.sleep(self.update_interval)
-                if self._check_for_updates():
-                    self.analyzer = self._initialize_analyzer()
+                logging.info(f"DLP stats: {self.stats()}")
+                # Notifications already keep the configuration up to date
+                if self.config_listener.connected:
+                    continue
+                try:
+                    self.reconcile()
+                except Exception as e:
+                    print(f"Cannot check for configuration updates: {e}")
 
         thread = threading.Thread(target=update_checker, daemon=True)
         thread.start()
 
-    def _check_for_updates(self) -> bool:
-        current_time = time.time()
-        last_db_update = self.db.get_last_update_time()
-        if last_db_update > self.last_update_time:
-            self.last_update_time = current_time
-            return True
-        return False
+    def _text_analyzer(self, rules: List[Dict[str, Any]]) -> Callable[[str], list]:
+        """
+        Analyzer results for a cleaned text, with the entities of rules.
+
+        Texts no recognizer can match are skipped, long ones are analyzed in
+        windows and results are cached by configuration version and text.
+        """
+        entities = [rule["entity"] for rule in rules]
+        # Read once: a reload swaps both at the same time
+        snapshot, analyzer = self.active
+        version = snapshot.version
+        entity_set = frozenset(entities)
+        plan = self.analysis_plan(analyzer, entity_set)
+
+        def analyze_window(window_text: str) -> list:
+            # Regex and deny list only entities don't need the spaCy pipeline at
+            # all; otherwise it runs batched with other requests, then this
+            # request's own entities are looked for
+            if not plan.needs_nlp:
+                nlp_artifacts = self.empty_nlp_artifacts
+            elif self.small_nlp_batcher is None:
+                nlp_artifacts = self.nlp_batcher.process(window_text)
+            else:
+                nlp_artifacts = self.small_nlp_batcher.process(window_text)
+                results = analyzer.analyze(
+                    text=window_text, language="es", entities=entities, nlp_artifacts=nlp_artifacts
+                )
+                # Context words only need the lemmas, which the small model gets right
+                if not plan.ner_entities:
+                    return results
+                escalate = needs_large_model(nlp_artifacts)
+                with self._ner_lock:
+                    self.ner_texts += 1
+                    if escalate:
+                        self.ner_escalations += 1
+                if not escalate:
+                    return results
+                nlp_artifacts = self.nlp_batcher.process(window_text)
+            return analyzer.analyze(text=window_text, language="es", entities=entities, nlp_artifacts=nlp_artifacts)
+
+        def analyze(text_cleared: str) -> list:
+            if not plan.prefilter.may_match(text_cleared):
+                return []
+
+            def compute() -> list:
+                # Big documents would hit spaCy's max_length and take one long pass
+                return analyze_windowed(
+                    analyze_window, text_cleared, self.window_size, self.window_overlap, self.window_executor
+                )
+
+            # Identical texts sent concurrently are analyzed once
+            return self.results_cache.get_or_compute((version, entity_set, content_hash(text_cleared)), compute)
+
+        return analyze
 
     def analyze_network(
         self,
@@ -80,51 +393,119 @@ class DLP:
         file_name: str = None,
         metadata: str = None,
     ) -> AnalysisResult:
-        rules = self.db.get_rules_network(origin_ip)
-        entities = [rule["entity"] for rule in rules]
-
-        def clear_text(text: str) -> str:
-            text = re.sub(r"\s+", " ", text)
-            return text.strip()
-
-        text_cleared = clear_text(text)
-
-        results = self.analyzer.analyze(text=text_cleared, language="es", entities=entities)
+        rules = self.rule_index.lookup(origin_ip)
+        if not rules:
+            # Nothing to look for (Presidio would take an empty list as "every entity")
+            return AnalysisResult({}, False, "No rules matched")
 
-        rules_matched = []
-        entity_dict = {}
-        action = Action.NOTHING
-        level = Level.NOTHING
+        # Analyzed with whitespace runs collapsed; offsets are mapped back to
+        # text for redaction
+        clean_text = CleanText(text)
+        results = self._text_analyzer(rules)(clean_text.text)
+        if not results:
+            return AnalysisResult({}, False, "No rules matched")
 
         for result in results:
             pprint.pprint(
-                f"Type: {result.entity_type}, Value: {text_cleared[result.start : result.end]}, Confidence: {result.score:.2f}"
+                f"Type: {result.entity_type}, Value: {clean_text.text[result.start : result.end]}, Confidence: {result.score:.2f}"
             )
 
-        for rule in rules:
-            result_matched = []
-            for result in results:
-                if rule["entity"] == result.entity_type and rule["confidence_level"] <= result.score:
-                    data = text_cleared[result.start : result.end]
-                    result_matched.append({**result.to_dict(), "data": data})
-                    action = Action.priority(rule["action"], action)
-                    level = Level.priority(rule["level"], level)
+        evaluator = RuleEvaluator(rules)
+        evaluator.add(results, clean_text)
+        return self._verdict(evaluator, text, origin_ip, destination_ip, file_name, metadata, len(text))
+
+    def analyze_segments(
+        self,
+        segments: Iterable[str],
+        origin_ip: str = "127.0.0.1",
+        destination_ip: str = "127.0.0.1",
+        file_name: str = None,
+        metadata: str = None,
+        separator: str = "\n",
+    ) -> AnalysisResult:
+        """
+        analyze_network for a text that arrives in segments (paragraphs, batches of PDF pages) joined by separator.
+
+        Segments are read in pieces of at least segment_size characters.
+        Each piece is analyzed as soon as enough of the text after it is
+        known and its results are counted right away. Once a Block verdict
+        is final (see RuleEvaluator) the remaining segments are not read.
+        Otherwise the verdict and redactions are those of analyze_network
+        on the whole text. The result tells how many characters were
+        scanned and whether that was the whole text (scanned is None when
+        the origin has no rules and nothing was read).
+        """
+        rules = self.rule_index.lookup(origin_ip)
+        if not rules:
+            # Nothing to look for: the segments are not read
+            return AnalysisResult({}, False, "No rules matched")
+
+        if not any(RuleEvaluator.decisive(rule) for rule in rules):
+            # Nothing can end the scan early: the whole text in one go, in
+            # parallel windows when it is long
+            text = separator.join(segments)
+            result = self.analyze_network(text, origin_ip, destination_ip, file_name, metadata)
+            result.scanned = len(text)
+            return result
+
+        analyze = self._text_analyzer(rules)
+        evaluator = RuleEvaluator(rules)
+        scanned = []
+        complete = True
+        pieces = coalesce_segments(segments, self.segment_size, separator)
+        for window in segment_windows(pieces, self.window_overlap, separator):
+            scanned.append(window.segment)
+            clean_text = CleanText(window.text)
+            results = [
+                result
+                for result in analyze(clean_text.text)
+                if window.own_start <= clean_text.to_original(result.start, result.end)[0] < window.own_end
+            ]
+            evaluator.add(results, clean_text, window.offset)
+            if evaluator.final:
+                complete = window.last
+                break
+
+        text = separator.join(scanned)
+        if not complete:
+            logging.info(f"Block verdict final after {len(text)} characters, not reading the rest")
+        return self._verdict(evaluator, text, origin_ip, destination_ip, file_name, metadata, len(text), complete)
+
+    def _verdict(
+        self,
+        evaluator: "RuleEvaluator",
+        text: str,
+        origin_ip: str,
+        destination_ip: str,
+        file_name: Optional[str],
+        metadata: Optional[str],
+        scanned: int,
+        complete: bool = True,
+    ) -> AnalysisResult:
+        action, level = evaluator.outcome()
+        if action == Action.NOTHING or level == Level.NOTHING:
+            return AnalysisResult({}, False, "No rules matched", scanned=scanned, complete=complete)
 
-            if len(result_matched) >= rule["hits_lower"] and len(result_matched) <= rule["hits_upper"]:
-                for result in result_matched:
-                    if rule["action"] == Action.REDACT:
-                        entity_dict[result["data"]] = result["entity_type"]
-                rules_matched.append({"matches": result_matched, "rule": rule})
+        rules_matched = []
+        entity_dict = {}
+        spans: List[Span] = []
+        for rule, matches in evaluator.applying():
+            if rule["action"] == Action.REDACT:
+                for match in matches:
+                    entity_type = match.result["entity_type"]
+                    entity_dict[match.result["data"]] = entity_type
+                    spans.append(match.span(entity_type))
+            rules_matched.append({"matches": [match.result for match in matches], "rule": rule})
 
-        redacted_text = self.anonymize(text=text, results=entity_dict)
+        redacted_text = self.anonymize(text=text, results=spans)
 
         is_file = bool(file_name)
         metadata_dict = json.loads(metadata) if metadata else {}
         if file_name:
             metadata_dict["file_name"] = file_name
-
-        if action == Action.NOTHING or level == Level.NOTHING:
-            return AnalysisResult({}, False, "No rules matched")
+        # How much of the content the verdict is based on
+        metadata_dict["scanned"] = scanned
+        metadata_dict["complete"] = complete
 
         history = HistoryEntry(
             origin=origin_ip,
@@ -139,27 +520,103 @@ class DLP:
             metadata=metadata_dict,
         )
 
-        try:
-            history.insert(db=self.db)
-        except Exception as e:
-            print(f"No se ha podido insertar el historial: {e}")
+        # Written in batches by the history thread, off the request path
+        self.history.put(history)
 
-        return AnalysisResult(entity_dict, action == Action.BLOCK, "Content blocked due to policy violation")
+        return AnalysisResult(
+            entity_dict, action == Action.BLOCK, "Content blocked due to policy violation", spans, scanned, complete
+        )
 
-    def anonymize(self, text: str, results: Union[list, Dict[str, str]]) -> str:
+    def anonymize(self, text: str, results: Union[List[Span], Dict[str, str], list]) -> str:
         if isinstance(results, dict):
-            for word, redaction in results.items():
-                text = text.replace(word, redaction)
-            return text
+            return replace_values(text, results)
+        if all(isinstance(result, Span) for result in results):
+            return redact(text, results)
 
         return self.anonymizer.anonymize(text=text, analyzer_results=results).text
 
 
 class AnalysisResult:
-    def __init__(self, censor_dict: Dict[str, str], block: bool, block_message: str):
+    def __init__(
+        self,
+        censor_dict: Dict[str, str],
+        block: bool,
+        block_message: str,
+        spans: List[Span] = None,
+        scanned: Optional[int] = None,
+        complete: bool = True,
+    ):
         self.censor_dict = censor_dict
         self.block = block
         self.block_message = block_message
+        # Redactions as offsets in the analyzed text
+        self.spans = spans or []
+        # Characters analyzed (None when not counted, e.g. the origin has no
+        # rules), and whether that was all of the input or the analysis
+        # stopped early on a Block
+        self.scanned = scanned
+        self.complete = complete
+
+
+class RuleMatch(NamedTuple):
+    # RecognizerResult.to_dict() plus the matched "data", offsets in the cleaned text
+    result: Dict[str, Any]
+    clean_text: CleanText
+    # Offset in the whole text of the text clean_text was made from
+    offset: int
+
+    def span(self, replacement: str) -> Span:
+        start, end = self.clean_text.to_original(self.result["start"], self.result["end"])
+        return Span(start + self.offset, end + self.offset, replacement)
+
+
+class RuleEvaluator:
+    """
+    Hit counters of an origin's rules, fed with analyzer results as a text is scanned.
+
+    A result is a hit of every rule looking for its entity with a
+    confidence_level it reaches, and every hit raises the action and level
+    of the verdict to its rule's. The rules whose hits are within
+    [hits_lower, hits_upper] are the ones that redact and are recorded.
+
+    final turns True once the action is Block (and the level not Nothing):
+    more text can only add hits, which can't undo a Block.
+    """
+
+    def __init__(self, rules: List[Dict[str, Any]]):
+        self.rules = rules
+        self.matches: List[List[RuleMatch]] = [[] for _ in rules]
+        self.action = Action.NOTHING
+        self.level = Level.NOTHING
+        self.final = False
+
+    @staticmethod
+    def decisive(rule: Dict[str, Any]) -> bool:
+        """Whether a hit of the rule can make the verdict final"""
+        return rule["action"] == Action.BLOCK
+
+    @staticmethod
+    def applies(rule: Dict[str, Any], hits: int) -> bool:
+        return hits >= rule["hits_lower"] and hits <= rule["hits_upper"]
+
+    def add(self, results: list, clean_text: CleanText, offset: int = 0):
+        for rule, matches in zip(self.rules, self.matches):
+            for result in results:
+                if rule["entity"] == result.entity_type and rule["confidence_level"] <= result.score:
+                    data = clean_text.text[result.start : result.end]
+                    matches.append(RuleMatch({**result.to_dict(), "data": data}, clean_text, offset))
+                    self.action = Action.priority(rule["action"], self.action)
+                    self.level = Level.priority(rule["level"], self.level)
+
+        if self.action == Action.BLOCK and self.level != Level.NOTHING:
+            self.final = True
+
+    def applying(self) -> List[Tuple[Dict[str, Any], List[RuleMatch]]]:
+        return [(rule, matches) for rule, matches in zip(self.rules, self.matches) if self.applies(rule, len(matches))]
+
+    def outcome(self) -> Tuple[str, str]:
+        """Action and level of the verdict"""
+        return self.action, self.level
 
 
 class Action:
@@ -1,15 +1,58 @@
+import bisect
 import logging
+import multiprocessing
+import copy
+import os
+import re
+import struct
+import tempfile
+import threading
+import zipfile
 from abc import ABC, abstractmethod
 from ast import mod
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
-from typing import Dict
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
 
 import fitz  # PyMuPDF library
-from docx import Document
-
-# For extracting text
-from pdfminer.high_level import extract_pages, extract_text
-from pdfminer.layout import LTChar, LTTextContainer, LTTextLine
+from lxml import etree
+
+from bodybuffer import BufferReader
+from textspans import CleanText, Span, find_values, redact, replace_values
+
+
+def replace_stream(pieces: Iterable[str], censor_dict: Dict[str, str]) -> Iterator[str]:
+    """
+    Apply censor_dict to text arriving in pieces, yielding the redacted text.
+
+    Values split across pieces are still replaced: the text that could be
+    the start of a value is held back until the next piece arrives.
+    """
+    if not censor_dict:
+        yield from pieces
+        return
+
+    pattern = re.compile("|".join(re.escape(key) for key in sorted(censor_dict, key=len, reverse=True)))
+    hold = max(len(key) for key in censor_dict) - 1
+    pending = ""
+    for piece in pieces:
+        pending += piece
+        # Matches starting before safe are complete whatever comes next
+        safe = len(pending) - hold
+        out = []
+        pos = 0
+        for match in pattern.finditer(pending):
+            if match.start() >= safe:
+                break
+            out.append(pending[pos : match.start()])
+            out.append(censor_dict[match.group(0)])
+            pos = match.end()
+        cut = max(pos, safe)
+        out.append(pending[pos:cut])
+        pending = pending[cut:]
+        yield "".join(out)
+
+    yield pattern.sub(lambda match: censor_dict[match.group(0)], pending)
 
 
 class AnalysisResult:
@@ -23,142 +66,442 @@ class FileOperations(ABC):
         self.analyze_function = analyze_function
 
     @abstractmethod
-    def analyze_content(self, content, file_content) -> AnalysisResult:
+    def extract_text(self, content, file_content) -> str:
         pass
 
-    @abstractmethod
-    def modify_content(self, content, file_content, censor_dict: Dict[str, str]):
-        pass
-
-
-class TextOperations(FileOperations):
-    def analyze_content(self, content, file_content) -> AnalysisResult:
-        logging.info("Text analyzed:")
-        logging.info(content.decode("utf-8"))
-        return self.analyze_function(content.decode("utf-8"))
-
-    def modify_content(self, content, file_content, censor_dict: Dict[str, str]):
-        print(censor_dict)
-        modified_text = content.decode("utf-8")
-        for key in censor_dict.keys():
-            modified_text = modified_text.replace(key, censor_dict[key])
-        return modified_text.encode("utf-8")
-
-
-class DOCOperations(FileOperations):
-    def analyze_content(self, content, file_content) -> AnalysisResult:
-        # Create a BytesIO object from the file content
-        docx_buffer = BytesIO(file_content)
-
-        # Load the Word document
-        document = Document(docx_buffer)
-
-        text = ""
-        # Iterate over each paragraph
-        for paragraph in document.paragraphs:
-            # Extract the text from the paragraph
-            text += paragraph.text
+    def analyze_content(
+        self, content, file_content, extract_text: Optional[Callable[[], str]] = None
+    ) -> AnalysisResult:
+        """Analyze the text of the content; extract_text (e.g. a cached extraction) replaces self.extract_text"""
+        text = extract_text() if extract_text is not None else self.extract_text(content, file_content)
+        return self.analyze_text(text)
 
+    def analyze_text(self, text: str) -> AnalysisResult:
         logging.info("Text analyzed:")
         logging.info(text)
-
         # Analyze the text using the provided function
         return self.analyze_function(text)
 
-    def modify_content(self, content, file_content, censor_dict: Dict[str, str]):
-        # Create a BytesIO object from the file content
-        docx_buffer = BytesIO(file_content)
-
-        # Load the Word document
-        document = Document(docx_buffer)
-
-        # Iterate over each paragraph
-        for paragraph in document.paragraphs:
-            # Extract the text from the paragraph
-            text = paragraph.text
-            # Modify the text using the provided function
-            modified_text = text
-            for key in censor_dict.keys():
-                modified_text = modified_text.replace(key, censor_dict[key])
-
-            print("Original text: " + text + "\nModified text: " + modified_text)
-
-            # Replace the paragraph text with the modified text
-            paragraph.text = modified_text
+    @abstractmethod
+    def modify_content(self, content, file_content, censor_dict: Dict[str, str], spans: Optional[List[Span]] = None):
+        """
+        Redact the file and return it (FileHandler puts it back in the body).
+        spans, when given, are offsets in the text extract_text returned;
+        censor_dict values are searched for otherwise.
+        """
+        pass
 
-        # Create a BytesIO object to store the modified Word document
-        output_buffer = BytesIO()
-        document.save(output_buffer)
 
-        # Get the modified Word document content as bytes
-        modified_file_content = output_buffer.getvalue()
+class TextOperations(FileOperations):
+    def extract_text(self, content, file_content) -> str:
+        return str(content, "utf-8")
 
-        # Reconstruct the multipart/form-data with the modified file content
-        boundary = content.split(b"\r\n")[0]
-        modified_content = b""
-        for part in content.split(boundary)[:-1]:
-            if b'filename="' in part:
-                headers, _ = part.split(b"\r\n\r\n", 1)
-                modified_content += boundary + headers + b"\r\n\r\n" + modified_file_content + b"\r\n"
-            elif len(part) > 0:
-                modified_content += part
+    def modify_content(self, content, file_content, censor_dict: Dict[str, str], spans: Optional[List[Span]] = None):
+        text = str(content, "utf-8")
+        modified_text = redact(text, spans) if spans else replace_values(text, censor_dict)
+        return modified_text.encode("utf-8")
 
-        # Add the closing boundary to the modified content
-        modified_content += boundary + b"--\r\n"
-        return modified_content
 
+class DOCXRun(NamedTuple):
+    # Offsets of the text of a w:t element in ParsedDOCX.text
+    start: int
+    end: int
+    part: str
+    # Position of the element among the part's w:t elements, in document order
+    index: int
+
+
+def _w(tag: str) -> str:
+    return "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}" + tag
+
+
+W_P, W_R, W_T, W_TYPE = _w("p"), _w("r"), _w("t"), _w("type")
+# Run content other than w:t that python-docx also reads as text
+W_RUN_TEXT = {_w("tab"): "\t", _w("ptab"): "\t", _w("cr"): "\n", _w("noBreakHyphen"): "-"}
+W_BR = _w("br")
+XML_SPACE = "{http://www.w3.org/XML/1998/namespace}space"
+# Uploads are untrusted: their XML is parsed without expanding entities or reaching the network
+XML_PARSER_OPTIONS = dict(resolve_entities=False, no_network=True)
+# Parts of a Word document holding text, besides word/document.xml
+DOCX_TEXT_PART_RE = re.compile(r"word/(header\d*|footer\d*|footnotes|endnotes)\.xml")
+
+
+class ParsedDOCX:
+    """
+    The text of a Word document, read once straight from its XML parts.
+
+    The body (tables included), then the headers, footers, footnotes and
+    endnotes, one paragraph per line so words of consecutive paragraphs stay
+    apart. The parts are parsed incrementally and their elements freed as
+    they are read, so no object model of the document is built; runs keeps
+    where the text of every w:t element went, so offsets in the text can be
+    redacted in place run by run, keeping the formatting.
+    """
+
+    def __init__(self, file_content):
+        # The upload stays in the request body; zipfile reads the parts from it
+        self.file_content = file_content
+        pieces = []
+        self.runs: List[DOCXRun] = []
+        with zipfile.ZipFile(BufferReader(file_content)) as archive:
+            names = archive.namelist()
+            if "word/document.xml" not in names:
+                raise ValueError("Not a Word document: no word/document.xml")
+            self.parts = ["word/document.xml"] + sorted(name for name in names if DOCX_TEXT_PART_RE.fullmatch(name))
+            length = 0
+            for part in self.parts:
+                with archive.open(part) as xml:
+                    for paragraph in self._paragraphs(part, xml):
+                        if pieces:
+                            pieces.append("\n")
+                            length += 1
+                        for index, text in paragraph:
+                            if index is not None:
+                                self.runs.append(DOCXRun(length, length + len(text), part, index))
+                            pieces.append(text)
+                            length += len(text)
+        self.text = "".join(pieces)
+        self.runs.sort()
+        self._starts = [run.start for run in self.runs]
+
+    @staticmethod
+    def _paragraphs(part: str, xml) -> Iterator[List[Tuple[Optional[int], str]]]:
+        """Each paragraph of the part as (w:t index or None, text) pieces, in the order they end"""
+        # Paragraphs nest in text boxes: the inner ones end (and are yielded) first
+        stack: List[List[Tuple[Optional[int], str]]] = []
+        index = 0
+        for event, element in etree.iterparse(xml, events=("start", "end"), **XML_PARSER_OPTIONS):
+            if event == "start":
+                if element.tag == W_P:
+                    stack.append([])
+                continue
+
+            if element.tag == W_T:
+                if stack:
+                    stack[-1].append((index, element.text or ""))
+                index += 1
+            elif stack and element.getparent() is not None and element.getparent().tag == W_R:
+                if element.tag in W_RUN_TEXT:
+                    stack[-1].append((None, W_RUN_TEXT[element.tag]))
+                elif element.tag == W_BR and element.get(W_TYPE, "textWrapping") == "textWrapping":
+                    stack[-1].append((None, "\n"))
+            elif element.tag == W_P:
+                yield stack.pop()
+                if not stack:
+                    # Done with it: free it and the paragraphs read before it
+                    element.clear()
+                    while element.getprevious() is not None:
+                        del element.getparent()[0]
+
+    def _run_spans(self, spans: Iterable[Span]) -> Dict[str, Dict[int, List[Span]]]:
+        """The part of each span in each run it covers, by part and w:t index; the first run gets the replacement"""
+        edits: Dict[str, Dict[int, List[Span]]] = {}
+        for span in spans:
+            position = max(bisect.bisect_right(self._starts, span.start) - 1, 0)
+            replacement = span.replacement
+            while position < len(self.runs) and self.runs[position].start < span.end:
+                run = self.runs[position]
+                position += 1
+                if run.end <= span.start:
+                    continue
+                start = max(span.start, run.start) - run.start
+                end = min(span.end, run.end) - run.start
+                edits.setdefault(run.part, {}).setdefault(run.index, []).append(Span(start, end, replacement))
+                replacement = ""
+        return edits
+
+    def find_values(self, censor_dict: Dict[str, str]) -> List[Span]:
+        return find_values(self.text, censor_dict)
+
+    def redact(self, censor_dict: Dict[str, str], spans: Optional[List[Span]] = None) -> memoryview:
+        """
+        Rewrite the w:t elements with something to redact; returns the new document.
+
+        Only the parts with something to redact are decompressed, parsed
+        again and rewritten (with their original compression); every other
+        member of the archive is copied as it is stored, still compressed.
+        """
+        if not spans:
+            spans = self.find_values(censor_dict)
+        edits = self._run_spans(spans)
 
-class PDFOperations(FileOperations):
-    def analyze_content(self, content, file_content) -> AnalysisResult:
-        # Create a BytesIO object from the file content
-        pdf_buffer = BytesIO(file_content)
-        text = ""
-        for page_layout in extract_pages(pdf_buffer):
-            for text_container in page_layout:
-                if isinstance(text_container, LTTextContainer):
+        output_buffer = BytesIO()
+        with zipfile.ZipFile(BufferReader(self.file_content)) as archive, zipfile.ZipFile(
+            output_buffer, "w"
+        ) as output:
+            for info in archive.infolist():
+                if info.filename in edits:
+                    data = self._redact_part(archive.read(info), edits[info.filename])
+                    output.writestr(copy.copy(info), data)
+                else:
+                    _copy_zip_member(self.file_content, info, output)
+        return output_buffer.getbuffer()
+
+    @staticmethod
+    def _redact_part(data: bytes, edits: Dict[int, List[Span]]) -> bytes:
+        root = etree.fromstring(data, etree.XMLParser(**XML_PARSER_OPTIONS))
+        for index, element in enumerate(root.iter(W_T)):
+            if index in edits:
+                text = element.text or ""
+                modified_text = redact(text, edits[index])
+                element.text = modified_text
+                # Keep the spaces around the replacement
+                element.set(XML_SPACE, "preserve")
+        return etree.tostring(root, xml_declaration=True, encoding="UTF-8", standalone=True)
+
+
+def _copy_zip_member(source, info: zipfile.ZipInfo, output: zipfile.ZipFile):
+    """Append the member info of the archive in source (a buffer) to output without decompressing it"""
+    view = memoryview(source)
+    # The data follows the member's local header: 30 bytes, then its name and extra field
+    name_length, extra_length = struct.unpack("<HH", view[info.header_offset + 26 : info.header_offset + 30])
+    data_start = info.header_offset + 30 + name_length + extra_length
+    copied = copy.copy(info)
+    # Sizes and CRC go in the local header, so no data descriptor follows the data
+    copied.flag_bits &= ~0x08
+    copied.header_offset = output.fp.tell()
+    output.fp.write(copied.FileHeader())
+    output.fp.write(view[data_start : data_start + info.compress_size])
+    # What ZipFile.writestr records for the central directory written on close
+    output.filelist.append(copied)
+    output.NameToInfo[copied.filename] = copied
+    output.start_dir = output.fp.tell()
+    output._didModify = True
 
-                    # The element is a LTTextContainer, containing a paragraph of text.
-                    text += text_container.get_text()
 
+class DOCOperations(FileOperations):
+    def __init__(self, analyze_function) -> None:
+        super().__init__(analyze_function)
+        # Parsed on first use (when the upload is sniffed), then reused by
+        # extract_text and modify_content
+        self.parsed: Optional[ParsedDOCX] = None
+
+    def parse(self, file_content) -> ParsedDOCX:
+        if self.parsed is None:
+            self.parsed = ParsedDOCX(file_content)
+        return self.parsed
+
+    def extract_text(self, content, file_content) -> str:
+        return self.parse(file_content).text
+
+    def analyze_content(
+        self, content, file_content, extract_text: Optional[Callable[[], str]] = None
+    ) -> AnalysisResult:
+        text = extract_text() if extract_text is not None else self.extract_text(content, file_content)
         logging.info("Text analyzed:")
         logging.info(text)
-        # Analyze the text using the provided function
-        return self.analyze_function(text)
-
-    def modify_content(self, content, file_content, censor_dict: Dict[str, str]):
-        # Create a BytesIO object from the file content
-        pdf_buffer = BytesIO(file_content)
-        # Open the original PDF
-        pdf_file = fitz.open("pdf", pdf_buffer)
-
-        # Iterate through each page
-        for page_index in range(len(pdf_file)):
-            page = pdf_file[page_index]
-
-            for key in censor_dict.keys():
-                censor_instances = page.search_for(key)
-
-                for inst in censor_instances:
-                    area = inst.irect
-                    redact_area = fitz.Rect(area.x0, area.y0, area.x1, area.y1)
-                    page.add_redact_annot(redact_area, text=censor_dict[key], align=fitz.TEXT_ALIGN_CENTER)
-
+        # Paragraph by paragraph, so a Block verdict can end the analysis early
+        return self.analyze_function(text.split("\n"))
+
+    def modify_content(self, content, file_content, censor_dict: Dict[str, str], spans: Optional[List[Span]] = None):
+        # The parsed document is left as it is: only the output is rewritten
+        return self.parse(file_content).redact(censor_dict, spans)
+
+
+class PDFWord(NamedTuple):
+    start: int
+    end: int
+    page: int
+    rect: "fitz.Rect"
+
+
+def open_pdf(file_content) -> fitz.Document:
+    """PyMuPDF document reading file_content (bytes, memoryview or mmap) in place, without copying it"""
+    return fitz.open(stream=memoryview(file_content), filetype="pdf")
+
+
+class ParsedPDF:
+    """
+    A PDF opened once with PyMuPDF, with its text and where each word of that text is.
+
+    In the text the words of a line are separated by a space and lines by a
+    newline, in PyMuPDF's reading order. words maps every word back to its
+    page and rectangle, so offsets in the text can be redacted in place
+    without searching the pages again.
+    """
+
+    def __init__(self, file_content, pages: Optional[range] = None, document: Optional[fitz.Document] = None):
+        # document: file_content already opened, e.g. to count its pages
+        self.document = document if document is not None else open_pdf(file_content)
+        self.words: List[PDFWord] = []
+        pieces = []
+        length = 0
+        previous_line = None
+        for page_number in pages if pages is not None else range(len(self.document)):
+            page = self.document[page_number]
+            for x0, y0, x1, y1, word, block, line, _ in page.get_text("words"):
+                if previous_line is not None:
+                    pieces.append(" " if previous_line == (page_number, block, line) else "\n")
+                    length += 1
+                previous_line = (page_number, block, line)
+                pieces.append(word)
+                self.words.append(PDFWord(length, length + len(word), page_number, fitz.Rect(x0, y0, x1, y1)))
+                length += len(word)
+        self.text = "".join(pieces)
+        self._starts = [word.start for word in self.words]
+
+    def find_values(self, censor_dict: Dict[str, str]) -> List[Span]:
+        # Values come from whitespace-collapsed text and may run over a line break
+        clean_text = CleanText(self.text)
+        return [
+            Span(*clean_text.to_original(span.start, span.end), span.replacement)
+            for span in find_values(clean_text.text, censor_dict)
+        ]
+
+    def redact(self, spans: Iterable[Span]) -> bytes:
+        """Cover the characters of each span with a redaction showing its replacement; returns the new PDF"""
+        pages = {}
+        for span in spans:
+            index = max(bisect.bisect_right(self._starts, span.start) - 1, 0)
+            replacement = span.replacement
+            while index < len(self.words) and self.words[index].start < span.end:
+                word = self.words[index]
+                index += 1
+                if word.end <= span.start:
+                    continue
+                if word.page not in pages:
+                    pages[word.page] = self.document[word.page]
+                rect = self._rect(pages[word.page], word, max(span.start, word.start), min(span.end, word.end))
+                # The replacement goes on the first word of the span
+                pages[word.page].add_redact_annot(rect, text=replacement, align=fitz.TEXT_ALIGN_CENTER)
+                replacement = ""
+
+        # Only pages with something to redact are rewritten
+        for page in pages.values():
             page.apply_redactions()
+        return self.document.tobytes()
+
+    def _rect(self, page, word: PDFWord, start: int, end: int):
+        """Rectangle of the characters start:end (offsets in the text) of word"""
+        if start == word.start and end == word.end:
+            return word.rect
+        # Part of a word, as in "DNI:12345678": only the matched characters
+        # are covered, taken from the boxes of the word's characters
+        boxes = []
+        for block in page.get_text("rawdict", clip=word.rect)["blocks"]:
+            for line in block.get("lines", []):
+                for text_span in line["spans"]:
+                    for char in text_span["chars"]:
+                        box = fitz.Rect(char["bbox"])
+                        if not char["c"].isspace() and word.rect.contains((box.tl + box.br) / 2):
+                            boxes.append(box)
+        if len(boxes) != word.end - word.start:
+            # Characters that don't map one to one (e.g. ligatures): the whole word
+            return word.rect
+        rect = fitz.Rect(boxes[start - word.start])
+        for box in boxes[start - word.start + 1 : end - word.start]:
+            rect |= box
+        return rect
+
+    def close(self):
+        self.document.close()
+
+
+def _extract_page_batch(path: str, start: int, stop: int) -> str:
+    with open(path, "rb") as f:
+        parsed = ParsedPDF(f.read(), range(start, stop))
+    parsed.close()
+    return parsed.text
+
+
+class PageExtractor:
+    """
+    Extracts the text of big PDFs in batches of pages, in parallel on a pool of processes.
+
+    iter_text yields the text of each batch in page order, as ParsedPDF
+    would have it: joined with newlines, the batches make up the text of the
+    whole document. Closing the iterator early cancels the batches not yet
+    extracted. The pool is started on first use, in the process using it.
+    """
+
+    def __init__(self, processes: Optional[int] = None, pages_per_batch: int = 10, min_pages: int = 40):
+        self.processes = processes or min(4, os.cpu_count() or 1)
+        self.pages_per_batch = pages_per_batch
+        # Smaller documents are extracted in one go, in the calling process
+        self.min_pages = min_pages
+        self._lock = threading.Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pid: Optional[int] = None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes, mp_context=multiprocessing.get_context("spawn")
+                )
+                self._pid = os.getpid()
+            return self._executor
+
+    def iter_text(self, file_content, page_count: int) -> Iterator[str]:
+        # Workers read the document from a file rather than each getting a copy
+        fd, path = tempfile.mkstemp(suffix=".pdf")
+        futures = []
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(file_content)
+            executor = self._pool()
+            for start in range(0, page_count, self.pages_per_batch):
+                stop = min(start + self.pages_per_batch, page_count)
+                futures.append(executor.submit(_extract_page_batch, path, start, stop))
+            for future in futures:
+                text = future.result()
+                # Pages without words add nothing, not even a newline
+                if text:
+                    yield text
+        finally:
+            for future in futures:
+                future.cancel()
+            os.unlink(path)
 
-        modified_file_content = pdf_file.tobytes()
-
-        pdf_file.close()
-        # Reconstruct the multipart/form-data with the modified file content
-        boundary = content.split(b"\r\n")[0]
-        modified_content = b""
-        for part in content.split(boundary)[:-1]:
-            if b'filename="' in part:
-                headers, _ = part.split(b"\r\n\r\n", 1)
-                modified_content += boundary + headers + b"\r\n\r\n" + modified_file_content + b"\r\n"
-            elif len(part) > 0:
-                modified_content += part
 
-        # Add the closing boundary to the modified content
-        modified_content += boundary + b"--\r\n"
+class PDFOperations(FileOperations):
+    # Streams the pages of big documents to the analyzer; None extracts every document in one go
+    page_extractor: Optional[PageExtractor] = PageExtractor()
 
-        return modified_content
+    def __init__(self, analyze_function) -> None:
+        super().__init__(analyze_function)
+        # Opened once, for counting the pages, extracting the text and redacting it
+        self.document: Optional[fitz.Document] = None
+        # Parsed on first use, then reused by modify_content
+        self.parsed: Optional[ParsedPDF] = None
+
+    def open(self, file_content) -> fitz.Document:
+        if self.document is None:
+            self.document = open_pdf(file_content)
+        return self.document
+
+    def parse(self, file_content) -> ParsedPDF:
+        if self.parsed is None:
+            self.parsed = ParsedPDF(file_content, document=self.open(file_content))
+        return self.parsed
+
+    def extract_text(self, content, file_content) -> str:
+        return self.parse(file_content).text
+
+    def analyze_content(
+        self, content, file_content, extract_text: Optional[Callable[[], str]] = None
+    ) -> AnalysisResult:
+        if self.page_extractor is None:
+            return super().analyze_content(content, file_content, extract_text)
+        page_count = len(self.open(file_content))
+        if page_count < self.page_extractor.min_pages:
+            return super().analyze_content(content, file_content, extract_text)
+
+        # analyze_function gets the batches as they are extracted instead of
+        # the whole text, and may stop reading them once its verdict is final
+        batches = self.page_extractor.iter_text(file_content, page_count)
+        try:
+            return self.analyze_function(batches)
+        finally:
+            batches.close()
+
+    def modify_content(self, content, file_content, censor_dict: Dict[str, str], spans: Optional[List[Span]] = None):
+        parsed = self.parse(file_content)
+        if not spans:
+            spans = parsed.find_values(censor_dict)
+        modified_file_content = parsed.redact(spans)
+
+        parsed.close()
+        self.parsed = None
+        self.document = None
+        return modified_file_content
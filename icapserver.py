@@ -1,14 +1,33 @@
+import asyncio
+import codecs
+import functools
+import gc
 import logging
+import os
+import queue
 import re
+import signal
+import threading
+import time
 import traceback
-from io import BytesIO
+import zlib
+from concurrent.futures import Future, ThreadPoolExecutor
 from socketserver import ThreadingMixIn
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, Iterator, List, Optional
 
-from docx import Document
-
-from file_operations.file_operations import DOCOperations, PDFOperations, TextOperations
+from aioicap import AsyncBaseICAPRequestHandler, AsyncICAPServer
+from bodybuffer import DEFAULT_SPILL_THRESHOLD, BodyBuffer, BodyTooLarge
+from cache import LRUCache, content_hash
+from file_operations.file_operations import (
+    DOCOperations,
+    PDFOperations,
+    TextOperations,
+    replace_stream,
+)
+from multipart import MultipartParser, MultipartPart, boundary_from_content_type, parse_multipart, splice
+from preview import DEFAULT_PREVIEW_SIZE, PreviewClassifier, PreviewDecision
 from pyicap import BaseICAPRequestHandler, ICAPServer
+from textspans import Span
 
 logging.basicConfig(
     filename="pyicap.log", level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -16,10 +35,25 @@ logging.basicConfig(
 
 
 class AnalysisResult:
-    def __init__(self, censor_dict: dict, block: bool, block_message: str = "Content blocked due to policy violation"):
+    def __init__(
+        self,
+        censor_dict: dict,
+        block: bool,
+        block_message: str = "Content blocked due to policy violation",
+        spans: Optional[List[Span]] = None,
+        scanned: Optional[int] = None,
+        complete: bool = True,
+    ):
         self.censor_dict = censor_dict
         self.block = block
         self.block_message = block_message
+        # Redactions as offsets in the analyzed text; applied in one pass
+        # when the same text is rewritten, censor_dict is used otherwise
+        self.spans = spans or []
+        # Characters of the text analyzed, if counted; complete is False when
+        # the analysis stopped before the end because the content was blocked
+        self.scanned = scanned
+        self.complete = complete
 
 
 class ContentAnalyzer:
@@ -33,7 +67,15 @@ class ContentAnalyzer:
             and the values represent the replacement values for the sensitive information.
     """
 
-    def analyze(self, content: str, origin_ip: str, destination_ip: str, file_name: str = None, metadata: dict = None):
+    def analyze(
+        self,
+        content: str,
+        origin_ip: str,
+        destination_ip: str,
+        file_name: str = None,
+        metadata: dict = None,
+        separator: str = "\n",
+    ):
         """
         Analyzes the provided plain text content and returns a dictionary.
 
@@ -42,7 +84,9 @@ class ContentAnalyzer:
         corresponding replacement values.
 
         Parameters:
-            content (str): The plain text content to be analyzed.
+            content (str): The plain text content to be analyzed. Documents and response bodies may be
+                given as an iterable of segments instead (paragraphs, batches of PDF pages, decoded chunks),
+                to be joined with separator.
 
         Returns:
             dict:   A dictionary where the keys are the sensitive information found in the content,
@@ -58,67 +102,368 @@ class RequestAuthorizer:
 
 
 class FileHandler:
-    def __init__(self, content: bytes, content_analyzer: Callable[[bytes], None] = None) -> None:
+    # Documents sent as a bare body (e.g. downloads) rather than a multipart upload
+    FILE_CONTENT_TYPES = {
+        "application/pdf": "pdf",
+        "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    }
+
+    def __init__(
+        self,
+        content,
+        content_analyzer: Callable[[bytes], None] = None,
+        content_type: str = None,
+        text_cache: Optional[LRUCache] = None,
+        document_analyzer: Optional[Callable[[str, bytes], AnalysisResult]] = None,
+        parts: Optional[List[MultipartPart]] = None,
+    ) -> None:
+        # content is any buffer (bytes, or a BodyBuffer view); the uploaded
+        # file is kept as a memoryview slice of it rather than a copy
         self.content = content
         self.file_content = None
+        self.file_part: Optional[MultipartPart] = None
+        # Text extracted from documents, by hash of the document bytes
+        self.text_cache = text_cache
+        # Extracts and analyzes a whole document elsewhere (e.g. in a worker
+        # process), given the FileOperations class name and the file bytes
+        self.document_analyzer = document_analyzer
         self.op_instance = TextOperations(content_analyzer)
 
-        # Split the content based on the boundary string
-        boundary = content.split(b"\r\n")[0][2:]
-        parts = content.split(boundary) if boundary else [content]
-
-        # Find the part containing the file content
-        file_part = None
-        for part in parts:
-            if b'filename="' in part:
-                file_part = part
-                file_extension = None
-                # Extract the filename using regex
-                header = part.split(b"\r\n\r\n", 1)[0]
-                match = re.search(rb'filename="(.+)"', header)
-                if match:
-                    filename = match.group(1).decode("utf-8")
-                    file_extension = filename.split(".")[-1].lower()
-                    print(f"Detected file extension: {file_extension}")
-                break
-
-        if file_part:
-            # Extract the file content by removing headers and trailing newlines
-            self.file_content = file_part.split(b"\r\n\r\n", 1)[1].strip()
+        # Find the part containing the file content; parts already found
+        # while the body was read (see MultipartParser) save a pass over it
+        if parts is None:
+            parts = parse_multipart(content) or []
+        self.file_part = next((part for part in parts if part.filename), None)
+        if self.file_part:
+            file_extension = self.file_part.filename.split(".")[-1].lower()
+            print(f"Detected file extension: {file_extension}")
+            self.file_content = self.file_part.view(content)
+        elif content_type in self.FILE_CONTENT_TYPES:
+            file_extension = self.FILE_CONTENT_TYPES[content_type]
+            self.file_content = memoryview(content)
+        else:
+            return
 
-            # Check if the content is a PDF
-            if file_extension == "pdf" or self.file_content.startswith(b"%PDF"):
-                self.op_instance = PDFOperations(content_analyzer)
-            # Check if the content is a Word document
-            elif file_extension == "docx":
-                try:
-                    Document(BytesIO(self.file_content))
-                    self.op_instance = DOCOperations(content_analyzer)
-                    return
-                except Exception:
-                    traceback.print_exc()
-            # TODO: define how to manage other files
+        # Check if the content is a PDF
+        if file_extension == "pdf" or self.file_content[:4] == b"%PDF":
+            self.op_instance = PDFOperations(content_analyzer)
+        # Check if the content is a Word document
+        elif file_extension == "docx":
+            try:
+                # Parsed once here, then reused for analysis and redaction
+                op_instance = DOCOperations(content_analyzer)
+                op_instance.parse(self.file_content)
+                self.op_instance = op_instance
+                return
+            except Exception:
+                traceback.print_exc()
+        # TODO: define how to manage other files
 
-    def modify_content(self, censor_dict: dict) -> bytes:
+    def modify_content(self, censor_dict: dict, spans: Optional[List[Span]] = None) -> bytes:
         try:
-            return self.op_instance.modify_content(self.content, self.file_content, censor_dict)
+            modified_content = self.op_instance.modify_content(self.content, self.file_content, censor_dict, spans)
+            if self.file_part is None or isinstance(self.op_instance, TextOperations):
+                return modified_content
+            # Only the file changes: the rest of the multipart body is copied around it
+            return splice(self.content, [(self.file_part, modified_content)])
         except Exception as e:
             print(f"Error modifying document: {str(e)}")
             traceback.print_exc()
             return self.content
 
+    def extract_text(self) -> str:
+        extract = functools.partial(self.op_instance.extract_text, self.content, self.file_content)
+        # Plain text is read from the whole body and is as cheap to decode as to hash
+        if self.text_cache is None or isinstance(self.op_instance, TextOperations):
+            return extract()
+        # The same document always parses to the same text
+        key = (type(self.op_instance).__name__, content_hash(self.file_content))
+        return self.text_cache.get_or_compute(key, extract)
+
     def analyze_content(self) -> AnalysisResult:
         try:
-            return self.op_instance.analyze_content(self.content, self.file_content)
+            if self.document_analyzer is not None and not isinstance(self.op_instance, TextOperations):
+                return self.document_analyzer(type(self.op_instance).__name__, self.file_content)
+            return self.op_instance.analyze_content(self.content, self.file_content, self.extract_text)
         except Exception as e:
             print(f"Error analyzing document: {str(e)}")
             traceback.print_exc()
 
 
+class SegmentStream:
+    """Segments handed from the thread reading a body to the thread analyzing it"""
+
+    _END = object()
+
+    def __init__(self):
+        self._queue = queue.Queue()
+
+    def put(self, segment: str):
+        self._queue.put(segment)
+
+    def close(self):
+        self._queue.put(self._END)
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            segment = self._queue.get()
+            if segment is self._END:
+                return
+            yield segment
+
+
+class StreamAnalysisPool:
+    """
+    Threads running the analyses of response bodies that are scanned while they stream in.
+
+    An analysis holds its thread for as long as its body takes to arrive,
+    so at most max_workers run at once. A body arriving while all of them
+    are busy is not queued behind the others: submit returns None and the
+    caller applies its fallback verdict. Kept apart from the asyncio
+    engine's executor, whose tasks may be waiting for these analyses.
+    """
+
+    def __init__(self, max_workers: int = 32):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="icap-stream")
+        self._slots = threading.BoundedSemaphore(max_workers)
+        self._lock = threading.Lock()
+        self.rejected = 0
+
+    def submit(self, function: Callable, *args) -> Optional[Future]:
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return None
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ResponseScanner:
+    """
+    Runs the DLP policy over a response body while it streams in.
+
+    Text bodies (gzip/deflate are decompressed on the fly) are decoded
+    incrementally into segments of segment_size characters, which are fed
+    to a single analysis of the whole body running on stream_pool, so a
+    response gets one verdict and one history entry. When stream_pool is
+    full the body is let through (fail_open) or blocked without analysis. The analysis reads
+    segments as they arrive and stops reading once a Block is final; the
+    body is then answered without waiting for the rest of it. PDF and DOCX
+    bodies need the whole document and are analyzed once complete. Other
+    bodies are not inspected.
+    """
+
+    TEXT = "Text"
+    FILE = "File"
+
+    TEXT_CONTENT_TYPES = (
+        "text/",
+        "application/json",
+        "application/xml",
+        "application/javascript",
+        "application/x-www-form-urlencoded",
+    )
+    TEXT_CONTENT_SUFFIXES = ("+json", "+xml")
+    COMPRESSED_ENCODINGS = (b"gzip", b"x-gzip", b"deflate")
+
+    def __init__(
+        self,
+        headers: Dict[bytes, List[bytes]],
+        analyze_function: Callable[[str], AnalysisResult],
+        stream_pool: StreamAnalysisPool,
+        fail_open: bool = True,
+        segment_size: int = 64 * 1024,
+        text_cache: Optional[LRUCache] = None,
+        document_analyzer: Optional[Callable[[str, bytes], AnalysisResult]] = None,
+    ):
+        self.analyze_function = analyze_function
+        self.stream_pool = stream_pool
+        self.fail_open = fail_open
+        self.text_cache = text_cache
+        self.document_analyzer = document_analyzer
+        self.segment_size = segment_size
+        self.content_type = PreviewClassifier.content_type(headers)
+        self.charset = self._charset(headers)
+        self.content_encoding = headers.get(b"content-encoding", [b""])[0].strip().lower()
+        self.decoded = self.content_encoding in self.COMPRESSED_ENCODINGS
+
+        self.mode = None
+        is_text = self.content_type.startswith(self.TEXT_CONTENT_TYPES) or self.content_type.endswith(
+            self.TEXT_CONTENT_SUFFIXES
+        )
+        if is_text and self.content_encoding in (b"", b"identity") + self.COMPRESSED_ENCODINGS:
+            self.mode = self.TEXT
+        elif self.content_type in FileHandler.FILE_CONTENT_TYPES and self.content_encoding in (b"", b"identity"):
+            self.mode = self.FILE
+
+        self._decompressor, self._decoder = self._new_decoder()
+        self._pending = []
+        self._pending_length = 0
+        self._stream: Optional[SegmentStream] = None
+        self._result: Optional[Future] = None
+        self.file_handler = None
+        self.censor_dict = {}
+        self.spans = []
+        self.blocked = False
+        self.block_message = ""
+        self.scanned = None
+        self.complete = True
+
+    @property
+    def inspectable(self) -> bool:
+        return self.mode is not None
+
+    @staticmethod
+    def _charset(headers: Dict[bytes, List[bytes]]) -> str:
+        match = re.search(rb"charset=\"?([\w.:-]+)", headers.get(b"content-type", [b""])[0], re.IGNORECASE)
+        if match:
+            try:
+                return codecs.lookup(match.group(1).decode("ascii")).name
+            except LookupError:
+                pass
+        return "utf-8"
+
+    def _new_decoder(self):
+        decompressor = None
+        if self.decoded:
+            # 32: accept both zlib and gzip headers
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 32)
+        return decompressor, codecs.getincrementaldecoder(self.charset)(errors="replace")
+
+    def _decode(self, decompressor, decoder, chunk, final: bool = False) -> str:
+        if decompressor is not None:
+            chunk = decompressor.decompress(chunk)
+            if final:
+                chunk += decompressor.flush()
+        return decoder.decode(chunk, final)
+
+    def feed(self, chunk: bytes) -> Optional[str]:
+        """Take the next body chunk; returns a text segment when one is ready for analyze()"""
+        if self.mode != self.TEXT:
+            return None
+        text = self._decode(self._decompressor, self._decoder, chunk)
+        self._pending.append(text)
+        self._pending_length += len(text)
+        if self._pending_length < self.segment_size:
+            return None
+        return self._next_segment()
+
+    def _next_segment(self) -> Optional[str]:
+        if not self._pending_length:
+            return None
+        segment = "".join(self._pending)
+        self._pending = []
+        self._pending_length = 0
+        return segment
+
+    def analyze(self, segment: str) -> None:
+        """Hand segment to the analysis of the body, started by the first one; doesn't wait for it"""
+        if self._stream is None:
+            self._stream = SegmentStream()
+            self._result = self.stream_pool.submit(self._analyze_stream)
+            if self._result is None:
+                self._result = Future()
+                self._result.set_result(self._fallback())
+        if not self._result.done():
+            self._stream.put(segment)
+
+    def _analyze_stream(self) -> Optional[AnalysisResult]:
+        try:
+            # Segments are consecutive pieces of the decoded body
+            return self.analyze_function(self._stream, separator="")
+        except Exception:
+            traceback.print_exc()
+            return None
+
+    def _fallback(self) -> AnalysisResult:
+        if self.fail_open:
+            print("Response analysis queue full, letting the content through")
+            return AnalysisResult({}, False, "")
+        print("Response analysis queue full, blocking the content")
+        return AnalysisResult({}, True, "Content blocked: analysis queue full")
+
+    def poll(self) -> None:
+        """Take the verdict of the analysis if it has already ended (a Block found before the end of the body)"""
+        if self._result is not None and self._result.done() and not self.blocked:
+            self._merge(self._result.result())
+
+    def close(self) -> None:
+        """End the stream, so an analysis still reading it doesn't wait for segments that won't come"""
+        if self._stream is not None:
+            self._stream.close()
+
+    def finish(self, content) -> None:
+        """Analyze what is left once the whole body (content) has been read"""
+        if self.mode == self.TEXT:
+            text = self._decode(self._decompressor, self._decoder, b"", final=True)
+            self._pending.append(text)
+            self._pending_length += len(text)
+            segment = self._next_segment()
+            if segment:
+                self.analyze(segment)
+            if self._stream is not None:
+                self.close()
+                self._merge(self._result.result())
+        elif self.mode == self.FILE:
+            self.file_handler = FileHandler(
+                content,
+                self.analyze_function,
+                content_type=self.content_type,
+                text_cache=self.text_cache,
+                document_analyzer=self.document_analyzer,
+            )
+            result = self.file_handler.analyze_content()
+            self._merge(result)
+            # A document is analyzed in one piece, so its spans apply as they are
+            if result is not None:
+                self.spans = result.spans
+
+    def _merge(self, result: Optional[AnalysisResult]):
+        if result is None:
+            return
+        if result.block:
+            self.blocked = True
+            self.block_message = result.block_message
+        self.censor_dict = result.censor_dict or {}
+        self.scanned = result.scanned
+        self.complete = result.complete
+
+    def modified_file(self) -> bytes:
+        return self.file_handler.modify_content(self.censor_dict, self.spans)
+
+    def modified_text(self, body: BodyBuffer) -> Iterator[bytes]:
+        """Redacted text body, re-read from body and rewritten piece by piece"""
+        decompressor, decoder = self._new_decoder()
+        encoder = codecs.getincrementalencoder(self.charset)(errors="replace")
+
+        def pieces():
+            for chunk in body.iter_chunks():
+                yield self._decode(decompressor, decoder, chunk)
+            yield self._decode(decompressor, decoder, b"", final=True)
+
+        for text in replace_stream(pieces(), self.censor_dict):
+            yield encoder.encode(text)
+        yield encoder.encode("", final=True)
+
+
 class ThreadingSimpleServer(ThreadingMixIn, ICAPServer):
     pass
 
 
+class ReusePortThreadingServer(ThreadingSimpleServer):
+    # Pre-fork workers each bind their own socket to the same port
+    allow_reuse_port = True
+
+
 class SimpleICAPHandler(BaseICAPRequestHandler):
     def __init__(self, request, client_address, server):
         self.content_analyzer = server.content_analyzer
@@ -127,9 +472,9 @@ class SimpleICAPHandler(BaseICAPRequestHandler):
 
     def dlp_OPTIONS(self):
         self.set_icap_response(200)
-        self.set_icap_header(b"Methods", b"REQMOD")
+        self.set_icap_header(b"Methods", b"REQMOD, RESPMOD")
         self.set_icap_header(b"Service", b"SimpleICAP Server 1.0")
-        self.set_icap_header(b"Preview", b"0")
+        self.set_icap_header(b"Preview", str(self.server.preview_size).encode("utf-8"))
         self.set_icap_header(b"Transfer-Preview", b"*")
         self.set_icap_header(b"Transfer-Ignore", b"jpg,jpeg,gif,png,swf,flv")
         self.set_icap_header(b"Transfer-Complete", b"")
@@ -143,43 +488,84 @@ class SimpleICAPHandler(BaseICAPRequestHandler):
             self.no_adaptation_required()
             return
 
-        prevbuf = b""  # Initialize content variable
+        # Finds the parts of a multipart upload while it is read
+        parser = self.multipart_parser()
+        with self.new_body_buffer() as body:
+            try:
+                if self.preview is not None:
+                    self.read_body(body, parser)
 
-        if self.preview:
-            print("Handling preview mode")
-            while True:
-                chunk = self.read_chunk()
-                if chunk == b"":
-                    break
-                prevbuf += chunk
-
-            if self.ieof:
-                print("End of preview")
-                self.send_headers(True)
-                if len(content) > 0:
-                    self.write_chunk(content)
-                self.write_chunk(b"")
+                if not self.request_authorizer.authorize(self.enc_req, self.enc_req_headers):
+                    self.discard_body()
+                    self.send_enc_error(403, message=b"Forbidden")
+                    return
+
+                if self.preview is not None and self.answer_preview(body, self.enc_req_headers):
+                    return
+
+                self.read_body(body, parser)
+            except BodyTooLarge as e:
+                self.oversized_body(body, e)
                 return
 
-            self.cont()
+            self.analyze_request(body, parser)
 
-        if not self.request_authorizer.authorize(self.enc_req, self.enc_req_headers):
-            self.send_enc_error(403, message=b"Forbidden")
-            return
+    def origin_ip(self) -> str:
+        # Squid sends the addresses as ICAP headers (icap_send_client_ip)
+        value = self.headers.get(b"x-client-ip") or self.enc_req_headers.get(b"x-client-ip") or [b"127.0.0.1"]
+        return value[0].decode("utf-8")
 
-        content = b""
+    def destination_ip(self) -> str:
+        value = self.headers.get(b"x-server-ip") or self.enc_req_headers.get(b"x-server-ip") or [b"127.0.0.1"]
+        return value[0].decode("utf-8")
 
-        while True:
-            chunk = self.read_chunk()
-            if not chunk:
-                break
-            content += chunk
+    def answer_preview(self, body: BodyBuffer, headers: Dict[bytes, List[bytes]]) -> bool:
+        """
+        Classify the message once its preview has been read into body.
 
-        file_handler = FileHandler(content, self.content_analyzer)
-        print(f"FileHandler type {type(file_handler.op_instance)}")
+        Answers 204 and returns True when nothing in the message can match a
+        rule. Otherwise asks for the rest of the body (unless the preview
+        already held all of it) and returns False.
+        """
+        decision, reason = self.server.preview_classifier.classify(
+            self.origin_ip(), headers, body.head(self.server.preview_size)
+        )
+        if decision == PreviewDecision.SKIP:
+            logging.info(f"Preview: {reason}, no adaptation required")
+            self.no_adaptation_required()
+            return True
+
+        if not self.ieof:
+            self.cont()
+        return False
+
+    def bound_analyzer(self, **metadata) -> Callable[[str], AnalysisResult]:
+        return functools.partial(
+            self.content_analyzer,
+            origin_ip=self.origin_ip(),
+            destination_ip=self.destination_ip(),
+            metadata=metadata or None,
+        )
+
+    def bound_document_analyzer(self, **metadata) -> Optional[Callable[[str, bytes], AnalysisResult]]:
+        if self.server.document_analyzer is None:
+            return None
+        return functools.partial(
+            self.server.document_analyzer,
+            origin_ip=self.origin_ip(),
+            destination_ip=self.destination_ip(),
+            metadata=metadata or None,
+        )
 
-        origin_ip = self.enc_req_headers.get(b"X-Client-IP", [b"127.0.0.1"])[0].decode("utf-8")
-        destination_ip = self.enc_req_headers.get(b"X-Server-IP", [b"127.0.0.1"])[0].decode("utf-8")
+    def analyze_request(self, body: BodyBuffer, parser: Optional[MultipartParser] = None):
+        file_handler = FileHandler(
+            body.getbuffer(),
+            self.bound_analyzer(),
+            text_cache=self.server.text_cache,
+            document_analyzer=self.bound_document_analyzer(),
+            parts=parser.parts if parser is not None and parser.complete else None,
+        )
+        print(f"FileHandler type {type(file_handler.op_instance)}")
 
         result = file_handler.analyze_content()
 
@@ -187,6 +573,7 @@ class SimpleICAPHandler(BaseICAPRequestHandler):
         logging.info("Blocked: " + str(result.block))
         logging.info("Message: " + result.block_message)
         logging.info("Censor dict: " + str(result.censor_dict))
+        self.set_scanned_header(result.scanned, result.complete)
 
         if result.block:
             self.send_enc_error(403, body=result.block_message.encode("utf-8"))
@@ -194,7 +581,7 @@ class SimpleICAPHandler(BaseICAPRequestHandler):
 
         if result.censor_dict:
             self.set_icap_response(200)
-            modified_content = file_handler.modify_content(result.censor_dict)
+            modified_content = file_handler.modify_content(result.censor_dict, result.spans)
             logging.info("Modified request")
             # logging.info(modified_content)
             self.set_enc_request(b" ".join(self.enc_req))
@@ -204,46 +591,174 @@ class SimpleICAPHandler(BaseICAPRequestHandler):
             self.write_chunk(modified_content)
             self.write_chunk(b"")
         else:
-            self.no_adaptation_required()
+            self.answer_unmodified(body)
 
     def dlp_RESPMOD(self):
         if not self.has_body:
             self.no_adaptation_required()
             return
 
-        prevbuf = b""  # Initialize content variable
+        scanner = ResponseScanner(
+            self.enc_res_headers,
+            self.bound_analyzer(direction="response"),
+            self.server.stream_pool,
+            fail_open=self.server.analysis_fail_open,
+            text_cache=self.server.text_cache,
+            document_analyzer=self.bound_document_analyzer(direction="response"),
+        )
+        if not scanner.inspectable:
+            self.no_adaptation_required()
+            return
 
-        if self.preview:
-            print("Handling preview mode")
-            while True:
-                chunk = self.read_chunk()
-                if chunk == b"":
-                    break
-                prevbuf += chunk
-
-            if self.ieof:
-                print("End of preview")
-                self.send_headers(True)
-                if len(prevbuf) > 0:
-                    self.write_chunk(prevbuf)
-                self.write_chunk(b"")
+        with self.new_body_buffer() as body:
+            try:
+                if self.preview is not None:
+                    self.read_body(body)
+                    if self.answer_preview(body, self.enc_res_headers):
+                        return
+
+                if not self.scan_body(body, scanner, body.head(len(body))):
+                    return
+                scanner.finish(body.getbuffer())
+            except BodyTooLarge as e:
+                self.oversized_body(body, e)
                 return
+            finally:
+                scanner.close()
+
+            self.answer_scanned_response(body, scanner)
+
+    def scan_body(self, body: BodyBuffer, scanner: ResponseScanner, chunk: bytes = b"") -> bool:
+        """
+        Read the rest of the body into body, feeding it to scanner as it arrives.
+
+        Returns False when the analysis found a Block before the end of the
+        body; the response has then been answered and the rest of the body
+        discarded.
+        """
+        while True:
+            if chunk:
+                segment = scanner.feed(chunk)
+                if segment is not None:
+                    scanner.analyze(segment)
+                scanner.poll()
+                if scanner.blocked:
+                    self.discard_body()
+                    self.set_scanned_header(scanner.scanned, scanner.complete)
+                    self.send_enc_error(403, body=scanner.block_message.encode("utf-8"))
+                    return False
+            chunk = self.read_chunk()
+            if not chunk:
+                return True
+            body.write(chunk)
+
+    def answer_scanned_response(self, body: BodyBuffer, scanner: ResponseScanner):
+        logging.info(
+            f"Response scanned: {len(body)} bytes, blocked: {scanner.blocked}, censor dict: {scanner.censor_dict}"
+        )
+        self.set_scanned_header(scanner.scanned, scanner.complete)
+
+        if scanner.blocked:
+            self.send_enc_error(403, body=scanner.block_message.encode("utf-8"))
+        elif not scanner.censor_dict:
+            self.answer_unmodified(body)
+        elif scanner.mode == ResponseScanner.FILE:
+            modified_content = scanner.modified_file()
+            self.set_modified_response_headers(scanner, len(modified_content))
+            self.send_headers(True)
+            self.write_chunk(modified_content)
+            self.write_chunk(b"")
+        else:
+            self.set_modified_response_headers(scanner)
+            self.send_headers(True)
+            for piece in scanner.modified_text(body):
+                if piece:
+                    self.write_chunk(piece)
+            self.write_chunk(b"")
+
+    def set_modified_response_headers(self, scanner: ResponseScanner, content_length: Optional[int] = None):
+        self.set_icap_response(200)
+        self.set_enc_status(b" ".join(self.enc_res_status))
+        for h, v in self.enc_res_headers.items():
+            if h == b"content-length" or (h == b"content-encoding" and scanner.decoded):
+                continue
+            for v_i in v:
+                self.set_enc_header(h, v_i)
+        if content_length is not None:
+            self.set_enc_header(b"content-length", str(content_length).encode("utf-8"))
+
+    def set_scanned_header(self, scanned: Optional[int], complete: bool):
+        """
+        Tell the client how much of the body its answer is based on.
 
-        self.cont()
+        X-DLP-Scanned is the number of characters analyzed and whether that
+        was the whole body, or the analysis stopped early on a Block.
+        """
+        if scanned is None:
+            return
+        logging.info(f"Scanned: {scanned} characters" + ("" if complete else ", stopped early"))
+        self.set_icap_header(b"X-DLP-Scanned", f"{scanned}; complete={str(complete).lower()}".encode("utf-8"))
 
-        content = b""
+    def new_body_buffer(self) -> BodyBuffer:
+        return BodyBuffer(spill_threshold=self.server.body_spill_threshold, max_size=self.server.max_body_size)
 
+    def read_body(self, body: BodyBuffer, parser: Optional[MultipartParser] = None):
         while True:
             chunk = self.read_chunk()
             if not chunk:
                 break
-            content += chunk
+            body.write(chunk)
+            if parser is not None:
+                parser.feed(chunk)
+
+    def multipart_parser(self) -> Optional[MultipartParser]:
+        """Parser for the request body, when its Content-Type is multipart with a boundary"""
+        boundary = boundary_from_content_type(self.enc_req_headers.get(b"content-type", [b""])[0])
+        return MultipartParser(boundary) if boundary else None
 
-        logging.info("Original content in response")
-        logging.info(content)
+    def discard_body(self):
+        while self.read_chunk() != b"":
+            pass
+
+    def oversized_body(self, body: BodyBuffer, error: BodyTooLarge):
+        """Answer for a body past max_body_size: fail open (pass it through) or closed (block)"""
+        if not self.server.oversize_fail_open:
+            logging.warning(f"{error}, blocking it")
+            self.discard_body()
+            self.send_enc_error(413, body=b"Content blocked: body too large to be inspected")
+            return
 
-        self.no_adaptation_required()
-        return
+        logging.warning(f"{error}, passing it through without inspection")
+        self.answer_unmodified(body)
+
+    def answer_unmodified(self, body: BodyBuffer):
+        """Leave the message unaltered once (part of) its body has been read into body"""
+        if b"204" in self.allow or self.preview is not None:
+            self.no_adaptation_required()
+            return
+
+        # We can't answer 204: echo what was read so far, then the rest
+        self.set_icap_response(200)
+        self.set_original_enc_headers()
+        self.send_headers(True)
+        for chunk in body.iter_chunks():
+            self.write_chunk(chunk)
+        while True:
+            chunk = self.read_chunk()
+            self.write_chunk(chunk)
+            if chunk == b"":
+                break
+
+    def set_original_enc_headers(self):
+        if self.command == b"RESPMOD":
+            self.set_enc_status(b" ".join(self.enc_res_status))
+            headers = self.enc_res_headers
+        else:
+            self.set_enc_request(b" ".join(self.enc_req))
+            headers = self.enc_req_headers
+        for h, v in headers.items():
+            for v_i in v:
+                self.set_enc_header(h, v_i)
 
     def set_content_length_header(self, content_length):
         for h in self.enc_req_headers:
@@ -253,7 +768,233 @@ class SimpleICAPHandler(BaseICAPRequestHandler):
                 self.set_enc_header(h, v)
 
 
+class AsyncSimpleICAPHandler(AsyncBaseICAPRequestHandler):
+    """SimpleICAPHandler for the asyncio engine
+
+    Socket reads are awaited on the event loop; FileHandler parsing,
+    analysis and redaction are CPU-bound and run on the server executor.
+    """
+
+    def __init__(self, reader, writer, server):
+        self.content_analyzer = server.content_analyzer
+        self.request_authorizer = server.request_authorizer
+        super().__init__(reader, writer, server)
+
+    dlp_OPTIONS = SimpleICAPHandler.dlp_OPTIONS
+    new_body_buffer = SimpleICAPHandler.new_body_buffer
+    multipart_parser = SimpleICAPHandler.multipart_parser
+    origin_ip = SimpleICAPHandler.origin_ip
+    destination_ip = SimpleICAPHandler.destination_ip
+    bound_analyzer = SimpleICAPHandler.bound_analyzer
+    bound_document_analyzer = SimpleICAPHandler.bound_document_analyzer
+    set_original_enc_headers = SimpleICAPHandler.set_original_enc_headers
+    set_modified_response_headers = SimpleICAPHandler.set_modified_response_headers
+    set_scanned_header = SimpleICAPHandler.set_scanned_header
+    set_content_length_header = SimpleICAPHandler.set_content_length_header
+
+    async def read_body(self, body: BodyBuffer, parser: Optional[MultipartParser] = None):
+        while True:
+            chunk = await self.read_chunk()
+            if not chunk:
+                break
+            body.write(chunk)
+            if parser is not None:
+                parser.feed(chunk)
+
+    async def discard_body(self):
+        while await self.read_chunk() != b"":
+            pass
+
+    async def oversized_body(self, body: BodyBuffer, error: BodyTooLarge):
+        """See SimpleICAPHandler.oversized_body"""
+        if not self.server.oversize_fail_open:
+            logging.warning(f"{error}, blocking it")
+            await self.discard_body()
+            self.send_enc_error(413, body=b"Content blocked: body too large to be inspected")
+            return
+
+        logging.warning(f"{error}, passing it through without inspection")
+        await self.answer_unmodified(body)
+
+    async def answer_unmodified(self, body: BodyBuffer):
+        """See SimpleICAPHandler.answer_unmodified"""
+        if b"204" in self.allow or self.preview is not None:
+            await self.no_adaptation_required()
+            return
+
+        self.set_icap_response(200)
+        self.set_original_enc_headers()
+        self.send_headers(True)
+        for chunk in body.iter_chunks():
+            self.write_chunk(chunk)
+        while True:
+            chunk = await self.read_chunk()
+            self.write_chunk(chunk)
+            if chunk == b"":
+                break
+
+    async def dlp_REQMOD(self):
+        if not self.has_body:
+            await self.no_adaptation_required()
+            return
+
+        parser = self.multipart_parser()
+        with self.new_body_buffer() as body:
+            try:
+                if self.preview is not None:
+                    await self.read_body(body, parser)
+
+                if not self.request_authorizer.authorize(self.enc_req, self.enc_req_headers):
+                    await self.discard_body()
+                    self.send_enc_error(403, message=b"Forbidden")
+                    return
+
+                if self.preview is not None and await self.answer_preview(body, self.enc_req_headers):
+                    return
+
+                await self.read_body(body, parser)
+            except BodyTooLarge as e:
+                await self.oversized_body(body, e)
+                return
+
+            await self.analyze_request(body, parser)
+
+    async def answer_preview(self, body: BodyBuffer, headers: Dict[bytes, List[bytes]]) -> bool:
+        """See SimpleICAPHandler.answer_preview"""
+        decision, reason = self.server.preview_classifier.classify(
+            self.origin_ip(), headers, body.head(self.server.preview_size)
+        )
+        if decision == PreviewDecision.SKIP:
+            logging.info(f"Preview: {reason}, no adaptation required")
+            await self.no_adaptation_required()
+            return True
+
+        if not self.ieof:
+            self.cont()
+        return False
+
+    async def analyze_request(self, body: BodyBuffer, parser: Optional[MultipartParser] = None):
+        file_handler = await self.server.run_in_executor(
+            FileHandler,
+            body.getbuffer(),
+            self.bound_analyzer(),
+            text_cache=self.server.text_cache,
+            document_analyzer=self.bound_document_analyzer(),
+            parts=parser.parts if parser is not None and parser.complete else None,
+        )
+        result = await self.server.run_in_executor(file_handler.analyze_content)
+
+        logging.info("Result:")
+        logging.info("Blocked: " + str(result.block))
+        logging.info("Message: " + result.block_message)
+        logging.info("Censor dict: " + str(result.censor_dict))
+        self.set_scanned_header(result.scanned, result.complete)
+
+        if result.block:
+            self.send_enc_error(403, body=result.block_message.encode("utf-8"))
+            return
+
+        if result.censor_dict:
+            self.set_icap_response(200)
+            modified_content = await self.server.run_in_executor(
+                file_handler.modify_content, result.censor_dict, result.spans
+            )
+            logging.info("Modified request")
+            self.set_enc_request(b" ".join(self.enc_req))
+            self.set_content_length_header(str(len(modified_content)))
+            self.send_headers(True)
+            self.write_chunk(modified_content)
+            self.write_chunk(b"")
+        else:
+            await self.answer_unmodified(body)
+
+    async def dlp_RESPMOD(self):
+        if not self.has_body:
+            await self.no_adaptation_required()
+            return
+
+        scanner = ResponseScanner(
+            self.enc_res_headers,
+            self.bound_analyzer(direction="response"),
+            self.server.stream_pool,
+            fail_open=self.server.analysis_fail_open,
+            text_cache=self.server.text_cache,
+            document_analyzer=self.bound_document_analyzer(direction="response"),
+        )
+        if not scanner.inspectable:
+            await self.no_adaptation_required()
+            return
+
+        with self.new_body_buffer() as body:
+            try:
+                if self.preview is not None:
+                    await self.read_body(body)
+                    if await self.answer_preview(body, self.enc_res_headers):
+                        return
+
+                if not await self.scan_body(body, scanner, body.head(len(body))):
+                    return
+                await self.server.run_in_executor(scanner.finish, body.getbuffer())
+            except BodyTooLarge as e:
+                await self.oversized_body(body, e)
+                return
+            finally:
+                scanner.close()
+
+            await self.answer_scanned_response(body, scanner)
+
+    async def scan_body(self, body: BodyBuffer, scanner: ResponseScanner, chunk: bytes = b"") -> bool:
+        """See SimpleICAPHandler.scan_body"""
+        while True:
+            if chunk:
+                segment = scanner.feed(chunk)
+                if segment is not None:
+                    scanner.analyze(segment)
+                scanner.poll()
+                if scanner.blocked:
+                    await self.discard_body()
+                    self.set_scanned_header(scanner.scanned, scanner.complete)
+                    self.send_enc_error(403, body=scanner.block_message.encode("utf-8"))
+                    return False
+            chunk = await self.read_chunk()
+            if not chunk:
+                return True
+            body.write(chunk)
+
+    async def answer_scanned_response(self, body: BodyBuffer, scanner: ResponseScanner):
+        """See SimpleICAPHandler.answer_scanned_response"""
+        logging.info(
+            f"Response scanned: {len(body)} bytes, blocked: {scanner.blocked}, censor dict: {scanner.censor_dict}"
+        )
+        self.set_scanned_header(scanner.scanned, scanner.complete)
+
+        if scanner.blocked:
+            self.send_enc_error(403, body=scanner.block_message.encode("utf-8"))
+        elif not scanner.censor_dict:
+            await self.answer_unmodified(body)
+        elif scanner.mode == ResponseScanner.FILE:
+            modified_content = await self.server.run_in_executor(scanner.modified_file)
+            self.set_modified_response_headers(scanner, len(modified_content))
+            self.send_headers(True)
+            self.write_chunk(modified_content)
+            self.write_chunk(b"")
+        else:
+            self.set_modified_response_headers(scanner)
+            self.send_headers(True)
+            pieces = scanner.modified_text(body)
+            while True:
+                piece = await self.server.run_in_executor(next, pieces, None)
+                if piece is None:
+                    break
+                if piece:
+                    self.write_chunk(piece)
+                await self.writer.drain()
+            self.write_chunk(b"")
+
+
 class SimpleICAPServer:
+    ENGINES = ("threading", "asyncio")
+
     def __init__(
         self,
         host: str = "127.0.0.1",
@@ -261,30 +1002,201 @@ class SimpleICAPServer:
         prefix: str = "dlp",
         content_analyzer: ContentAnalyzer = None,
         request_authorizer: RequestAuthorizer = None,
+        engine: str = "threading",
+        executor_workers: Optional[int] = None,
+        workers: int = 0,
+        before_fork: Optional[Callable[[], None]] = None,
+        after_fork: Optional[Callable[[], None]] = None,
+        before_exit: Optional[Callable[[], None]] = None,
+        max_body_size: Optional[int] = None,
+        body_spill_threshold: int = DEFAULT_SPILL_THRESHOLD,
+        oversize_fail_open: bool = True,
+        stream_analyses: int = 32,
+        analysis_fail_open: bool = True,
+        preview_size: int = DEFAULT_PREVIEW_SIZE,
+        preview_classifier: Optional[PreviewClassifier] = None,
+        text_cache: Optional[LRUCache] = None,
+        document_analyzer: Optional[Callable[..., AnalysisResult]] = None,
     ):
+        if engine not in self.ENGINES:
+            raise ValueError(f"Unknown engine '{engine}', expected one of {self.ENGINES}")
+
         self.host = host
         self.port = port
         self.prefix = prefix
         self.content_analyzer = content_analyzer
         self.request_authorizer = request_authorizer
+        self.engine = engine
+        # Only used by the asyncio engine, for extraction and analysis
+        self.executor_workers = executor_workers
+        # Pre-fork mode: the parent loads everything once, then forks `workers`
+        # processes sharing the port through SO_REUSEPORT. before_fork runs in
+        # the parent (e.g. to close DB connections), after_fork in each worker.
+        self.workers = workers
+        self.before_fork = before_fork
+        self.after_fork = after_fork
+        # Runs in every serving process once it stops serving (e.g. to flush
+        # queued history); SIGTERM stops serving like Ctrl-C does
+        self.before_exit = before_exit
+        self.restart_delay = 1.0
+        # Bodies are kept in memory up to body_spill_threshold, then spilled
+        # to a temp file. Past max_body_size they are not inspected: they are
+        # passed through (fail open) or blocked with a 413 (fail closed).
+        self.max_body_size = max_body_size
+        self.body_spill_threshold = body_spill_threshold
+        self.oversize_fail_open = oversize_fail_open
+        # Text responses analyzed at once while they stream in; past that
+        # they are let through (analysis_fail_open) or blocked
+        self.stream_analyses = stream_analyses
+        self.analysis_fail_open = analysis_fail_open
+        # Bytes of each body Squid sends up front; the classifier can answer
+        # 204 from them without the rest of the body being transferred
+        self.preview_size = preview_size
+        self.preview_classifier = preview_classifier or PreviewClassifier()
+        # Text extracted from PDF/DOCX files, shared by every connection
+        self.text_cache = text_cache if text_cache is not None else LRUCache("extracted_text")
+        # Optional: takes PDF/DOCX extraction and analysis off the serving
+        # process (see analysis_pool.ProcessPoolContentAnalyzer.analyze_document)
+        self.document_analyzer = document_analyzer
 
-    def start(self):
-        class CustomHandler(SimpleICAPHandler):
+    @staticmethod
+    def _prefixed(handler_class):
+        class CustomHandler(handler_class):
             def __getattr__(self, name):
                 if name.startswith(self.server.prefix + "_"):
                     return getattr(self, name.split("_", 1)[1])
                 raise AttributeError(f"'{self.__class__.__name__}' object has no attribute '{name}'")
 
-        server = ThreadingSimpleServer(
-            (self.host, self.port),
-            CustomHandler,
-        )
+        return CustomHandler
+
+    def _configure(self, server):
         server.content_analyzer = self.content_analyzer
         server.request_authorizer = self.request_authorizer
         server.prefix = self.prefix
+        server.max_body_size = self.max_body_size
+        server.body_spill_threshold = self.body_spill_threshold
+        server.oversize_fail_open = self.oversize_fail_open
+        # Created in the serving process: threads don't survive fork()
+        server.stream_pool = StreamAnalysisPool(self.stream_analyses)
+        server.analysis_fail_open = self.analysis_fail_open
+        server.preview_size = self.preview_size
+        server.preview_classifier = self.preview_classifier
+        server.text_cache = self.text_cache
+        server.document_analyzer = self.document_analyzer
+        return server
+
+    def start(self):
+        print(f"Starting ICAP server on {self.host}:{self.port} ({self.engine} engine)")
+        if self.workers > 0:
+            self._start_prefork()
+        else:
+            signal.signal(signal.SIGTERM, signal.default_int_handler)
+            try:
+                self._serve()
+            finally:
+                if self.before_exit:
+                    self.before_exit()
+
+    def _serve(self, reuse_port: bool = False):
+        if self.engine == "asyncio":
+            self._start_asyncio(reuse_port)
+        else:
+            self._start_threading(reuse_port)
 
-        print(f"Starting ICAP server on {self.host}:{self.port}")
+    def _start_threading(self, reuse_port: bool = False):
+        server_class = ReusePortThreadingServer if reuse_port else ThreadingSimpleServer
+        server = self._configure(server_class((self.host, self.port), self._prefixed(SimpleICAPHandler)))
         try:
             server.serve_forever()
         except KeyboardInterrupt:
             print("Server stopped")
+        finally:
+            server.stream_pool.shutdown()
+
+    def _start_asyncio(self, reuse_port: bool = False):
+        executor = ThreadPoolExecutor(max_workers=self.executor_workers, thread_name_prefix="icap-analysis")
+        server = self._configure(
+            AsyncICAPServer(
+                (self.host, self.port),
+                self._prefixed(AsyncSimpleICAPHandler),
+                executor=executor,
+                reuse_port=reuse_port,
+            )
+        )
+        try:
+            asyncio.run(server.serve_forever())
+        except KeyboardInterrupt:
+            print("Server stopped")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            server.stream_pool.shutdown()
+
+    def _start_prefork(self):
+        if self.before_fork:
+            self.before_fork()
+
+        # Move everything loaded so far (spaCy model, recognizers) out of the
+        # collector's reach, so GC passes in the workers don't touch those
+        # pages and they stay shared copy-on-write.
+        gc.collect()
+        gc.freeze()
+
+        children: Dict[int, float] = {}
+        stopping = False
+
+        def spawn():
+            pid = os.fork()
+            if pid == 0:
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                code = 0
+                try:
+                    if self.after_fork:
+                        self.after_fork()
+                    self._serve(reuse_port=True)
+                except KeyboardInterrupt:
+                    pass
+                except Exception:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    try:
+                        if self.before_exit:
+                            self.before_exit()
+                    finally:
+                        os._exit(code)
+            children[pid] = time.monotonic()
+            print(f"Started worker {pid}")
+
+        def stop(signum, frame):
+            nonlocal stopping
+            stopping = True
+            for pid in list(children):
+                try:
+                    os.kill(pid, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+
+        for _ in range(self.workers):
+            spawn()
+
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+        while children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            started = children.pop(pid, None)
+            if started is None or stopping:
+                continue
+
+            print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, restarting")
+            # Don't spin if workers die right after starting (e.g. DB down)
+            if time.monotonic() - started < self.restart_delay:
+                time.sleep(self.restart_delay)
+            if not stopping:
+                spawn()
+
+        print("Server stopped")
@@ -0,0 +1,196 @@
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Header blocks of a part larger than this are not a multipart body we can parse
+MAX_HEADER_SIZE = 16 * 1024
+
+BOUNDARY_PARAM_RE = re.compile(rb'boundary=(?:"([^"]+)"|([^;\s]+))', re.IGNORECASE)
+BOUNDARY_LINE_RE = re.compile(rb"--([^\r\n]+)\r\n")
+HEADER_END_RE = re.compile(rb"\r\n\r\n")
+LINE_END_RE = re.compile(rb"\r\n")
+DISPOSITION_PARAM_RE = re.compile(r'(?:^|;)\s*([\w-]+)=(?:"([^"]*)"|([^;]*))')
+
+
+def boundary_from_content_type(value) -> Optional[bytes]:
+    """The boundary parameter of a multipart Content-Type header value, if it has one"""
+    if isinstance(value, str):
+        value = value.encode("latin-1")
+    if not value.split(b";", 1)[0].strip().lower().startswith(b"multipart/"):
+        return None
+    match = BOUNDARY_PARAM_RE.search(value)
+    if not match:
+        return None
+    return match.group(1) or match.group(2)
+
+
+class MultipartPart(NamedTuple):
+    # Header names lowercased
+    headers: Dict[str, str]
+    # Offsets of the part's content in the body
+    start: int
+    end: int
+
+    def disposition_param(self, name: str) -> Optional[str]:
+        for match in DISPOSITION_PARAM_RE.finditer(self.headers.get("content-disposition", "")):
+            if match.group(1).lower() == name:
+                return match.group(2) if match.group(2) is not None else match.group(3).strip()
+        return None
+
+    @property
+    def name(self) -> Optional[str]:
+        return self.disposition_param("name")
+
+    @property
+    def filename(self) -> Optional[str]:
+        return self.disposition_param("filename")
+
+    def view(self, content) -> memoryview:
+        """The part's content, as a slice of the body rather than a copy"""
+        return memoryview(content)[self.start : self.end]
+
+
+class MultipartParser:
+    """
+    Incremental multipart parser: finds the parts of a body fed to it chunk by chunk.
+
+    Only offsets and headers are kept, never the parts' content, and only
+    the bytes that may still hold the start of a delimiter are held between
+    chunks, so the body can be parsed as it is read into a BodyBuffer and
+    the parts then sliced out of it. parts holds the parts completed so far;
+    complete turns True once the closing delimiter has been read. A body
+    that doesn't parse sets failed and the rest of it is ignored.
+    """
+
+    PREAMBLE, DELIMITER, HEADERS, CONTENT, DONE = range(5)
+
+    def __init__(self, boundary: bytes):
+        self.boundary = boundary
+        self.delimiter_re = re.compile(re.escape(b"\r\n--" + boundary))
+        self.parts: List[MultipartPart] = []
+        self.failed = False
+        self._state = self.PREAMBLE
+        self._pending = bytearray()
+        # Offset in the body of self._pending[0]
+        self._base = 0
+        self._headers: Dict[str, str] = {}
+        self._part_start = 0
+
+    @property
+    def complete(self) -> bool:
+        return self._state == self.DONE and not self.failed
+
+    def feed(self, chunk) -> List[MultipartPart]:
+        """Parse the next chunk of the body; returns the parts it completed"""
+        if self._state == self.DONE or self.failed or not chunk:
+            return []
+        self._pending += chunk
+        count = len(self.parts)
+        consumed = self._scan(self._pending, final=False)
+        del self._pending[:consumed]
+        self._base += consumed
+        return self.parts[count:]
+
+    def _scan(self, data, final: bool) -> int:
+        """Parse as much of data (the body from self._base on) as possible; returns the bytes done with"""
+        position = 0
+        delimiter_length = len(self.boundary) + 4
+        while not self.failed:
+            if self._state == self.PREAMBLE:
+                # The first delimiter has no line break before it when it starts the body
+                opening = b"--" + self.boundary
+                if self._base == 0 and position == 0 and len(data) < len(opening) and not final:
+                    return 0
+                if self._base == 0 and position == 0 and data[: len(opening)] == opening:
+                    position = len(opening)
+                    self._state = self.DELIMITER
+                    continue
+                match = self.delimiter_re.search(data, position)
+                if not match:
+                    # Keep what could be the start of a delimiter cut by the chunk
+                    return max(position, len(data) - delimiter_length + 1)
+                position = match.end()
+                self._state = self.DELIMITER
+
+            elif self._state == self.DELIMITER:
+                # "--" closes the body; otherwise the line ends (after optional padding) and headers follow
+                if len(data) - position < 2:
+                    return position
+                if data[position : position + 2] == b"--":
+                    self._state = self.DONE
+                    return len(data)
+                line_end = LINE_END_RE.search(data, position)
+                if not line_end:
+                    if len(data) - position > MAX_HEADER_SIZE:
+                        self.failed = True
+                    return position
+                if bytes(data[position : line_end.start()]).strip(b" \t"):
+                    self.failed = True
+                    return position
+                # The header block starts with the delimiter line's CRLF, so an empty one is just CRLFCRLF
+                position = line_end.start()
+                self._state = self.HEADERS
+
+            elif self._state == self.HEADERS:
+                header_end = HEADER_END_RE.search(data, position)
+                if not header_end:
+                    if len(data) - position > MAX_HEADER_SIZE:
+                        self.failed = True
+                    return position
+                self._headers = self._parse_headers(data[position + 2 : header_end.start()])
+                position = header_end.end()
+                self._part_start = self._base + position
+                self._state = self.CONTENT
+
+            elif self._state == self.CONTENT:
+                match = self.delimiter_re.search(data, position)
+                if not match:
+                    # The content so far is only needed as offsets: drop it
+                    return max(position, len(data) - delimiter_length + 1)
+                self.parts.append(MultipartPart(self._headers, self._part_start, self._base + match.start()))
+                position = match.end()
+                self._state = self.DELIMITER
+
+            else:
+                return len(data)
+        return position
+
+    @staticmethod
+    def _parse_headers(block) -> Dict[str, str]:
+        headers = {}
+        for line in bytes(block).split(b"\r\n"):
+            name, separator, value = line.partition(b":")
+            if separator:
+                headers[name.strip().decode("latin-1").lower()] = value.strip().decode("utf-8", "replace")
+        return headers
+
+
+def parse_multipart(content, boundary: Optional[bytes] = None) -> Optional[List[MultipartPart]]:
+    """
+    The parts of a whole multipart body, or None if it isn't one.
+
+    Works on any buffer (bytes, memoryview, mmap) without copying it.
+    Without boundary (no Content-Type at hand) it is taken from the body's
+    first line. The parts before a malformed one (or a missing closing
+    delimiter) are still returned.
+    """
+    if boundary is None:
+        match = BOUNDARY_LINE_RE.match(content)
+        if not match:
+            return None
+        boundary = match.group(1)
+    parser = MultipartParser(boundary)
+    parser._scan(content, final=True)
+    return parser.parts if parser.complete or parser.parts else None
+
+
+def splice(content, replacements: Iterable[Tuple[MultipartPart, bytes]]) -> bytes:
+    """The body with the content of some parts replaced; the rest is copied straight from content"""
+    view = memoryview(content)
+    pieces = []
+    position = 0
+    for part, data in sorted(replacements, key=lambda replacement: replacement[0].start):
+        pieces.append(view[position : part.start])
+        pieces.append(data)
+        position = part.end
+    pieces.append(view[position:])
+    return b"".join(pieces)
@@ -0,0 +1,86 @@
+import logging
+from typing import Dict, Iterable, List
+
+import regex
+from presidio_analyzer import EntityRecognizer, PatternRecognizer
+
+# Something every match of these built-in recognizers contains, much cheaper
+# to look for than their full patterns. Each must be implied by every
+# pattern of the recognizer (checked by tests/test_prefilter.py).
+NATIVE_SIGNALS: Dict[str, str] = {
+    "EmailRecognizer": r"@",
+    "IbanRecognizer": r"[A-Z]{2}[ \-]?[0-9]{2}",
+    "CreditCardRecognizer": r"\d{4}",
+    "EsNifRecognizer": r"\d{7}",
+    "MedicalLicenseRecognizer": r"\d{7}",
+    "CryptoRecognizer": r"[0-9A-Z]{27}",
+    "IpRecognizer": r"[\d:]",
+    "DateRecognizer": r"\d",
+    "UrlRecognizer": r"\.",
+    "PhoneRecognizer": r"\d",
+}
+
+DEFAULT_SIGNAL_FLAGS = regex.DOTALL | regex.MULTILINE | regex.IGNORECASE
+
+# Numbered backreferences change meaning once the pattern is one branch of
+# a bigger alternation
+BACKREFERENCE_RE = regex.compile(r"\\[1-9]|\\g<\d|\(\?P=")
+
+
+class Prefilter:
+    """
+    Tells in one pass over the text whether a set of recognizers can find anything at all.
+
+    Each recognizer is reduced to a signal, a regex every one of its matches
+    must contain: its own patterns (deny lists are patterns too), or a
+    cheaper NATIVE_SIGNALS entry for built-in recognizers. The signals are
+    OR-ed into one matcher per regex flags combination. If none matches the
+    text, no recognizer would have returned a result and the analyzer can
+    be skipped.
+
+    Recognizers with no known signal (NER based ones, anything custom that
+    isn't a PatternRecognizer) make may_match always true.
+    """
+
+    def __init__(self, recognizers: Iterable[EntityRecognizer]):
+        self.always = False
+        signals: Dict[int, List[str]] = {}
+        for recognizer in recognizers:
+            native = NATIVE_SIGNALS.get(type(recognizer).__name__)
+            if native is not None:
+                signals.setdefault(DEFAULT_SIGNAL_FLAGS, []).append(native)
+            elif isinstance(recognizer, PatternRecognizer) and recognizer.patterns:
+                flags = recognizer.global_regex_flags or 0
+                signals.setdefault(flags, []).extend(pattern.regex for pattern in recognizer.patterns)
+            else:
+                self.always = True
+
+        self.matchers = []
+        for flags, patterns in signals.items():
+            self.matchers.extend(self._compile(patterns, flags))
+
+    @staticmethod
+    def _compile(patterns: List[str], flags: int) -> List["regex.Pattern"]:
+        separate = [p for p in patterns if BACKREFERENCE_RE.search(p)]
+        combined = [p for p in patterns if not BACKREFERENCE_RE.search(p)]
+        matchers = []
+        if combined:
+            try:
+                matchers.append(regex.compile("|".join(f"(?:{p})" for p in combined), flags))
+            except regex.error as e:
+                # e.g. inline flags that are only valid at the start of a pattern
+                logging.warning(f"Cannot combine prefilter patterns, matching them one by one: {e}")
+                separate.extend(combined)
+        for pattern in separate:
+            try:
+                matchers.append(regex.compile(pattern, flags))
+            except regex.error as e:
+                logging.warning(f"Invalid pattern {pattern!r} left out of the prefilter: {e}")
+                # Whatever the analyzer makes of it, it can't be ruled out here
+                matchers.append(regex.compile(""))
+        return matchers
+
+    def may_match(self, text: str) -> bool:
+        if self.always:
+            return True
+        return any(matcher.search(text) for matcher in self.matchers)
@@ -0,0 +1,90 @@
+import re
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+DEFAULT_PREVIEW_SIZE = 4096
+
+# Content types that never carry text the analyzers can look at
+DEFAULT_IGNORED_CONTENT_TYPES = ("image/", "video/", "audio/", "font/")
+
+# Leading bytes of media formats, for bodies sent without (or with a
+# generic) Content-Type. Only signatures plain text can't start with
+# belong here.
+DEFAULT_MEDIA_SIGNATURES = (
+    rb"\x89PNG\r\n\x1a\n",
+    rb"\xff\xd8\xff",  # JPEG
+    rb"GIF8[79]a",
+    rb"II\*\x00",  # TIFF
+    rb"MM\x00\*",
+    rb"RIFF.{4}(?:WEBP|AVI |WAVE)",
+    rb".{4}ftyp",  # MP4, MOV, HEIC
+    rb"\x1aE\xdf\xa3",  # Matroska, WebM
+    rb"OggS\x00",
+    rb"ID3[\x02-\x04]",  # MP3
+    rb"fLaC",
+    rb"FLV\x01",
+    rb"wOF[F2]",
+)
+
+
+class PreviewDecision:
+    SCAN = "Scan"  # The whole body is needed
+    SKIP = "Skip"  # Nothing in the body can match a rule, answer 204
+
+
+class PreviewClassifier:
+    """
+    Decides from the ICAP preview whether a message needs to be inspected at all.
+
+    The decision only uses the origin address, the encapsulated HTTP headers
+    and the first bytes of the body, so it can answer 204 before the client
+    sends the rest of the message.
+
+    Parameters:
+        has_rules: Tells whether any active rule applies to an origin IP.
+            When omitted every origin is assumed to have rules.
+        ignored_content_types: Content-Type prefixes that are never inspected.
+        media_signatures: Byte patterns matched at the start of the body of
+            formats that are never inspected.
+    """
+
+    def __init__(
+        self,
+        has_rules: Optional[Callable[[str], bool]] = None,
+        ignored_content_types: Iterable[str] = DEFAULT_IGNORED_CONTENT_TYPES,
+        media_signatures: Iterable[bytes] = DEFAULT_MEDIA_SIGNATURES,
+    ):
+        self.has_rules = has_rules
+        self.ignored_content_types = tuple(t.lower() for t in ignored_content_types)
+        self.media_signature = re.compile(b"|".join(b"(?:%s)" % sig for sig in media_signatures), re.DOTALL)
+
+    def classify(self, origin_ip: str, headers: Dict[bytes, List[bytes]], preview: bytes) -> Tuple[str, str]:
+        """
+        Classify a message from its preview.
+
+        Parameters:
+            origin_ip (str): Address of the client that sent the message.
+            headers (dict): Encapsulated HTTP headers, lowercase names as parsed by pyicap.
+            preview (bytes): The first bytes of the body.
+
+        Returns:
+            tuple: (PreviewDecision, reason)
+        """
+        if self.has_rules is not None and not self.has_rules(origin_ip):
+            return PreviewDecision.SKIP, f"no rules for origin {origin_ip}"
+
+        content_type = self.content_type(headers)
+        if content_type.startswith(self.ignored_content_types):
+            return PreviewDecision.SKIP, f"ignored content type {content_type}"
+
+        # A multipart body starts with its boundary, files only show up later
+        if not content_type.startswith("multipart/"):
+            signature = self.media_signature.match(preview)
+            if signature:
+                return PreviewDecision.SKIP, f"media signature {signature.group(0)[:12]!r}"
+
+        return PreviewDecision.SCAN, "inspection required"
+
+    @staticmethod
+    def content_type(headers: Dict[bytes, List[bytes]]) -> str:
+        value = headers.get(b"content-type", [b""])[0]
+        return value.split(b";", 1)[0].strip().decode("latin-1").lower()
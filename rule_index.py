@@ -0,0 +1,113 @@
+import ipaddress
+import logging
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+Rule = Dict[str, Any]
+
+
+class _Node:
+    __slots__ = ("children", "rules")
+
+    def __init__(self):
+        self.children: List[Optional["_Node"]] = [None, None]
+        self.rules: List[Rule] = []
+
+
+class RuleIndex:
+    """
+    In-memory index answering "which active rules apply to this origin IP".
+
+    Equivalent to the `origin_ip <<= networks.subnet` join of
+    Database.get_rules_network: subnets are stored in a binary radix trie
+    (one per IP version) and a lookup walks the address bits from the
+    shortest to the longest matching prefix, collecting the rules of every
+    subnet that contains the address. Resolved rule lists are kept in an
+    LRU cache keyed by IP.
+
+    The index is immutable once built; on configuration changes build a
+    new one and swap the reference.
+    """
+
+    def __init__(self, rows: Iterable[Rule], cache_size: int = 4096):
+        self._roots = {4: _Node(), 6: _Node()}
+        self._cache: "OrderedDict[str, Tuple[Rule, ...]]" = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.subnets = 0
+
+        for row in rows:
+            rule = dict(row)
+            subnet = rule.pop("subnet")
+            try:
+                network = ipaddress.ip_network(subnet, strict=False)
+            except ValueError:
+                logging.warning(f"Ignoring rule {rule.get('id')} for invalid subnet {subnet!r}")
+                continue
+            self._insert(network, rule)
+
+    def _insert(self, network, rule: Rule):
+        node = self._roots[network.version]
+        address = int(network.network_address)
+        for i in range(network.prefixlen):
+            bit = (address >> (network.max_prefixlen - 1 - i)) & 1
+            if node.children[bit] is None:
+                node.children[bit] = _Node()
+            node = node.children[bit]
+        if not node.rules:
+            self.subnets += 1
+        if all(r["id"] != rule["id"] for r in node.rules):
+            node.rules.append(rule)
+
+    def _walk(self, ip: str) -> Tuple[Rule, ...]:
+        try:
+            address = ipaddress.ip_address(ip)
+        except ValueError:
+            logging.warning(f"Cannot look up rules for invalid origin IP {ip!r}")
+            return ()
+        if address.version == 6 and address.ipv4_mapped is not None:
+            address = address.ipv4_mapped
+
+        bits = address.max_prefixlen
+        value = int(address)
+        node = self._roots[address.version]
+        found: Dict[Any, Rule] = {}
+        for i in range(bits + 1):
+            for rule in node.rules:
+                found.setdefault(rule["id"], rule)
+            if i == bits:
+                break
+            node = node.children[(value >> (bits - 1 - i)) & 1]
+            if node is None:
+                break
+        return tuple(sorted(found.values(), key=lambda rule: rule["id"]))
+
+    def lookup(self, ip: str) -> Tuple[Rule, ...]:
+        """Rules of every subnet containing ip, each rule once, ordered by id"""
+        with self._lock:
+            rules = self._cache.get(ip)
+            if rules is not None:
+                self._cache.move_to_end(ip)
+                self.hits += 1
+                return rules
+            self.misses += 1
+
+        rules = self._walk(ip)
+
+        with self._lock:
+            self._cache[ip] = rules
+            if len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+        return rules
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "subnets": self.subnets,
+                "cached_ips": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -1,14 +1,19 @@
+import argparse
+import functools
 import json
 import logging
-from typing import Dict, List
+from typing import Dict, Iterable, List, Optional, Union
 
+from analysis_pool import DEFAULT_TASK_TIMEOUT, ProcessPoolContentAnalyzer
 from dlp import DLP, Database
+from file_operations.file_operations import PageExtractor, PDFOperations
 from icapserver import (
     AnalysisResult,
     ContentAnalyzer,
     RequestAuthorizer,
     SimpleICAPServer,
 )
+from preview import DEFAULT_PREVIEW_SIZE, PreviewClassifier
 
 logging.basicConfig(
     filename="files_recieved.log", level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
@@ -16,32 +21,76 @@ logging.basicConfig(
 
 
 class DLPContentAnalyzer(ContentAnalyzer):
-    def __init__(self):
-        self.db = Database("127.0.0.1", "dlp", "oliver", "oliver")
-        self.dlp = DLP(db=self.db)
+    def __init__(
+        self,
+        start_background: bool = True,
+        snapshot_path: str = "config-snapshot.json",
+        pdf_page_processes: Optional[int] = None,
+    ):
+        # No connection is opened up front: with a config snapshot on disk the
+        # server starts even while the database is down
+        self.db = Database("127.0.0.1", "dlp", "oliver", "oliver", min_connections=0)
+        self.dlp = DLP(db=self.db, start_background=start_background, snapshot_path=snapshot_path)
+        # Set here rather than in main so pool workers, which import this module afresh, get it too
+        if pdf_page_processes == 0:
+            PDFOperations.page_extractor = None
+        elif pdf_page_processes is not None:
+            PDFOperations.page_extractor = PageExtractor(processes=pdf_page_processes)
+
+    def has_rules(self, origin_ip: str) -> bool:
+        return self.dlp.has_rules(origin_ip)
+
+    def before_fork(self):
+        # A libpq connection must not be shared between processes
+        self.db.close()
+
+    def after_fork(self):
+        self.db.connect()
+        self.dlp.start_background_tasks()
+
+    def close(self):
+        self.dlp.close()
+        self.db.close()
 
     def analyze(
         self,
-        content: str,
+        content: Union[str, Iterable[str]],
         origin_ip: str = "127.0.0.1",
         destination_ip: str = "127.0.0.1",
         file_name: str = None,
         metadata: dict = None,
+        separator: str = "\n",
     ) -> AnalysisResult:
 
         metadata_dict = metadata or {}
         if file_name:
             metadata_dict["file_name"] = file_name
 
+        # Documents and response bodies come as segments (paragraphs, batches of PDF pages, decoded
+        # chunks), analyzed as they are read
+        streamed = not isinstance(content, str)
+        preview = "<document segments>" if streamed else content[:100]
+
         # Log the file reception details
-        log_message = f"Received file: {file_name}, with content: {content[:100]} from {origin_ip} to {destination_ip}"
+        log_message = f"Received file: {file_name}, with content: {preview} from {origin_ip} to {destination_ip}"
         logging.info(log_message)
         print(log_message)
 
-        result = self.dlp.analyze_network(
-            text=content, origin_ip=origin_ip, destination_ip=destination_ip, metadata=json.dumps(metadata_dict)
+        if streamed:
+            result = self.dlp.analyze_segments(
+                content,
+                origin_ip=origin_ip,
+                destination_ip=destination_ip,
+                metadata=json.dumps(metadata_dict),
+                separator=separator,
+            )
+        else:
+            result = self.dlp.analyze_network(
+                text=content, origin_ip=origin_ip, destination_ip=destination_ip, metadata=json.dumps(metadata_dict)
+            )
+        return AnalysisResult(
+            result.censor_dict, result.block, result.block_message, result.spans, result.scanned, result.complete
         )
-        return AnalysisResult(result.censor_dict, result.block, result.block_message)
 
 
 class DLPRequestAuthorizer(RequestAuthorizer):
@@ -51,16 +100,131 @@ class DLPRequestAuthorizer(RequestAuthorizer):
         return True
 
 
+def parse_args():
+    parser = argparse.ArgumentParser(description="DLP ICAP Server")
+    parser.add_argument(
+        "--engine",
+        choices=SimpleICAPServer.ENGINES,
+        default="threading",
+        help="threading: one thread per connection; asyncio: one event loop, analysis on an executor",
+    )
+    parser.add_argument(
+        "--executor-workers", type=int, default=None, help="Analysis threads used by the asyncio engine"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Fork N worker processes sharing the port (SO_REUSEPORT); 0 serves from a single process",
+    )
+    parser.add_argument(
+        "--max-body-size", type=int, default=None, help="Largest body (bytes) that is inspected; no limit by default"
+    )
+    parser.add_argument(
+        "--fail-closed",
+        action="store_true",
+        help="Block bodies that cannot be inspected (larger than --max-body-size, analysis timed out, failed or "
+        "had no free slot) instead of passing them through",
+    )
+    parser.add_argument(
+        "--stream-analyses",
+        type=int,
+        default=32,
+        help="Text responses analyzed at once while they stream in; past that they are let through (or blocked "
+        "with --fail-closed)",
+    )
+    parser.add_argument(
+        "--preview-size",
+        type=int,
+        default=DEFAULT_PREVIEW_SIZE,
+        help="Preview bytes requested from Squid, used to skip bodies early",
+    )
+    parser.add_argument(
+        "--analysis-processes",
+        type=int,
+        default=0,
+        help="Run extraction and analysis in N worker processes, each with its own warm model; 0 analyzes in the "
+        "serving process",
+    )
+    parser.add_argument(
+        "--analysis-queue",
+        type=int,
+        default=None,
+        help="Analysis tasks queued or running at once in the worker processes (default: 4 per process)",
+    )
+    parser.add_argument(
+        "--analysis-timeout",
+        type=float,
+        default=DEFAULT_TASK_TIMEOUT,
+        help="Seconds an analysis may take in a worker process before the content is let through (or blocked with "
+        "--fail-closed)",
+    )
+    parser.add_argument(
+        "--pdf-page-processes",
+        type=int,
+        default=None,
+        help="Processes extracting the pages of big PDFs in parallel, while the pages already extracted are "
+        "analyzed; 0 extracts every PDF in one go",
+    )
+    parser.add_argument(
+        "--config-snapshot",
+        default="config-snapshot.json",
+        help="Local copy of the configuration, used to start without waiting for the database",
+    )
+    return parser.parse_args()
+
+
 def main():
-    analyzer = DLPContentAnalyzer().analyze
+    args = parse_args()
     authorizer = DLPRequestAuthorizer()
 
+    if args.analysis_processes > 0:
+        # The serving process only does I/O; the model lives in the pool workers
+        content_analyzer = ProcessPoolContentAnalyzer(
+            functools.partial(
+                DLPContentAnalyzer,
+                snapshot_path=args.config_snapshot,
+                pdf_page_processes=args.pdf_page_processes,
+            ),
+            processes=args.analysis_processes,
+            max_pending=args.analysis_queue,
+            task_timeout=args.analysis_timeout,
+            fail_open=not args.fail_closed,
+        )
+        server_options = dict(
+            before_exit=content_analyzer.close,
+            preview_classifier=PreviewClassifier(),
+            document_analyzer=content_analyzer.analyze_document,
+        )
+    else:
+        content_analyzer = DLPContentAnalyzer(
+            start_background=args.workers == 0,
+            snapshot_path=args.config_snapshot,
+            pdf_page_processes=args.pdf_page_processes,
+        )
+        server_options = dict(
+            before_fork=content_analyzer.before_fork,
+            after_fork=content_analyzer.after_fork,
+            before_exit=content_analyzer.close,
+            preview_classifier=PreviewClassifier(has_rules=content_analyzer.has_rules),
+            text_cache=content_analyzer.dlp.text_cache,
+        )
+
     server = SimpleICAPServer(
         host="127.0.0.1",
         port=1344,
         prefix="dlp",
-        content_analyzer=analyzer,
+        content_analyzer=content_analyzer.analyze,
         request_authorizer=authorizer,
+        engine=args.engine,
+        executor_workers=args.executor_workers,
+        workers=args.workers,
+        max_body_size=args.max_body_size,
+        oversize_fail_open=not args.fail_closed,
+        stream_analyses=args.stream_analyses,
+        analysis_fail_open=not args.fail_closed,
+        preview_size=args.preview_size,
+        **server_options,
     )
 
     print("Starting DLP ICAP Server...")
@@ -0,0 +1,52 @@
+-- Notifies the DLP servers on the dlp_config channel whenever detection or
+-- rule configuration changes, so they reload it right away instead of
+-- waiting for the next poll. Safe to run more than once.
+--
+-- Payload: {"table": ..., "op": "INSERT|UPDATE|DELETE", "id": ..., "entity_type_id": ...}
+-- Identical notifications sent within one transaction are delivered once.
+
+CREATE OR REPLACE FUNCTION dlp_notify_config_change() RETURNS trigger AS $$
+DECLARE
+    row_data jsonb;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        row_data := to_jsonb(OLD);
+    ELSE
+        row_data := to_jsonb(NEW);
+    END IF;
+
+    PERFORM pg_notify('dlp_config', json_build_object(
+        'table', TG_TABLE_NAME,
+        'op', TG_OP,
+        'id', row_data -> 'id',
+        'entity_type_id', CASE
+            WHEN TG_TABLE_NAME = 'custom_entity_types' THEN row_data -> 'id'
+            ELSE row_data -> 'entity_type_id'
+        END
+    )::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    config_table text;
+BEGIN
+    FOREACH config_table IN ARRAY ARRAY[
+        'custom_entity_types',
+        'custom_patterns',
+        'custom_deny_list',
+        'custom_context_words',
+        'rules',
+        'groups_rules',
+        'networks'
+    ] LOOP
+        EXECUTE format('DROP TRIGGER IF EXISTS dlp_config_notify ON %I', config_table);
+        EXECUTE format(
+            'CREATE TRIGGER dlp_config_notify AFTER INSERT OR UPDATE OR DELETE ON %I '
+            'FOR EACH ROW EXECUTE FUNCTION dlp_notify_config_change()',
+            config_table
+        );
+    END LOOP;
+END;
+$$;
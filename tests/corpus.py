@@ -0,0 +1,85 @@
+from presidio_analyzer import Pattern, PatternRecognizer, RecognizerRegistry
+from presidio_analyzer.predefined_recognizers import SpacyRecognizer
+
+# Real looking values of every built-in Spanish pattern recognizer and of
+# the custom ones below
+SAMPLES = [
+    "12345678",
+    "DNI 45678912",
+    "20123456789",
+    "12345678-Z",
+    "juan.perez@pucp.edu.pe",
+    "a@b.co",
+    "PE12 3456 7890 1234 5678 90",
+    "ES9121000418450200051332",
+    "4111 1111 1111 1111",
+    "5500-0000-0000-0004",
+    "1BoatSLRHtKNngkdXEeobR76b53LETtpyT",
+    "192.168.0.1",
+    "fe80::1",
+    "::",
+    "2001:db8::ff00:42:8329",
+    "31/12/2023",
+    "2024-01-15",
+    "15-MAR-2024",
+    "MAR-24",
+    "https://www.example.com/path",
+    "dlp.pucp.pe",
+    "+51 987 654 321",
+    "(01) 626-2000",
+    "AB1234563",
+    "secreto",
+    "Proyecto Cóndor",
+    "XY-777",
+]
+
+# Text around the samples, and text with nothing to find
+FILLER = [
+    "",
+    "hola",
+    "Estimado cliente, adjuntamos el informe del mes.",
+    "el documento de identidad del titular es",
+    "PRECIO: 150 soles; 3 unidades (aprox.)",
+    "ñandú áéíóú #etiqueta -- / + ;",
+    "Línea uno\nLínea dos\n\nFin",
+]
+
+TEXTS = (
+    SAMPLES
+    + FILLER
+    + [f"{before} {sample}, {after}" for sample in SAMPLES for before, after in zip(FILLER, reversed(FILLER))]
+    + [f"({sample})" for sample in SAMPLES]
+)
+
+
+def custom_recognizers():
+    return [
+        PatternRecognizer(
+            supported_entity="DNI",
+            patterns=[Pattern("DNI", r"\b\d{8}\b", 0.5)],
+            context=["dni", "documento"],
+            supported_language="es",
+        ),
+        PatternRecognizer(
+            supported_entity="RUC",
+            patterns=[Pattern("RUC", r"\b(10|15|17|20)\d{9}\b", 0.6)],
+            supported_language="es",
+        ),
+        PatternRecognizer(
+            supported_entity="PROYECTO",
+            deny_list=["secreto", "Proyecto Cóndor", "confidencial"],
+            supported_language="es",
+        ),
+        PatternRecognizer(
+            supported_entity="CODIGO",
+            patterns=[Pattern("Codigo", r"(?P<pre>[A-Z]{2})-(\d)\2{2}", 0.4)],
+            supported_language="es",
+        ),
+    ]
+
+
+def pattern_recognizers():
+    """The built-in Spanish recognizers that don't need an NLP model, and the custom ones"""
+    registry = RecognizerRegistry()
+    registry.load_predefined_recognizers(languages=["es"])
+    return [r for r in registry.recognizers if not isinstance(r, SpacyRecognizer)] + custom_recognizers()
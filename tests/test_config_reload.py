@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+
+# The local database setup.py connects to
+DATABASE = dict(host="127.0.0.1", database="dlp", user="oliver", password="oliver")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture
+def connection():
+    try:
+        conn = psycopg2.connect(connect_timeout=3, **DATABASE)
+    except psycopg2.Error as e:
+        pytest.skip(f"No database available: {e}")
+    conn.autocommit = True
+    yield conn
+    conn.close()
+
+
+@pytest.fixture
+def dlp(connection, tmp_path, monkeypatch):
+    dlp_module = pytest.importorskip("dlp")
+    db_module = pytest.importorskip("db")
+    # The NLP engine configuration is read relative to the working directory
+    monkeypatch.chdir(REPO_ROOT)
+    db = db_module.Database(min_connections=0, **DATABASE)
+    instance = dlp_module.DLP(db, start_background=False, snapshot_path=str(tmp_path / "config-snapshot.json"))
+    yield instance
+    instance.close()
+    db.close()
+
+
+def set_confidence_level(connection, rule_id: int, confidence_level: float):
+    with connection.cursor() as cursor:
+        cursor.execute("UPDATE rules SET confidence_level = %s WHERE id = %s", (confidence_level, rule_id))
+
+
+def confidence_levels(dlp, rule_id: int):
+    return {float(rule["confidence_level"]) for rule in dlp.snapshot.rules if rule["id"] == rule_id}
+
+
+def test_changed_rule_is_picked_up(connection, dlp):
+    if not dlp.snapshot.rules:
+        pytest.skip("No active rules in the database")
+    rule = dlp.snapshot.rules[0]
+    original = float(rule["confidence_level"])
+    changed = 0.5 if original != 0.5 else 0.6
+    version = dlp.snapshot.version
+
+    set_confidence_level(connection, rule["id"], changed)
+    try:
+        # What the config listener calls on a notification from the rules trigger
+        dlp.apply_config_changes([{"table": "rules", "op": "UPDATE", "id": rule["id"], "entity_type_id": None}])
+        assert dlp.snapshot.version != version
+        assert confidence_levels(dlp, rule["id"]) == {changed}
+        # The rule index is rebuilt from the new rules as well
+        assert any(
+            float(indexed["confidence_level"]) == changed
+            for indexed in dlp.rule_index.lookup(rule["subnet"].split("/")[0])
+            if indexed["id"] == rule["id"]
+        )
+        # Nothing changed since
+        assert not dlp.reconcile()
+    finally:
+        set_confidence_level(connection, rule["id"], original)
+
+    assert dlp.reconcile()
+    assert dlp.snapshot.version == version
+    assert confidence_levels(dlp, rule["id"]) == {original}
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("presidio_analyzer")
+
+from presidio_analyzer.nlp_engine import NlpArtifacts  # noqa: E402
+
+from prefilter import Prefilter  # noqa: E402
+from tests.corpus import TEXTS, pattern_recognizers  # noqa: E402
+
+ARTIFACTS = NlpArtifacts(entities=[], tokens=[], tokens_indices=[], lemmas=[], nlp_engine=None, language="es")
+
+
+def detections(recognizer, text):
+    return recognizer.analyze(text=text, entities=recognizer.supported_entities, nlp_artifacts=ARTIFACTS)
+
+
+def test_prefilter_never_hides_a_detection():
+    recognizers = pattern_recognizers()
+    combined = Prefilter(recognizers)
+    found = 0
+    for recognizer in recognizers:
+        prefilter = Prefilter([recognizer])
+        for text in TEXTS:
+            if detections(recognizer, text):
+                found += 1
+                assert prefilter.may_match(text), (type(recognizer).__name__, text)
+                assert combined.may_match(text), (type(recognizer).__name__, text)
+    # The corpus does exercise the recognizers
+    assert found > len(TEXTS)
+
+
+def test_prefilter_rules_out_plain_text():
+    combined = Prefilter(pattern_recognizers())
+    assert not combined.may_match("")
+    assert not combined.may_match("hola")
@@ -0,0 +1,103 @@
+import pytest
+
+from preview import PreviewClassifier, PreviewDecision
+
+PNG = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR"
+
+
+def classifier():
+    return PreviewClassifier(has_rules=lambda ip: ip.startswith("10."))
+
+
+def test_origin_without_rules_is_skipped():
+    # Answered with a 204 whatever the body is
+    decision, reason = classifier().classify("192.168.1.1", {b"content-type": [b"text/plain"]}, b"DNI 12345678")
+    assert decision == PreviewDecision.SKIP
+    assert "no rules" in reason
+
+
+def test_every_origin_has_rules_by_default():
+    decision, _ = PreviewClassifier().classify("192.168.1.1", {b"content-type": [b"text/plain"]}, b"hola")
+    assert decision == PreviewDecision.SCAN
+
+
+def test_ignored_content_type_is_skipped():
+    decision, reason = classifier().classify("10.0.0.1", {b"content-type": [b"Image/PNG; q=1"]}, b"anything")
+    assert decision == PreviewDecision.SKIP
+    assert "image/png" in reason
+
+
+def test_media_signature_is_skipped_without_content_type():
+    for preview in (PNG, b"RIFF\x10\x00\x00\x00WEBPVP8 ", b"\x00\x00\x00\x18ftypmp42"):
+        decision, reason = classifier().classify("10.0.0.1", {}, preview)
+        assert decision == PreviewDecision.SKIP
+        assert "media signature" in reason
+
+
+def test_text_is_scanned():
+    # The rest of the body is asked for with a 100 Continue
+    headers = {b"content-type": [b"application/json"]}
+    assert classifier().classify("10.0.0.1", headers, b'{"dni": "12345678"}') == (
+        PreviewDecision.SCAN,
+        "inspection required",
+    )
+
+
+def test_signature_only_matches_at_the_start():
+    decision, _ = classifier().classify("10.0.0.1", {}, b"RIFF raff WAVE")
+    assert decision == PreviewDecision.SCAN
+
+
+def test_multipart_is_scanned_whatever_its_first_bytes():
+    headers = {b"content-type": [b"multipart/form-data; boundary=x"]}
+    decision, _ = classifier().classify("10.0.0.1", headers, PNG)
+    assert decision == PreviewDecision.SCAN
+
+
+class PreviewHandler:
+    """The state SimpleICAPHandler.answer_preview reads, recording how it answers"""
+
+    def __init__(self, classifier, ieof=False, client_ip=b"10.0.0.1"):
+        self.server = type("Server", (), {"preview_classifier": classifier, "preview_size": 4096})()
+        self.headers = {b"x-client-ip": [client_ip]}
+        self.enc_req_headers = {}
+        self.ieof = ieof
+        self.answers = []
+
+    def no_adaptation_required(self):
+        self.answers.append(204)
+
+    def cont(self):
+        self.answers.append(100)
+
+
+class Preview:
+    def __init__(self, data):
+        self.data = data
+
+    def head(self, size):
+        return self.data[:size]
+
+
+def answer_preview(handler, preview, headers):
+    icapserver = pytest.importorskip("icapserver")
+    handler.origin_ip = icapserver.SimpleICAPHandler.origin_ip.__get__(handler)
+    return icapserver.SimpleICAPHandler.answer_preview(handler, Preview(preview), headers)
+
+
+def test_skip_answers_204():
+    handler = PreviewHandler(classifier(), client_ip=b"192.168.1.1")
+    assert answer_preview(handler, b"hola", {b"content-type": [b"text/plain"]})
+    assert handler.answers == [204]
+
+
+def test_scan_asks_for_the_rest_with_100_continue():
+    handler = PreviewHandler(classifier())
+    assert not answer_preview(handler, b"DNI 12345678", {b"content-type": [b"text/plain"]})
+    assert handler.answers == [100]
+
+
+def test_scan_of_a_complete_preview_needs_no_100_continue():
+    handler = PreviewHandler(classifier(), ieof=True)
+    assert not answer_preview(handler, b"DNI 12345678", {b"content-type": [b"text/plain"]})
+    assert handler.answers == []
@@ -0,0 +1,76 @@
+import pytest
+
+pytest.importorskip("presidio_analyzer")
+
+from presidio_analyzer import EntityRecognizer  # noqa: E402
+from presidio_analyzer.nlp_engine import NlpArtifacts  # noqa: E402
+
+from tests.corpus import TEXTS, pattern_recognizers  # noqa: E402
+from windowing import analyze_windowed, coalesce_segments, segment_windows  # noqa: E402
+
+ARTIFACTS = NlpArtifacts(entities=[], tokens=[], tokens_indices=[], lemmas=[], nlp_engine=None, language="es")
+RECOGNIZERS = pattern_recognizers()
+# Long enough for many window borders with small windows
+TEXT = " ".join(TEXTS)
+
+SEGMENTS = ["Página uno", "", "DNI 12345678", "x" * 30, "fin"]
+
+
+def owned_text(windows):
+    return "".join(window.text[window.own_start : window.own_end] for window in windows)
+
+
+@pytest.mark.parametrize("separator", ["\n", ""])
+@pytest.mark.parametrize("overlap", [0, 1, 2, 3, 40])
+def test_segment_windows_flag_the_last_segment(overlap, separator):
+    windows = list(segment_windows(SEGMENTS, overlap, separator))
+    assert [window.segment for window in windows] == SEGMENTS
+    assert [window.last for window in windows] == [False] * (len(SEGMENTS) - 1) + [True]
+    assert owned_text(windows) == separator.join(SEGMENTS)
+
+
+@pytest.mark.parametrize("separator", ["\n", ""])
+@pytest.mark.parametrize("overlap", [0, 1])
+def test_single_segment_is_last(overlap, separator):
+    assert [window.last for window in segment_windows(["solo"], overlap, separator)] == [True]
+    assert list(segment_windows([], overlap, separator)) == []
+
+
+def analyze(text):
+    results = []
+    for recognizer in RECOGNIZERS:
+        results += recognizer.analyze(text=text, entities=recognizer.supported_entities, nlp_artifacts=ARTIFACTS)
+    return EntityRecognizer.remove_duplicates(results)
+
+
+def key(results):
+    return sorted((r.entity_type, r.start, r.end, round(r.score, 6)) for r in results)
+
+
+@pytest.mark.parametrize("size, overlap", [(500, 200), (2000, 400), (len(TEXT), 400)])
+def test_windowed_analysis_matches_single_pass(size, overlap):
+    expected = analyze(TEXT)
+    assert expected
+    assert key(analyze_windowed(analyze, TEXT, size, overlap)) == key(expected)
+
+
+@pytest.mark.parametrize("min_length", [1, 300, 5000])
+def test_segment_analysis_matches_single_pass(min_length):
+    # As DLP.analyze_segments does with the paragraphs of a document
+    segments = coalesce_segments(TEXTS, min_length)
+    results = []
+    for window in segment_windows(segments, 200):
+        for result in analyze(window.text):
+            if window.own_start <= result.start < window.own_end:
+                result.start += window.offset
+                result.end += window.offset
+                results.append(result)
+    assert key(EntityRecognizer.remove_duplicates(results)) == key(analyze("\n".join(TEXTS)))
+
+
+def test_value_cut_by_a_window_border_is_not_reported():
+    # Wherever the border falls, the 8 digits left of a RUC by a window that
+    # starts inside it must not turn into a DNI
+    for shift in range(60):
+        text = "palabra " * 20 + "x" * shift + " RUC 20123456789 " + "palabra " * 20
+        assert key(analyze_windowed(analyze, text, 100, 40)) == key(analyze(text)), shift
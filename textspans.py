@@ -0,0 +1,109 @@
+import bisect
+import re
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+class Span(NamedTuple):
+    start: int
+    end: int
+    replacement: str
+
+
+class CleanText:
+    """
+    Text with every whitespace run collapsed to one space and the ends stripped.
+
+    Keeps what is needed to map offsets in the cleaned text back to the
+    original, so results found in the cleaned text can be applied to the
+    original one. The map is only built the first time it is used.
+    """
+
+    def __init__(self, original: str):
+        self.original = original
+        self.text = WHITESPACE_RE.sub(" ", original).strip()
+        # (cleaned offset, original - cleaned from there on), sorted
+        self._starts: Optional[List[int]] = None
+        self._deltas: Optional[List[int]] = None
+
+    def _build(self):
+        starts = [0]
+        deltas = [0]
+        position = 0  # cleaned offset of the current original offset
+        previous_end = 0
+        for match in WHITESPACE_RE.finditer(self.original):
+            position += match.start() - previous_end
+            previous_end = match.end()
+            if match.start() == 0:
+                # Stripped: the cleaned text starts where the run ends
+                deltas[0] = match.end()
+                continue
+            if match.end() == len(self.original):
+                break
+            # The run became one space, at cleaned offset position
+            position += 1
+            starts.append(position)
+            deltas.append(match.end() - position)
+        self._starts, self._deltas = starts, deltas
+
+    def _original_offset(self, offset: int) -> int:
+        index = bisect.bisect_right(self._starts, offset) - 1
+        return offset + self._deltas[index]
+
+    def to_original(self, start: int, end: int) -> Tuple[int, int]:
+        """Original offsets of the cleaned text[start:end]"""
+        if self._starts is None:
+            self._build()
+        if end <= start:
+            position = self._original_offset(start)
+            return position, position
+        return self._original_offset(start), self._original_offset(end - 1) + 1
+
+
+def redact(text: str, spans: Iterable[Span]) -> str:
+    """
+    Rewrite text with every span replaced, in a single pass.
+
+    Overlapping spans are resolved in favour of the one starting first (the
+    longest, when they start together).
+    """
+    out = []
+    position = 0
+    for start, end, replacement in sorted(spans, key=lambda span: (span.start, -span.end)):
+        if start < position:
+            continue
+        out.append(text[position:start])
+        out.append(replacement)
+        position = end
+    out.append(text[position:])
+    return "".join(out)
+
+
+def find_values(text: str, censor_dict: Dict[str, str]) -> List[Span]:
+    """Spans of every occurrence of the censor_dict keys, found in one pass (longest key first)"""
+    keys = sorted((key for key in censor_dict if key), key=len, reverse=True)
+    if not keys:
+        return []
+    pattern = re.compile("|".join(re.escape(key) for key in keys))
+    return [Span(match.start(), match.end(), censor_dict[match.group(0)]) for match in pattern.finditer(text)]
+
+
+def replace_values(text: str, censor_dict: Dict[str, str]) -> str:
+    return redact(text, find_values(text, censor_dict))
+
+
+def clip_spans(spans: Iterable[Span], start: int, end: int) -> Iterator[Span]:
+    """
+    The part of each span inside text[start:end], relative to start.
+
+    A span running over several pieces is replaced in the piece where it
+    starts and removed from the following ones.
+    """
+    for span in spans:
+        if span.end <= start or span.start >= end:
+            continue
+        if span.start >= start:
+            yield Span(span.start - start, min(span.end, end) - start, span.replacement)
+        else:
+            yield Span(0, min(span.end, end) - start, "")
@@ -0,0 +1,190 @@
+from collections import deque
+from concurrent.futures import Executor
+from typing import Callable, Deque, Iterable, Iterator, List, NamedTuple, Optional
+
+from presidio_analyzer import EntityRecognizer, RecognizerResult
+
+DEFAULT_WINDOW_SIZE = 50_000
+DEFAULT_WINDOW_OVERLAP = 2_000
+DEFAULT_SEGMENT_SIZE = 10_000
+
+
+class Window(NamedTuple):
+    start: int
+    end: int
+    # Results starting in [own_start, own_end) are taken from this window
+    own_start: int
+    own_end: int
+
+
+def split_windows(text: str, size: int = DEFAULT_WINDOW_SIZE, overlap: int = DEFAULT_WINDOW_OVERLAP) -> List[Window]:
+    """
+    Cut text into windows of at most size characters, each overlapping the next by about overlap characters.
+
+    Windows end on a space where there is one, so words aren't cut in two.
+    The overlap is shared at its middle: every offset of the text is owned
+    by exactly one window, and at least overlap // 2 characters away from
+    the edges that window shares with its neighbours.
+    """
+    if size <= 2 * overlap:
+        raise ValueError(f"Window size ({size}) must be more than twice the overlap ({overlap})")
+    if len(text) <= size:
+        return [Window(0, len(text), 0, len(text))]
+
+    bounds = []
+    start = 0
+    while True:
+        end = min(start + size, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + 2 * overlap, end)
+            if space != -1:
+                end = space
+        bounds.append((start, end))
+        if end == len(text):
+            break
+        start = end - overlap
+
+    margin = overlap // 2
+    windows = []
+    for i, (start, end) in enumerate(bounds):
+        own_start = 0 if i == 0 else bounds[i][0] + margin
+        own_end = len(text) if i == len(bounds) - 1 else bounds[i + 1][0] + margin
+        windows.append(Window(start, end, own_start, own_end))
+    return windows
+
+
+def merge_window_results(windows: List[Window], window_results: List[List[RecognizerResult]]) -> List[RecognizerResult]:
+    """
+    Combine per-window results into results for the whole text.
+
+    Offsets are moved back to the whole text and each result is kept only
+    from the window that owns its start, which drops the duplicates seen by
+    two windows as well as matches made up by a window edge (a number cut
+    in two, a word without its context). The single-pass duplicate removal
+    then runs over the merged list.
+    """
+    merged = []
+    for window, results in zip(windows, window_results):
+        for result in results:
+            result.start += window.start
+            result.end += window.start
+            if window.own_start <= result.start < window.own_end:
+                merged.append(result)
+    return EntityRecognizer.remove_duplicates(merged)
+
+
+def analyze_windowed(
+    analyze: Callable[[str], List[RecognizerResult]],
+    text: str,
+    size: int = DEFAULT_WINDOW_SIZE,
+    overlap: int = DEFAULT_WINDOW_OVERLAP,
+    executor: Optional[Executor] = None,
+) -> List[RecognizerResult]:
+    """
+    Run analyze over the windows of text (in parallel on executor, if given) and merge the results.
+
+    Matches single-pass analysis as long as no entity, together with the
+    context words that raise its score, spans more than overlap // 2
+    characters.
+    """
+    windows = split_windows(text, size, overlap)
+    texts = [text[window.start : window.end] for window in windows]
+    if executor is None or len(windows) == 1:
+        window_results = [analyze(window_text) for window_text in texts]
+    else:
+        window_results = list(executor.map(analyze, texts))
+    return merge_window_results(windows, window_results)
+
+
+def coalesce_segments(
+    segments: Iterable[str], min_length: int = DEFAULT_SEGMENT_SIZE, separator: str = "\n"
+) -> Iterator[str]:
+    """
+    Join consecutive segments into pieces of at least min_length characters (but for the last one).
+
+    The pieces joined by separator are the same text as the segments, so
+    short segments such as paragraphs can be analyzed a piece at a time
+    rather than one by one, each with its own overlap.
+    """
+    group = []
+    length = 0
+    for segment in segments:
+        group.append(segment)
+        length += len(segment) + len(separator)
+        if length >= min_length:
+            yield separator.join(group)
+            group = []
+            length = 0
+    if group:
+        yield separator.join(group)
+
+
+class SegmentWindow(NamedTuple):
+    segment: str
+    # The segment with up to overlap // 2 characters of the text around it
+    text: str
+    # Offset of text in the whole text
+    offset: int
+    # The segment (and the separator after it), in text
+    own_start: int
+    own_end: int
+    # No segment comes after this one
+    last: bool
+
+
+def segment_windows(
+    segments: Iterable[str], overlap: int = DEFAULT_WINDOW_OVERLAP, separator: str = "\n"
+) -> Iterator[SegmentWindow]:
+    """
+    One window per segment of a text that arrives in segments (pages, paragraphs) joined by separator.
+
+    As with split_windows, keeping from each window only the results that
+    start in the part it owns gives the results of the whole text, so the
+    text can be analyzed while it is still being read. A segment is
+    yielded once the segment after it and the overlap // 2 characters
+    after it have arrived, or the segments have run out.
+    """
+    margin = overlap // 2
+    iterator = iter(segments)
+    pending: Deque[str] = deque()
+    pending_length = 0
+    exhausted = False
+    before = ""
+    offset = 0
+    while True:
+        # The next segment, to tell whether the current one is the last, and
+        # the text known after the current segment and its separator
+        while not exhausted and (
+            len(pending) < 2 or pending_length - len(pending[0]) - 2 * len(separator) < margin
+        ):
+            segment = next(iterator, None)
+            if segment is None:
+                exhausted = True
+            else:
+                pending.append(segment)
+                pending_length += len(segment) + len(separator)
+        if not pending:
+            return
+
+        segment = pending.popleft()
+        pending_length -= len(segment) + len(separator)
+        owned = segment + separator if pending else segment
+        after = []
+        after_length = 0
+        for following in pending:
+            if after_length >= margin:
+                break
+            piece = separator + following if after else following
+            after.append(piece)
+            after_length += len(piece)
+
+        yield SegmentWindow(
+            segment,
+            before + owned + "".join(after)[:margin],
+            offset - len(before),
+            len(before),
+            len(before) + len(owned),
+            exhausted and not pending,
+        )
+        before = (before + owned)[-margin:] if margin else ""
+        offset += len(owned)